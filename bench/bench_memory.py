@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Compare the memory used by a parsed playlist with the compact Item
+storage against the old dict-based Item and Playlist.
+
+    python bench/bench_memory.py [number of items]
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import navix
+
+def synthetic_playlist(n):
+    "Write a playlist with n video items to a temporary file"
+    fd, fname = tempfile.mkstemp(suffix='.plx')
+    out = os.fdopen(fd, 'w')
+    out.write("version=4\ntitle=Benchmark\n\n")
+    for i in xrange(n):
+        out.write("type=video\n"
+                  "name=[COLOR=FFFFFF00]Synthetic video %d[/COLOR]\n"
+                  "thumb=http://images.example.com/thumbs/default.jpg\n"
+                  "date=2010-01-%02d\n"
+                  "infotag=%dm\n"
+                  "URL=http://videos.example.com/watch?v=%08d\n"
+                  "processor=http://navix.turner3d.net/proc/example\n"
+                  "description=Video number %d, with a description\n"
+                  "which goes over several lines/description\n"
+                  "#\n" % (i, i % 28 + 1, i % 120, i, i))
+    out.close()
+    return fname
+
+class DictItem(dict):
+    "The previous Item: a dict of decoded values"
+    @property
+    def url(self):
+        return self.get('URL', None)
+
+def dict_playlist(url):
+    "Build the structures of the previous list-based Playlist"
+    items = []
+    d = {}
+    for x in navix.parse_navix_pls(url):
+        item = DictItem((navix.dcode(k), navix.dcode(v)) for k, v in x.items())
+        if item.url:
+            d[item.url] = item
+        items.append(item)
+    return items, d
+
+def deep_size(obj, seen=None):
+    "Return the total size of obj and everything it references"
+    if seen is None:
+        seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif isinstance(o, navix.Item):
+            stack.append(o._layout)
+            stack.append(o._values)
+    return total
+
+def main(args):
+    n = len(args) > 1 and int(args[1]) or 50000
+    fname = synthetic_playlist(n)
+    url = "file://" + fname
+    try:
+        t = time.time()
+        old = dict_playlist(url)
+        old_time = time.time() - t
+        t = time.time()
+        pl = navix.Playlist(url, lazy=False)
+        new_time = time.time() - t
+        # interned strings are shared with the interpreter; count them once
+        old_size = deep_size(old)
+        new_size = deep_size((pl.items, pl.d))
+    finally:
+        os.unlink(fname)
+    print "%d items" % n
+    print "%-12s %12s %10s %10s" % ("", "total", "per item", "parse")
+    for label, size, secs in (("dict Item", old_size, old_time),
+                              ("compact Item", new_size, new_time)):
+        print "%-12s %10dkB %9dB %9.2fs" % (label, size // 1024, size // n, secs)
+    print "compact Items use %.1f%% of the memory" % (100.0 * new_size / old_size)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Time how long navix.py takes to start and show its first playlist.
+
+    python bench/bench_startup.py [number of items] [server delay] [runs]
+
+The index playlist is served from bench/server.py, which waits server
+delay seconds (0.3 by default) before each response, like a distant
+one.  Each run starts navix.py with its own home directory, treating
+cached playlists as older than PLAYLIST_TTL, as on the next day:
+
+    cold      nothing saved from an earlier run
+    cached    the playlist in the HTTP cache, to be revalidated
+    snapshot  the playlist in the session snapshot as well
+
+and times the first item being listed, and the process exiting.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+import server
+
+NAVIX = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'navix.py')
+
+def run(url, home):
+    """Start navix.py on url with no commands, returning the seconds until
+    it listed the first item and until it exited"""
+    env = dict(os.environ, HOME=home)
+    code = ('import sys; sys.path.insert(0, %r); import navix; '
+            'navix.playlist_cache.ttl = 0; sys.exit(navix.main([%r, %r]))'
+            % (os.path.dirname(NAVIX), NAVIX, url))
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, '-c', code], env=env,
+                            stdin=open(os.devnull), stdout=subprocess.PIPE)
+    first = None
+    for line in iter(proc.stdout.readline, ''):
+        if first is None and '[  0]' in line:
+            first = time.time() - start
+    proc.wait()
+    return first, time.time() - start
+
+def import_time():
+    "Seconds to start python and import navix"
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c',
+        'import sys; sys.path.insert(0, %r); import navix' % os.path.dirname(NAVIX)])
+    return time.time() - start
+
+def main(args):
+    n = len(args) > 1 and int(args[1]) or 2000
+    delay = len(args) > 2 and float(args[2]) or 0.3
+    runs = len(args) > 3 and int(args[3]) or 3
+    url = server.start(delay=delay).url('/playlist.plx?n=%d' % n)
+    results = {'cold' : [], 'cached' : [], 'snapshot' : []}
+    for i in xrange(runs):
+        home = tempfile.mkdtemp(prefix='navix-bench-')
+        try:
+            results['cold'].append(run(url, home))
+            os.unlink(os.path.join(home, '.navix', 'session'))
+            results['cached'].append(run(url, home))
+            results['snapshot'].append(run(url, home))
+        finally:
+            shutil.rmtree(home)
+    print "%d items, %.2fs server delay, best of %d runs" % (n, delay, runs)
+    print "%-10s %12s %10s" % ("", "first item", "exit")
+    print "%-10s %12s %9.3fs" % ("import", "", min(import_time() for i in xrange(runs)))
+    for label in ('cold', 'cached', 'snapshot'):
+        first = min(r[0] for r in results[label])
+        done = min(r[1] for r in results[label])
+        print "%-10s %11.3fs %9.3fs" % (label, first, done)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,261 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Benchmark parsing playlists, resolving items through processors and
+downloading, offline, against the stand-in server in bench/server.py.
+
+    python bench/bench_suite.py [options]
+
+    -n ITEMS      items in the parsed playlist (20000)
+    -r COUNT      items resolved through each processor version (200)
+    -m MB         size of the downloaded file (64)
+    -t RUNS       runs of each benchmark, keeping the best (3)
+    -o FILE       where to save the results (bench-<date>-<time>.json)
+    -c OLD.json   compare the results with an earlier run's
+
+It reports:
+
+    parse       items/s from parse_navix_pls(), fetching the playlist
+                (http), from the playlist cache (cached), and from a file
+    resolve     resolutions/s and latency percentiles for the v1 and v2
+                (two phase) processors, each item resolved from scratch,
+                and resolutions/s one at a time (serial) and with
+                resolve_all() (batch) from a server that takes DELAY
+                seconds to answer each request
+    download    MB/s from get_file(), over one connection and SEGMENTS,
+                and over one connection from a server that sends no
+                Content-Length (nolength), which must still arrive whole
+
+navix.py runs with its own home directory, so nothing is read from or
+saved to ~/.navix.
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import itertools
+import subprocess
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+HOME = tempfile.mkdtemp(prefix='navix-bench-')
+os.environ['HOME'] = HOME # before navix works out where its caches go
+
+import server
+import navix
+import scraper
+import downloader
+
+class QuietBoard(object):
+    "Takes the place of a ProgressBoard, so downloads draw nothing"
+    def log(self, msg):
+        pass
+
+def percentile(values, p):
+    "The p'th percentile of values (nearest rank)"
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def best(runs, func):
+    "Call func runs times, returning the shortest time and its result"
+    results = []
+    for i in xrange(runs):
+        start = time.time()
+        result = func()
+        results.append((time.time() - start, result))
+    return min(results)
+
+def bench_parse(srv, items, runs):
+    url = srv.url('/playlist.plx?n=%d' % items)
+    def parse():
+        return sum(1 for d in navix.parse_navix_pls(url))
+    def fetch_and_parse():
+        navix.playlist_cache.clear()
+        return parse()
+    fname = os.path.join(HOME, 'bench.plx')
+    fd = open(fname, 'w')
+    fd.write(server.playlist(srv.url(''), items))
+    fd.close()
+    def parse_file():
+        return sum(1 for d in navix.parse_navix_pls('file://' + fname))
+    results = {}
+    for name, func in (('http', fetch_and_parse), ('cached', parse),
+                       ('file', parse_file)):
+        secs, n = best(runs, func)
+        results['parse_' + name] = { 'items' : n, 'seconds' : round(secs, 4),
+                                     'items_per_sec' : round(n / secs) }
+    return results
+
+def bench_resolve(srv, count, runs):
+    results = {}
+    for version in ('v1', 'v2'):
+        procurl = srv.url('/proc/' + version)
+        latencies = []
+        elapsed = 0
+        for run in xrange(runs):
+            start = time.time()
+            for i in xrange(count):
+                # a new page each time, so nothing comes from proc_cache
+                url = srv.url('/page/%s%dr%d' % (version, i, run))
+                t = time.time()
+                res = scraper.navix_resolve(procurl, url)
+                latencies.append(time.time() - t)
+                if res is None or not res.url.endswith(server.token(
+                        '%s%dr%d' % (version, i, run))):
+                    raise AssertionError("%s resolved %s to %r" % (version, url, res))
+            elapsed += time.time() - start
+        ms = lambda secs: round(secs * 1000, 3)
+        results['resolve_' + version] = {
+            'resolutions' : len(latencies),
+            'per_sec' : round(len(latencies) / elapsed, 1),
+            'p50_ms' : ms(percentile(latencies, 50)),
+            'p90_ms' : ms(percentile(latencies, 90)),
+            'p99_ms' : ms(percentile(latencies, 99)),
+            'max_ms' : ms(max(latencies)) }
+    return results
+
+DELAY = 0.02 # seconds the server for the batch resolutions waits to answer
+
+def bench_resolve_batch(count, runs):
+    srv = server.start(delay=DELAY)
+    procurl = srv.url('/proc/v2')
+    pages = itertools.count()
+    results = {}
+    for name in ('serial', 'batch'):
+        def resolve_pages():
+            # new pages each time, so nothing comes from the caches
+            keys = [(procurl, srv.url('/page/b%d' % next(pages)))
+                    for i in xrange(count)]
+            if name == 'serial':
+                resolved = [scraper.resolve(*key) for key in keys]
+            else:
+                resolved = [r[1] for r in scraper.resolve_all(keys)]
+            if None in resolved:
+                raise AssertionError("%s: not every item resolved" % name)
+            return len(resolved)
+        secs, n = best(runs, resolve_pages)
+        results['resolve_' + name] = { 'resolutions' : n,
+            'seconds' : round(secs, 4), 'per_sec' : round(n / secs, 1) }
+    results['resolve_batch']['workers'] = scraper.RESOLVE_WORKERS
+    return results
+
+def bench_download(srv, mb, runs):
+    size = mb << 20
+    browser = scraper.shared_browser()
+    results = {}
+    url = srv.url('/media/%d/bench' % size)
+    for name, segments, query in (('1', 1, ''),
+            (str(downloader.SEGMENTS), downloader.SEGMENTS, ''),
+            ('nolength', 1, '?nolength=1')):
+        def opener(byterange, url=url + query):
+            if byterange is None:
+                return browser.get(url)
+            return browser.get(url, Range=byterange)
+        def get():
+            fname = os.path.join(HOME, 'bench.avi')
+            progress = downloader.Progress(fname, board=QuietBoard())
+            fname = downloader.get_file(opener, fname, progress, segments)
+            written = os.path.getsize(fname)
+            os.unlink(fname)
+            if written != size:
+                raise AssertionError("downloaded %d of %d bytes" % (written, size))
+            return written
+        secs, n = best(runs, get)
+        results['download_' + name] = { 'segments' : segments,
+            'bytes' : n, 'seconds' : round(secs, 4),
+            'mb_per_sec' : round(n / secs / (1 << 20), 1) }
+    return results
+
+def git_revision():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=HERE, stdout=subprocess.PIPE,
+            stderr=open(os.devnull, 'w')).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+# the measurements compared between runs, and whether more is better
+MEASURES = (('items_per_sec', True), ('per_sec', True), ('p50_ms', False),
+            ('p90_ms', False), ('p99_ms', False), ('mb_per_sec', True))
+
+def report(results, old=None):
+    "Print the results, with the change from the old ones"
+    for name in sorted(results):
+        for measure, more in MEASURES:
+            value = results[name].get(measure)
+            if value is None:
+                continue
+            line = "%-16s %-14s %12s" % (name, measure, value)
+            then = old and old.get(name, {}).get(measure)
+            if then:
+                change = (value - then) * 100.0 / then
+                better = (change > 0) == more
+                line += "  %12s  %+6.1f%% %s" % (then, change,
+                    abs(change) >= 5 and (better and "better" or "worse") or "")
+            print line
+
+def main(args):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('-n', dest='items', type='int', default=20000,
+                      help="items in the parsed playlist")
+    parser.add_option('-r', dest='resolutions', type='int', default=200,
+                      help="items resolved by each processor version")
+    parser.add_option('-m', dest='mb', type='int', default=64,
+                      help="size of the downloaded file in MB")
+    parser.add_option('-t', dest='runs', type='int', default=3,
+                      help="runs of each benchmark")
+    parser.add_option('-o', dest='output', help="file to save the results to")
+    parser.add_option('-c', dest='compare', help="earlier results to compare with")
+    opts, rest = parser.parse_args(args[1:])
+    old = None
+    if opts.compare:
+        old = json.load(open(opts.compare))['results']
+    output = opts.output or time.strftime('bench-%Y%m%d-%H%M%S.json')
+    srv = server.start()
+    try:
+        results = {}
+        results.update(bench_parse(srv, opts.items, opts.runs))
+        results.update(bench_resolve(srv, opts.resolutions, opts.runs))
+        results.update(bench_resolve_batch(opts.resolutions, opts.runs))
+        results.update(bench_download(srv, opts.mb, opts.runs))
+    finally:
+        shutil.rmtree(HOME)
+    run = {
+        'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision' : git_revision(),
+        'python' : sys.version.split()[0],
+        'platform' : sys.platform,
+        'options' : { 'items' : opts.items, 'resolutions' : opts.resolutions,
+                      'mb' : opts.mb, 'runs' : opts.runs },
+        'results' : results,
+    }
+    fd = open(output, 'w')
+    json.dump(run, fd, indent=2, sort_keys=True)
+    fd.write('\n')
+    fd.close()
+    report(results, old)
+    print "Saved to %s" % output
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""A local stand-in for a Navi-X server and the sites its processors
+scrape, for the benchmarks.
+
+    /playlist.plx?n=N[&proc=v1|v2]
+        a playlist of N items: every tenth a playlist, the rest videos
+        with processors, alternating between v1 and v2 unless proc says
+    /page/<i>
+        an item's web page, with a token for the processors to scrape
+    /proc/v1?url=<page>, /proc/v1?v1=<token>
+        a v1 processor: a page to scrape and a regex, then the media URL
+    /proc/v2?url=<page>, /proc/v2?tok=<token>
+        a v2 (NIPL) processor in two phases: phase 1 scrapes the page
+        and reports the token, phase 2 builds the media URL and a cookie
+    /media/<size>[/<token>][?nolength=1]
+        size bytes of media, with Range requests and an ETag, or with
+        nolength, without a Content-Length (ended by closing the
+        connection, like an HTTP/1.0 server)
+
+Playlists have ETags too, so clients can revalidate them.  Each
+response waits for the server's delay first, like a distant server.
+
+    python bench/server.py [port]
+"""
+
+import re
+import sys
+import time
+import random
+import threading
+import BaseHTTPServer
+import SocketServer
+from urlparse import urlparse, parse_qs
+
+MEDIA_SIZE = 16 << 20 # bytes of media the processors resolve to
+CHUNK = 1 << 16       # media is written in blocks of this size
+
+# the media bodies: this block, repeated
+_block = ''.join(chr(random.Random(0).randrange(256)) for i in xrange(CHUNK))
+
+PHASE1 = """v2
+# phase 1: scrape the page for the token, and report it
+regex='token=(\\w+)
+scrape
+if nomatch
+  error 'no token
+endif
+report_val tok v1
+report
+"""
+
+PHASE2 = """# phase 2: build the media URL from the reported token
+url='%(base)s/media/%(size)d/
+concat url v1
+s_cookie='session=%(token)s
+play
+"""
+
+def playlist(base, n, proc=None):
+    "The text of a synthetic playlist of n items"
+    lines = ["version=4", "title=Benchmark %d" % n, ""]
+    for i in xrange(n):
+        if i % 10 == 9:
+            lines += ["type=playlist", "name=Playlist %d" % i,
+                      "URL=%s/playlist.plx?n=10" % base, "#"]
+            continue
+        lines += ["type=video",
+                  "name=[COLOR=FFFFFF00]Synthetic video %d[/COLOR]" % i,
+                  "thumb=%s/thumbs/default.jpg" % base,
+                  "infotag=%dm" % (i % 120),
+                  "URL=%s/page/%d" % (base, i),
+                  "processor=%s/proc/%s" % (base, proc or ('v1', 'v2')[i % 2]),
+                  "description=Video number %d, with a description" % i,
+                  "which goes over two lines/description", "#"]
+    return "\n".join(lines) + "\n"
+
+def token(i):
+    return "t%sx" % i
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1 # send the headers with the body, not a packet each
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.requests += 1
+        u = urlparse(self.path)
+        q = dict((k, v[0]) for k, v in parse_qs(u.query).items())
+        base = "http://%s:%d" % self.server.server_address
+        path = u.path
+        if path == '/playlist.plx':
+            n = int(q.get('n', 100))
+            etag = '"pl-%d-%s"' % (n, q.get('proc', ''))
+            if self.headers.get('If-None-Match') == etag:
+                return self.reply('', 304, extra=[('ETag', etag)])
+            return self.reply(playlist(base, n, q.get('proc')),
+                              extra=[('ETag', etag)])
+        m = re.match(r'/page/(\w+)$', path)
+        if m:
+            return self.reply("<html><p>token=%s</p></html>" % token(m.group(1)),
+                              ctype='text/html')
+        if path == '/proc/v1':
+            if 'v1' in q:
+                return self.reply("%s/media/%d/%s" % (base, MEDIA_SIZE, q['v1']))
+            return self.reply("%s\ntoken=(\\w+)" % q.get('url', ''))
+        if path == '/proc/v2':
+            if 'tok' in q:
+                return self.reply(PHASE2 % { 'base' : base, 'size' : MEDIA_SIZE,
+                                             'token' : q['tok'] })
+            return self.reply(PHASE1)
+        m = re.match(r'/media/(\d+)(/\w+)?$', path)
+        if m:
+            if 'nolength' in q:
+                return self.media_nolength(int(m.group(1)))
+            return self.media(int(m.group(1)))
+        self.reply('not found', 404)
+
+    def reply(self, body, code=200, ctype='text/plain', extra=()):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in extra:
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def media(self, size):
+        "Send size bytes of media, or the requested range of them"
+        start, end = 0, size - 1
+        m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if m:
+            start = int(m.group(1))
+            if m.group(2):
+                end = min(int(m.group(2)), size - 1)
+            if start >= size:
+                return self.reply('', 416, extra=[
+                    ('Content-Range', 'bytes */%d' % size)])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'video/x-msvideo')
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"media-%d"' % size)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        self.write_media(start, end)
+
+    def media_nolength(self, size):
+        "Send size bytes of media with no length, closing the connection"
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/x-msvideo')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = 1
+        if self.command != 'HEAD':
+            self.write_media(0, size - 1)
+
+    def write_media(self, start, end):
+        pos = start
+        while pos <= end:
+            offset = pos % CHUNK
+            n = min(CHUNK - offset, end + 1 - pos)
+            self.wfile.write(buffer(_block, offset, n))
+            pos += n
+# Handler
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass # a client went away mid-response
+
+    def url(self, path):
+        return "http://%s:%d%s" % (self.server_address + (path,))
+# Server
+
+def start(port=0, delay=0):
+    """Start a server on a background thread, waiting delay seconds
+    before each response"""
+    server = Server(('127.0.0.1', port), Handler)
+    server.delay = delay
+    server.requests = 0
+    server.lock = threading.Lock()
+    t = threading.Thread(target=server.serve_forever, name="Bench server")
+    t.daemon = True
+    t.start()
+    return server
+
+if __name__ == '__main__':
+    server = start(len(sys.argv) > 1 and int(sys.argv[1]) or 0)
+    print "Serving on %s" % server.url('/playlist.plx?n=100')
+    while True:
+        time.sleep(60)
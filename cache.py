@@ -0,0 +1,404 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Local caches for things fetched over HTTP
+
+An HTTPCache keeps response bodies in memory and in a directory under
+CACHEDIR, and revalidates stale entries with If-None-Match and
+If-Modified-Since.  If revalidation fails because we're offline, the
+stale entry is used anyway.  Each cache's directory is pruned to
+DISK_MAXITEMS entries, none older than DISK_MAXAGE seconds.
+"""
+
+import os
+import time
+import errno
+import hashlib
+import threading
+import cPickle as pickle
+from cStringIO import StringIO
+from collections import OrderedDict
+
+CACHEDIR = os.path.join(os.path.expanduser("~"), ".navix", "cache")
+DISK_MAXITEMS = 4096          # entries kept on disk per cache
+DISK_MAXAGE = 30 * 24 * 3600  # seconds an entry is kept on disk unused
+PRUNE_EVERY = 256             # entries stored between prunings
+
+def prefix_lookup(d, url, default=None):
+    "Return the value in d for the longest key that prefixes url"
+    best = None
+    for prefix in d:
+        if url.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    if best is None:
+        return default
+    return d[best]
+
+def current(ttl):
+    "The value of a ttl that may be a function returning it"
+    if callable(ttl):
+        return ttl()
+    return ttl
+
+class Entry(object):
+    """A cached response body and its validators"""
+    __slots__ = ('url', 'body', 'etag', 'last_modified', 'stored')
+
+    def __init__(self, url, body, etag=None, last_modified=None, stored=None):
+        self.url = url
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored = stored or time.time()
+
+    def __getstate__(self):
+        return (self.url, self.body, self.etag, self.last_modified, self.stored)
+
+    def __setstate__(self, state):
+        self.url, self.body, self.etag, self.last_modified, self.stored = state
+
+    def age(self):
+        return time.time() - self.stored
+
+    def validators(self):
+        "Return the headers for a conditional request for this entry"
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+# Entry
+
+class DiskCache(object):
+    """A directory of pickled entries, one file per key
+
+    It's pruned when the first entry is stored and every PRUNE_EVERY
+    after that: the oldest entries go once there are more than maxitems,
+    and any not stored or used in maxage seconds.  None for either means
+    DISK_MAXITEMS or DISK_MAXAGE, read when pruning."""
+    def __init__(self, path, maxitems=None, maxage=None):
+        self.path = path
+        self.maxitems = maxitems
+        self.maxage = maxage
+        self.puts = 0
+
+    def filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        try:
+            fd = open(self.filename(key), "rb")
+        except IOError:
+            return None
+        try:
+            try:
+                entry = pickle.load(fd)
+                try: os.utime(fd.name, None) # used, so pruned last
+                except OSError: pass
+                return entry
+            except Exception:
+                return None # a corrupt entry is a missing entry
+        finally:
+            fd.close()
+
+    def put(self, key, entry):
+        "Atomically store an entry, ignoring errors (eg. a read-only home)"
+        fname = self.filename(key)
+        tmpname = "%s.%d.%d" % (fname, os.getpid(), threading.current_thread().ident)
+        try:
+            try:
+                os.makedirs(self.path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            fd = open(tmpname, "wb")
+            try:
+                pickle.dump(entry, fd, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+            os.rename(tmpname, fname)
+        except (IOError, OSError):
+            try: os.unlink(tmpname)
+            except OSError: pass
+        self.puts += 1
+        if self.puts % PRUNE_EVERY == 1:
+            self.prune()
+
+    def prune(self):
+        "Remove old entries, and the oldest beyond maxitems"
+        maxitems = self.maxitems
+        if maxitems is None:
+            maxitems = DISK_MAXITEMS
+        maxage = self.maxage
+        if maxage is None:
+            maxage = DISK_MAXAGE
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        entries = []
+        for name in names:
+            fname = os.path.join(self.path, name)
+            try:
+                entries.append((os.path.getmtime(fname), fname))
+            except OSError:
+                pass # removed meanwhile
+        entries.sort(reverse=True) # newest first
+        cutoff = time.time() - maxage
+        for n, (mtime, fname) in enumerate(entries):
+            if n >= maxitems or mtime < cutoff:
+                try:
+                    os.unlink(fname)
+                except OSError:
+                    pass
+
+    def delete(self, key):
+        try:
+            os.unlink(self.filename(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+# DiskCache
+
+class CachingFile(object):
+    """Wraps a response, storing its body in an HTTPCache once it has
+    been read to the end"""
+    def __init__(self, cache, url, res):
+        self.cache = cache
+        self.url = url
+        self.res = res
+        self.chunks = []
+
+    def info(self):
+        return self.res.info()
+
+    def geturl(self):
+        return self.res.geturl()
+
+    def getcode(self):
+        return self.res.getcode()
+
+    def _keep(self, data, eof):
+        if self.chunks is None:
+            return data
+        if data:
+            self.chunks.append(data)
+        if eof:
+            info = self.res.info()
+            self.cache.store(Entry(self.url, ''.join(self.chunks),
+                info.get('ETag'), info.get('Last-Modified')))
+            self.chunks = None
+        return data
+
+    def read(self, amt=-1):
+        data = self.res.read(amt)
+        return self._keep(data, amt is None or amt < 0 or not data)
+
+    def readline(self):
+        data = self.res.readline()
+        return self._keep(data, not data)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        "Close the response; the body isn't cached unless it was all read"
+        self.chunks = None
+        self.res.close()
+# CachingFile
+
+class HTTPCache(object):
+    """Two-tier (memory LRU + disk) cache of HTTP response bodies
+
+    ttl is the number of seconds an entry is used without revalidation,
+    or a function returning it (eg. to read a setting when it's needed),
+    and can be overridden per URL prefix by adding to the ttls dict.
+    A ttl of 0 revalidates every time, and None disables the cache."""
+    def __init__(self, name, ttl=3600, maxitems=256, path=None):
+        self.name = name
+        self.ttl = ttl
+        self.ttls = {}
+        self.maxitems = maxitems
+        self.mem = OrderedDict()
+        self.disk = DiskCache(path or os.path.join(CACHEDIR, name))
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.revalidated = 0
+
+    def ttl_for(self, url):
+        "Return the ttl for the given url"
+        return prefix_lookup(self.ttls, url, current(self.ttl))
+
+    def lookup(self, url):
+        "Return the entry for url from memory or disk, or None"
+        with self.lock:
+            entry = self.mem.get(url)
+            if entry is not None:
+                del self.mem[url]
+                self.mem[url] = entry
+                return entry
+        entry = self.disk.get(url)
+        if entry is not None:
+            self.remember(entry)
+        return entry
+
+    def remember(self, entry):
+        "Add an entry to the memory tier"
+        with self.lock:
+            self.mem.pop(entry.url, None)
+            self.mem[entry.url] = entry
+            while len(self.mem) > self.maxitems:
+                self.mem.popitem(last=False)
+
+    def store(self, entry):
+        self.remember(entry)
+        self.disk.put(entry.url, entry)
+
+    def invalidate(self, url):
+        with self.lock:
+            self.mem.pop(url, None)
+        self.disk.delete(url)
+
+    def clear(self):
+        with self.lock:
+            self.mem.clear()
+        self.disk.clear()
+
+    def open(self, browser, url, ttl=-1, store=True):
+        """Return a file-like object for the body of url, using browser
+        only when the cached copy is missing or stale.  A fresh response
+        is streamed, and stored in the cache once it's read to the end,
+        unless store is False (eg. for a crawl, which would fill the
+        disk with playlists nobody may look at)."""
+        if ttl == -1:
+            ttl = self.ttl_for(url)
+        if ttl is None:
+            return browser.get(url)
+        entry = self.lookup(url)
+        if entry is not None and entry.age() < ttl:
+            self.hits += 1
+            return StringIO(entry.body)
+        headers = entry and entry.validators() or {}
+        import urllib2 # slow to import, and only needed here
+        try:
+            res = browser.get(url, **headers)
+        except urllib2.HTTPError, e:
+            if e.code != 304 or entry is None:
+                raise
+            self.revalidated += 1
+            if store:
+                entry.stored = time.time()
+                self.store(entry)
+            return StringIO(entry.body)
+        except urllib2.URLError:
+            if entry is None:
+                raise
+            return StringIO(entry.body) # offline, so stale is better than nothing
+        self.misses += 1
+        if not store:
+            return res
+        return CachingFile(self, url, res)
+
+    def fetch(self, browser, url, ttl=-1):
+        "Return the body of url, as for open()"
+        fd = self.open(browser, url, ttl)
+        try:
+            return fd.read()
+        finally:
+            fd.close()
+
+    def stats(self):
+        return "%s: %d in memory, %d hits, %d revalidated, %d fetched" % (
+            self.name, len(self.mem), self.hits, self.revalidated, self.misses)
+# HTTPCache
+
+class ExpiringCache(object):
+    """An in-memory LRU whose entries expire after a number of seconds
+
+    Keys are tuples whose first element is a URL (eg. a processor) used
+    to look up per-prefix expiry times in the ttls dict.  As for an
+    HTTPCache, ttl can be a function returning the number of seconds, and
+    a ttl of 0 (or None) disables the cache, including for the entries
+    already in it."""
+    def __init__(self, name, ttl=300, maxitems=1024):
+        self.name = name
+        self.ttl = ttl
+        self.ttls = {}
+        self.maxitems = maxitems
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def ttl_for(self, key):
+        return prefix_lookup(self.ttls, key[0], current(self.ttl))
+
+    def get(self, key):
+        "Return the unexpired value for key, or None"
+        if not self.ttl_for(key):
+            return None
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.time():
+                return None
+            self.items[key] = item
+            return value
+
+    def put(self, key, value):
+        ttl = self.ttl_for(key)
+        if not ttl:
+            return
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, time.time() + ttl)
+            while len(self.items) > self.maxitems:
+                self.items.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def values(self):
+        "The unexpired values, least recently used first"
+        now = time.time()
+        with self.lock:
+            return [value for value, expires in self.items.itervalues()
+                    if expires >= now]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        return "%s: %d remembered" % (self.name, len(self.items))
+# ExpiringCache
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""HTTP requests and responses recorded to a file, to be played back
+
+A Browser recording to a cassette saves each request it makes (method,
+URL, headers including cookies, and any POST data) with its response
+(status, headers and body).  Replaying, it answers each request with
+the next response recorded for the same method, URL and data, without
+the network, so a processor can be run again exactly as it was, as
+often as needed.  Once the responses for a request run out, the last
+one is given again.
+
+Cassettes are saved as JSON, with whatever the resolution being
+recorded is described by in 'meta'.  To replay the resolutions recorded
+by 'record', checking they come out the same:
+
+    python cassette.py [-n <runs>] [-p] <file>...
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import httplib
+import urllib2
+import threading
+from urllib import addinfourl
+from cStringIO import StringIO
+
+class CassetteMiss(urllib2.URLError):
+    "Raised when replaying a request the cassette has no response for"
+
+def request_key(method, url, data):
+    return (method, url, data or None)
+
+class Cassette(object):
+    """The requests and responses of a recording, in order"""
+    def __init__(self, interactions=None, meta=None):
+        self.interactions = interactions or []
+        self.meta = meta or {}
+        self.lock = threading.Lock()
+        self.rewind()
+
+    @classmethod
+    def load(cls, fname):
+        fd = open(fname)
+        try:
+            d = json.load(fd)
+        finally:
+            fd.close()
+        return cls(d.get('interactions'), d.get('meta'))
+
+    def save(self, fname):
+        "Write the cassette to fname, replacing it atomically"
+        tmpname = "%s.%d" % (fname, os.getpid())
+        fd = open(tmpname, "w")
+        try:
+            json.dump({ 'version' : 1, 'meta' : self.meta,
+                        'interactions' : self.interactions },
+                      fd, indent=1, sort_keys=True)
+        finally:
+            fd.close()
+        os.rename(tmpname, fname)
+
+    def rewind(self):
+        "Start playing back from the first response for each request"
+        with self.lock:
+            self.queues = {} # request key -> indexes of its interactions
+            for i, d in enumerate(self.interactions):
+                key = request_key(d['method'], d['url'], d.get('data'))
+                self.queues.setdefault(key, []).append(i)
+            self.played = dict((key, 0) for key in self.queues)
+
+    def record(self, req, res):
+        """Save a request and its response (or HTTPError), returning a
+        response (or HTTPError) to use in its place"""
+        body = res.read()
+        res.close()
+        d = { 'method' : req.get_method(), 'url' : req.get_full_url(),
+              'request_headers' : dict(req.header_items()),
+              'status' : res.code, 'reason' : res.msg,
+              'final_url' : res.geturl(),
+              'headers' : ''.join(res.info().headers).decode('latin-1') }
+        if req.get_data():
+            d['data'] = req.get_data()
+        try:
+            d['body'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            d['body_base64'] = base64.b64encode(body)
+        with self.lock:
+            self.interactions.append(d)
+            key = request_key(d['method'], d['url'], d.get('data'))
+            self.queues.setdefault(key, []).append(len(self.interactions) - 1)
+            self.played.setdefault(key, 0)
+        return response(d)
+
+    def play(self, req):
+        """Return the next response recorded for a request, raising it if
+        it's an HTTPError, or CassetteMiss if there isn't one"""
+        key = request_key(req.get_method(), req.get_full_url(), req.get_data())
+        with self.lock:
+            queue = self.queues.get(key)
+            if not queue:
+                raise CassetteMiss("not recorded: %s %s" % key[:2])
+            n = self.played[key]
+            self.played[key] = n + 1
+            d = self.interactions[queue[min(n, len(queue) - 1)]]
+        res = response(d)
+        if isinstance(res, urllib2.HTTPError):
+            raise res
+        return res
+# Cassette
+
+def response(d):
+    "Make a response (or an HTTPError for an error status) from a recording"
+    if 'body_base64' in d:
+        body = base64.b64decode(d['body_base64'])
+    else:
+        body = d['body'].encode('utf-8')
+    headers = httplib.HTTPMessage(StringIO(d['headers'].encode('latin-1')))
+    if d['status'] >= 400:
+        return urllib2.HTTPError(d['final_url'], d['status'], d['reason'],
+                                 headers, StringIO(body))
+    res = addinfourl(StringIO(body), headers, d['final_url'], d['status'])
+    res.msg = d['reason']
+    return res
+
+def main(args):
+    """Replay the resolutions recorded in cassette files, checking they
+    come out the same, and time them.  Returns 1 if any don't."""
+    import optparse
+    import scraper
+    parser = optparse.OptionParser(usage="%prog [-n <runs>] [-p] <cassette>...")
+    parser.add_option("-n", "--runs", type="int", default=1,
+        help="replay each cassette this many times")
+    parser.add_option("-p", "--profile", action="store_true",
+        help="profile the replays with cProfile")
+    options, args = parser.parse_args(args[1:])
+    if not args:
+        parser.error("no cassettes given")
+    prof = None
+    if options.profile:
+        import cProfile
+        prof = cProfile.Profile()
+    status = 0
+    for fname in args:
+        try:
+            c = Cassette.load(fname)
+        except (IOError, ValueError), e:
+            print "%s: %s" % (fname, e)
+            status = 1
+            continue
+        browser = scraper.Browser()
+        start = time.time()
+        for i in xrange(max(options.runs, 1)):
+            # only the first replay says what it's doing
+            scraper.log_to(i == 0 and scraper.log or None)
+            if prof is not None:
+                res = prof.runcall(scraper.replay, c, browser)
+            else:
+                res = scraper.replay(c, browser)
+        elapsed = time.time() - start
+        scraper.log_to(scraper.log)
+        got = res and { 'url' : res.url, 'headers' : res.headers }
+        same = got == c.meta.get('resolution')
+        if not same:
+            status = 1
+        print "%s: %s, %.2fms per resolution%s" % (fname,
+            same and "same" or "DIFFERENT", elapsed * 1000 / max(options.runs, 1),
+            not same and " (%r, recorded %r)" % (got, c.meta.get('resolution')) or "")
+    if prof is not None:
+        import pstats
+        pstats.Stats(prof).sort_stats('cumulative').print_stats(25)
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
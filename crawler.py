@@ -0,0 +1,315 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Crawling a tree of playlists into an index file
+
+    python crawler.py [-d depth] [-w workers] [-o index] [-s] <playlist url>
+
+The crawl follows type=playlist items breadth first on a pool of worker
+threads, fetching each playlist URL once and waiting at least HOST_DELAY
+seconds between requests to the same host.  Items are written to the
+index as they're parsed, so memory use depends on the number of
+playlists rather than the number of items.  Playlists are read through
+the playlist cache but not added to it, so a crawl doesn't fill the
+disk either.
+
+The index is a tab-separated text file (gzipped if its name ends in
+.gz), with tabs, newlines and backslashes escaped in the fields:
+
+    # navix crawl <root url> <time>
+    P <id> <parent id> <depth> <url> <name>
+    I <playlist id> <type> <name> <url> <processor> <infotag> <description>
+
+Each crawled playlist has a P record, which comes before its items.  The
+root playlist has parent id 0.  read_index() yields each item along with
+the names of the playlists above it.
+
+Given an indexer (such as search.index), each playlist's items are also
+added to it with indexer.begin(url) and indexer.add(url, item).
+
+Playlists are parsed by the parse function the crawl is given, by
+default navix.parse_navix_pls.  The shell passes its own, as navix.py
+is usually running as __main__ and importing it would load a second
+copy, with caches and settings of its own.
+"""
+
+import os
+import re
+import sys
+import gzip
+import time
+import hashlib
+import threading
+from urlparse import urlparse
+from collections import deque
+
+import downloader
+
+WORKERS = 8        # playlists fetched at once
+HOST_DELAY = 0.2   # seconds between requests to the same host
+DEPTH = 10         # levels of playlists followed below the root
+INDEX = "navix-crawl.idx.gz" # default index file
+
+ITEM_FIELDS = ('type', 'name', 'URL', 'processor', 'infotag', 'description')
+
+_escapes = {'\\' : '\\\\', '\t' : '\\t', '\n' : '\\n', '\r' : ''}
+_escaped = re.compile(r'[\\\t\n\r]')
+_unescapes = {'\\\\' : '\\', '\\t' : '\t', '\\n' : '\n'}
+_unescaped = re.compile(r'\\[\\tn]')
+
+def escape(s):
+    return _escaped.sub(lambda m: _escapes[m.group(0)], s)
+
+def unescape(s):
+    return _unescaped.sub(lambda m: _unescapes[m.group(0)], s)
+
+def open_index(fname, mode="r"):
+    if fname.endswith(".gz"):
+        return gzip.open(fname, mode + "b")
+    return open(fname, mode)
+
+def read_index(fname):
+    """Yield (path, item) for each item in an index, where path is a
+    tuple of the names of the playlists above it and item a dict of the
+    ITEM_FIELDS that it has"""
+    paths = {0 : ()}
+    fd = open_index(fname)
+    try:
+        for line in fd:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == 'P' and len(fields) == 6:
+                parent = paths.get(int(fields[2]), ())
+                paths[int(fields[1])] = parent + (unescape(fields[5]),)
+            elif fields[0] == 'I' and len(fields) == 2 + len(ITEM_FIELDS):
+                item = dict((k, unescape(v)) for k, v in
+                            zip(ITEM_FIELDS, fields[2:]) if v)
+                yield paths.get(int(fields[1]), ()), item
+    finally:
+        fd.close()
+
+class HostLimiter(object):
+    """Spaces out requests to each host by at least delay seconds
+    (HOST_DELAY by default)"""
+    def __init__(self, delay=None):
+        if delay is None:
+            delay = HOST_DELAY
+        self.delay = delay
+        self.next = {} # host -> time of its next request
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlparse(url)[1]
+        if not host:
+            return # a local file
+        with self.lock:
+            now = time.time()
+            when = max(now, self.next.get(host, 0))
+            self.next[host] = when + self.delay
+        if when > now:
+            time.sleep(when - now)
+# HostLimiter
+
+class Crawler(object):
+    """Crawls the playlists under a root URL into an index file.  depth
+    and workers default to DEPTH and WORKERS."""
+    def __init__(self, root, out, depth=None, workers=None,
+                 host_delay=None, name=None, indexer=None, parse=None):
+        if depth is None:
+            depth = DEPTH
+        if workers is None:
+            workers = WORKERS
+        if parse is None:
+            import navix
+            parse = navix.parse_navix_pls
+        self.root = root
+        self.out = out
+        self.indexer = indexer
+        self.parse = parse
+        self.depth = depth
+        self.workers = workers
+        self.limiter = HostLimiter(host_delay)
+        # (url, depth, parent id, name) of the playlists still to fetch
+        self.frontier = deque([(root, 0, 0, name or root)])
+        # playlists are fetched once, wherever they appear in the tree;
+        # digests take less room than the URLs themselves
+        self.seen = set([self.digest(root)])
+        self.active = 0
+        self.ids = 0
+        self.playlists = self.items = self.failed = 0
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+
+    @staticmethod
+    def digest(url):
+        return hashlib.sha1(url).digest()
+
+    def line(self):
+        "A progress line for downloader.ProgressTicker"
+        return "%d playlists, %d items, %d queued, %d failed" % (
+            self.playlists, self.items, len(self.frontier), self.failed)
+
+    def log(self, msg):
+        sys.stdout.write("\r\033[K%s\n" % msg)
+
+    def write(self, fields):
+        line = '\t'.join(fields) + '\n'
+        with self.write_lock:
+            self.out.write(line)
+            if fields[0] == 'I':
+                self.items += 1
+
+    def next_playlist(self):
+        "Take a playlist off the frontier, or return None when the crawl's done"
+        with self.cond:
+            while not self.frontier and self.active and not self.stopped:
+                self.cond.wait(1)
+            if self.stopped or not self.frontier:
+                self.cond.notify_all()
+                return None
+            self.active += 1
+            return self.frontier.popleft()
+
+    def crawl_playlist(self, url, depth, parent, name):
+        "Fetch one playlist, writing its items and queueing its playlists"
+        with self.cond:
+            self.ids += 1
+            pid = self.ids
+        self.limiter.wait(url)
+        self.write(('P', str(pid), str(parent), str(depth), escape(url),
+                    escape(name)))
+        indexer = self.indexer
+        if indexer is not None:
+            indexer.begin(url)
+        # read through the playlist cache, but don't fill it
+        for d in self.parse(url, store=False):
+            self.write(['I', str(pid)] + [escape(d.get(k, ''))
+                                          for k in ITEM_FIELDS])
+            if indexer is not None:
+                indexer.add(url, d)
+            if d['type'] == 'playlist' and d.get('URL') and depth < self.depth:
+                key = self.digest(d['URL'])
+                with self.cond:
+                    if key not in self.seen:
+                        self.seen.add(key)
+                        self.frontier.append((d['URL'], depth + 1, pid,
+                                              d.get('name', d['URL'])))
+                        self.cond.notify()
+        with self.cond:
+            self.playlists += 1
+
+    def work(self):
+        while True:
+            job = self.next_playlist()
+            if job is None:
+                return
+            try:
+                self.crawl_playlist(*job)
+            except Exception, e:
+                with self.cond:
+                    self.failed += 1
+                self.log("!! %s: %s" % (job[0], e))
+            finally:
+                with self.cond:
+                    self.active -= 1
+                    self.cond.notify_all()
+
+    def run(self, show=True):
+        """Crawl until the frontier is empty.  Control-C stops the crawl,
+        leaving what's been written so far in the index."""
+        self.out.write("# navix crawl %s %s\n" % (self.root,
+            time.strftime("%Y-%m-%dT%H:%M:%S")))
+        threads = []
+        for i in xrange(self.workers):
+            t = threading.Thread(target=self.work, name="Crawler")
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        ticker = None
+        if show:
+            ticker = downloader.ProgressTicker(self)
+            ticker.start()
+        try:
+            for t in threads:
+                while t.isAlive():
+                    t.join(0.5)
+        except KeyboardInterrupt:
+            with self.cond:
+                self.stopped = True
+                self.cond.notify_all()
+            self.log("Stopping...")
+            for t in threads:
+                t.join()
+        finally:
+            if ticker is not None:
+                ticker.stop()
+        return not self.stopped
+# Crawler
+
+def crawl(root, fname=None, depth=None, workers=None, host_delay=None,
+          name=None, show=True, indexer=None, parse=None):
+    """Crawl the tree under root into the index file fname (INDEX by
+    default), returning the Crawler"""
+    if fname is None:
+        fname = INDEX
+    out = open_index(fname, "w")
+    try:
+        crawler = Crawler(root, out, depth, workers, host_delay, name,
+                          indexer, parse)
+        crawler.run(show)
+    finally:
+        out.close()
+    return crawler
+
+def main(args):
+    import optparse
+    parser = optparse.OptionParser(
+        usage="%prog [options] <playlist url or file>")
+    parser.add_option("-d", "--depth", type="int", default=DEPTH,
+        help="levels of playlists to follow (default %default)")
+    parser.add_option("-w", "--workers", type="int", default=WORKERS,
+        help="playlists to fetch at once (default %default)")
+    parser.add_option("-r", "--host-delay", type="float", default=HOST_DELAY,
+        help="seconds between requests to a host (default %default)")
+    parser.add_option("-o", "--output", default=INDEX,
+        help="index file to write (default %default)")
+    parser.add_option("-s", "--search", action="store_true",
+        help="add the items to the shell's search index too")
+    parser.add_option("-q", "--quiet", action="store_true",
+        help="don't show progress")
+    options, args = parser.parse_args(args[1:])
+    if len(args) != 1:
+        parser.error("expected one playlist")
+    root = args[0]
+    if "://" not in root:
+        root = "file://" + os.path.abspath(root)
+    indexer = None
+    if options.search:
+        import search
+        indexer = search.index
+    crawler = crawl(root, options.output, options.depth, options.workers,
+                    options.host_delay, show=not options.quiet, indexer=indexer)
+    if indexer is not None:
+        indexer.save()
+    print "%d playlists, %d items written to %s (%d failed)" % (
+        crawler.playlists, crawler.items, options.output, crawler.failed)
+    return crawler.failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
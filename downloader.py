@@ -0,0 +1,1045 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Downloading: the transfer loop, progress display and a queue that runs
+several downloads at once
+
+A Job wraps a function that resolves and downloads one file.  Jobs
+submitted to a DownloadQueue run on a pool of worker threads, at most
+per_host at a time for any one host, and are retried with exponential
+backoff when they fail with a transient (network or 5xx) error.
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import hashlib
+import time
+import socket
+import httplib
+import urllib2
+import itertools
+import collections
+import mimetypes
+import threading
+import traceback
+from urlparse import urlparse
+
+import tracing
+import manifest
+
+WORKERS = 4       # downloads running at once
+PER_HOST = 2      # downloads running at once from any one host
+RETRIES = 3       # times a job is retried after a transient error
+BACKOFF = 5       # seconds before the first retry, doubling each time
+SEGMENTS = 4      # connections used by a segmented download ('get -s')
+MIN_SEGMENT = 1 << 20 # don't split files into segments smaller than this
+BLOCKSIZE = 65536 # first (and smallest) block read by a transfer
+MAX_BLOCKSIZE = 4 << 20 # largest block read by a transfer
+BLOCK_TIME = 0.1  # seconds a block should take to read; the size adapts to it
+RATE_WINDOW = 5   # seconds over which the download rate is averaged
+JOURNAL_SUFFIX = ".navix-resume" # sidecar file recording a download's progress
+JOURNAL_INTERVAL = 2 # seconds between saves of a download's journal
+
+class Cancelled(Exception):
+    "Raised in a transfer when its job has been cancelled"
+
+class DownloadError(Exception):
+    "Raised when a download can't go ahead"
+
+def ratestring(kbps):
+    "Return the download rate in a human-friendly format."
+    if kbps > 1024:
+        return "%0.2f MB/s" % (kbps/1024)
+    return "%d KB/s" % (kbps)
+
+def guess_extension(response):
+    "Return an extension based on the Content-Type header in the response"
+    if not response:
+        return None
+    ct = response.info().get('content-type')
+    if ct:
+        mimetype = ct.split(';')[0]
+        ext = mimetypes.guess_extension(mimetype)
+        if ext:
+            return ext
+        # otherwise try based on URL
+        mimetype, _ = mimetypes.guess_type(response.geturl())
+        if mimetype:
+            ext = mimetypes.guess_extension(mimetype)
+        return ext
+
+def is_transient(e):
+    "True if the exception is worth retrying the download for"
+    if isinstance(e, urllib2.HTTPError):
+        return e.code >= 500 or e.code == 429
+    return isinstance(e, (urllib2.URLError, socket.error, httplib.HTTPException))
+
+class Progress(object):
+    """The progress of one transfer"""
+    def __init__(self, name, board=None):
+        self.name = name
+        self.board = board
+        self.count = self.base = 0
+        self.total = None
+        self.started = time.time()
+        self.samples = collections.deque() # (time, count) for the rolling rate
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def start(self, total=None, done=0):
+        "Start timing a transfer of total bytes, of which done are already here"
+        self.count = self.base = done
+        self.total = total
+        self.started = time.time()
+        self.samples.clear()
+
+    def update(self, nbytes):
+        if self.cancelled:
+            raise Cancelled(self.name)
+        with self.lock:
+            self.count += nbytes
+
+    def kbps(self):
+        "The rate over the last RATE_WINDOW seconds, in KB/s"
+        now = time.time()
+        with self.lock:
+            count = self.count
+            samples = self.samples
+            if not samples or now - samples[-1][0] >= 0.25:
+                samples.append((now, count))
+            while len(samples) > 1 and now - samples[1][0] >= RATE_WINDOW:
+                samples.popleft()
+            since, then = samples[0]
+        if now - since < 1:
+            # too early for a rolling rate
+            since, then = self.started, self.base
+        return (count - then) / ((now - since) or 1) / 1024.0
+
+    def line(self):
+        strlength = self.total and ("%dk" % (self.total/1024)) or "Unknown"
+        return "[%dk / %s] (~%s)" % (self.count//1024, strlength,
+            ratestring(self.kbps()))
+
+    def log(self, msg):
+        if self.board is not None:
+            self.board.log(msg)
+        else:
+            print msg
+# Progress
+
+class ProgressBoard(object):
+    """Draws one line per running transfer, plus a total, redrawing them
+    in place with VT100 codes every interval seconds.  Messages printed
+    with log() appear above the board, or are held until take_held() if
+    the board isn't being shown (eg. while the user is at a prompt)."""
+    def __init__(self, out=sys.stdout, interval=0.5):
+        self.out = out
+        self.interval = interval
+        self.transfers = []
+        self.drawn = 0 # lines currently on screen
+        self.held = [] # messages logged while the board isn't shown
+        self.only = None # if set, the transfers to show
+        self.lock = threading.RLock()
+        self.thread = None
+        self.running = False
+
+    def add(self, progress):
+        with self.lock:
+            progress.board = self
+            self.transfers.append(progress)
+
+    def remove(self, progress):
+        with self.lock:
+            if progress in self.transfers:
+                self.transfers.remove(progress)
+
+    def clear(self):
+        if self.drawn:
+            self.out.write("\033[%dA\r\033[J" % self.drawn)
+            self.drawn = 0
+
+    def draw(self):
+        with self.lock:
+            self.clear()
+            transfers = self.transfers
+            if self.only is not None:
+                transfers = [p for p in transfers if p in self.only]
+            if not transfers:
+                self.out.flush()
+                return
+            total = 0.0
+            for p in transfers:
+                self.out.write("\033[K%s %s\n" % (p.line(), p.name[:40]))
+                total += p.kbps()
+            self.out.write("\033[K%d downloading, ~%s total\n" % (
+                len(transfers), ratestring(total)))
+            self.drawn = len(transfers) + 1
+            self.out.flush()
+
+    def log(self, msg):
+        with self.lock:
+            if not self.running:
+                self.held.append(msg)
+                return
+            self.clear()
+            print >>self.out, msg
+            self.draw()
+
+    def take_held(self):
+        "Return the messages logged while the board wasn't shown"
+        with self.lock:
+            held, self.held = self.held, []
+            return held
+
+    def run(self):
+        me = threading.current_thread()
+        while self.running and self.thread is me:
+            self.draw()
+            time.sleep(self.interval)
+
+    def start(self, only=None):
+        "Start showing the board, or just the transfers in only"
+        with self.lock:
+            self.only = only
+            if self.running:
+                return
+            self.running = True
+            for msg in self.take_held():
+                print >>self.out, msg
+            self.thread = threading.Thread(target=self.run, name="ProgressBoard")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.draw()
+            self.only = None
+# ProgressBoard
+
+class ProgressTicker(object):
+    """Redraws the progress line of a transfer that isn't on a
+    ProgressBoard every interval seconds, so the transfer itself never
+    writes to the terminal"""
+    def __init__(self, progress, out=sys.stdout, interval=0.5):
+        self.progress = progress
+        self.out = out
+        self.interval = interval
+        self.done = threading.Event()
+        self.thread = None
+
+    def draw(self):
+        self.out.write("\r\033[K" + self.progress.line())
+        self.out.flush()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.draw()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="ProgressTicker")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.draw()
+            print >>self.out, ""
+# ProgressTicker
+
+def readinto_of(res):
+    "Return the readinto() method of a response (or the file it wraps), or None"
+    return getattr(res, 'readinto', None) \
+        or getattr(getattr(res, 'fp', None), 'readinto', None)
+
+class BlockReader(object):
+    """Reads a response in blocks, into one buffer that's reused for each
+    block when the response has a readinto() (as responses on pooled
+    connections do).  The block size starts at BLOCKSIZE and doubles, up
+    to MAX_BLOCKSIZE, while blocks take less than BLOCK_TIME to read, so
+    a fast transfer makes few large reads and a slow one still shows
+    its progress."""
+    def __init__(self, res):
+        self.res = res
+        self.readinto = readinto_of(res)
+        self.blocksize = BLOCKSIZE
+        self.view = None
+
+    def read(self, limit=None):
+        """Return the next block of at most limit bytes, which is only
+        valid until the next read.  An empty block is the end."""
+        size = self.blocksize
+        if limit is not None and limit < size:
+            size = limit
+        started = time.time()
+        if self.readinto is None:
+            block = self.res.read(size)
+        else:
+            if self.view is None or len(self.view) < size:
+                self.view = memoryview(bytearray(size))
+            n = 0
+            while n < size:
+                got = self.readinto(self.view[n:size])
+                if not got:
+                    break
+                n += got
+            block = self.view[:n]
+        if len(block) == size:
+            elapsed = time.time() - started
+            if elapsed < BLOCK_TIME / 2 and self.blocksize < MAX_BLOCKSIZE:
+                self.blocksize *= 2
+            elif elapsed > BLOCK_TIME * 2 and self.blocksize > BLOCKSIZE:
+                self.blocksize //= 2
+        return block
+# BlockReader
+
+def unique_name(fname):
+    "If fname exists, return the first of fname.1, fname.2, ... that doesn't"
+    i = 1
+    base = fname
+    while os.path.exists(fname):
+        fname = "%s.%d" % (base, i)
+        i = i + 1
+    return fname
+
+def response_range(res):
+    """Return (offset, total length) for a response, where the total is
+    None if the server didn't say.  A 206 without a usable Content-Range
+    raises DownloadError, as we wouldn't know where its bytes go."""
+    info = res.info()
+    if res.getcode() == 206:
+        m = re.match(r'bytes\s+(\d+)-\d+/(\d+|\*)', info.get('Content-Range', ''))
+        if m is None:
+            raise DownloadError("partial response without a Content-Range")
+        total = m.group(2)
+        return int(m.group(1)), total != '*' and int(total) or None
+    length = info.get('Content-Length')
+    return 0, length and length.isdigit() and int(length) or None
+
+class Journal(object):
+    """Sidecar file (the download's name + JOURNAL_SUFFIX) recording which
+    byte ranges of a download are complete, along with the URL it came
+    from and the validators (length, ETag, Last-Modified) needed to tell
+    whether the remote file has changed since.  It's removed once the
+    download is complete.
+
+    A download for an item (with a source, the item's URL) is added to
+    the manifest of its directory when it completes, with the SHA-1 of
+    its contents if they were all written in order from the start, as
+    they're hashed while they're written.  Resumed and segmented
+    downloads have none, rather than reading the file again."""
+    def __init__(self, target, url=None, length=None, etag=None,
+                 last_modified=None, done=(), source=None):
+        self.target = target
+        self.path = target + JOURNAL_SUFFIX
+        self.url = url
+        self.length = length
+        self.etag = etag
+        self.last_modified = last_modified
+        self.done = [list(r) for r in done] # sorted [start, end) ranges
+        self.source = source
+        self.digest = None # the SHA-1 of the first hashed bytes
+        self.hashed = 0
+        if source is not None and not self.done:
+            self.digest = hashlib.sha1()
+        self.saved = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_response(cls, target, res, source=None):
+        "Return a new journal for downloading res to target"
+        info = res.info()
+        return cls(target, res.geturl(), response_range(res)[1],
+            info.get('ETag'), info.get('Last-Modified'), source=source)
+
+    @classmethod
+    def load(cls, target):
+        "Return the journal for target, or None if there isn't one"
+        try:
+            fd = open(target + JOURNAL_SUFFIX)
+            try:
+                state = json.load(fd)
+            finally:
+                fd.close()
+        except (IOError, ValueError):
+            return None
+        return cls(target, state.get('url'), state.get('length'),
+            state.get('etag'), state.get('last_modified'), state.get('done', ()),
+            state.get('source'))
+
+    @classmethod
+    def find(cls, fname):
+        """Return the journal for fname, where a name ending in .EXT
+        matches a journal for that name with any extension"""
+        if not fname.endswith(".EXT"):
+            return cls.load(fname)
+        pattern = re.sub(r'([*?\[])', r'[\1]', fname[:-4]) + ".*" + JOURNAL_SUFFIX
+        for path in sorted(glob.glob(pattern)):
+            journal = cls.load(path[:-len(JOURNAL_SUFFIX)])
+            if journal is not None:
+                return journal
+        return None
+
+    def matches(self, res):
+        "True if res is for the same version of the file as this journal"
+        info = res.info()
+        if self.length is not None and response_range(res)[1] != self.length:
+            return False
+        if self.etag and info.get('ETag'):
+            return self.etag == info.get('ETag')
+        if self.last_modified and info.get('Last-Modified'):
+            return self.last_modified == info.get('Last-Modified')
+        return self.length is not None
+
+    def reset(self, res):
+        "Start again, for a new version of the file"
+        fresh = Journal.for_response(self.target, res)
+        with self.lock:
+            self.url, self.length = fresh.url, fresh.length
+            self.etag, self.last_modified = fresh.etag, fresh.last_modified
+            self.done = []
+            self.digest = self.source is not None and hashlib.sha1() or None
+            self.hashed = 0
+
+    def add(self, start, end, block=None):
+        """Record that bytes start to end (exclusive) have been written,
+        hashing them if they're the block written"""
+        with self.lock:
+            if self.digest is not None:
+                if block is not None and start == self.hashed:
+                    self.digest.update(block)
+                    self.hashed = end
+                else:
+                    self.digest = None # out of order, so there'll be no SHA-1
+            done = self.done
+            i = 0
+            while i < len(done) and done[i][1] < start:
+                i += 1
+            j = i
+            while j < len(done) and done[j][0] <= end:
+                start = min(start, done[j][0])
+                end = max(end, done[j][1])
+                j += 1
+            done[i:j] = [[start, end]]
+        if time.time() - self.saved > JOURNAL_INTERVAL:
+            self.save()
+
+    def count(self):
+        "The number of bytes downloaded"
+        return sum(end - start for start, end in self.done)
+
+    def missing(self):
+        "Return the [start, end) ranges still to be downloaded"
+        gaps = []
+        pos = 0
+        for start, end in self.done:
+            if start > pos:
+                gaps.append([pos, start])
+            pos = end
+        if self.length is None:
+            gaps.append([pos, None])
+        elif pos < self.length:
+            gaps.append([pos, self.length])
+        return gaps
+
+    def complete(self):
+        return self.length is not None and not self.missing()
+
+    def sha1(self):
+        "The SHA-1 of the file, if all of it was hashed, or None"
+        if self.digest is None or self.hashed != self.length:
+            return None
+        return self.digest.hexdigest()
+
+    def finish(self, progress=None):
+        """Remove the journal of a complete download, and add the file to
+        its directory's manifest if it's for an item.  If it's the same
+        as a file already there, it's replaced with a hard link to it."""
+        self.remove()
+        if self.source is None:
+            return
+        m = manifest.for_file(self.target)
+        sha1 = self.sha1()
+        if sha1 is not None:
+            same = m.for_sha1(sha1, self.length, self.target)
+            if same is not None and manifest.link(m.filename(same), self.target):
+                progress and progress.log("%s is the same as %s, linked to it" % (
+                    self.target, same['name']))
+        m.add(self.target, self.source, self.url, self.length, self.etag,
+              self.last_modified, sha1)
+
+    def save(self):
+        with self.lock:
+            state = { 'url' : self.url, 'length' : self.length,
+                      'etag' : self.etag, 'last_modified' : self.last_modified,
+                      'done' : self.done, 'source' : self.source }
+            self.saved = time.time()
+            tmpname = self.path + ".tmp"
+            try:
+                fd = open(tmpname, "w")
+                try:
+                    json.dump(state, fd)
+                finally:
+                    fd.close()
+                os.rename(tmpname, self.path)
+            except (IOError, OSError):
+                pass
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+# Journal
+
+def download(res, filename, progress=None, journal=None, source=None):
+    """Download the HTTP response object to the given filename,
+    updating progress, and using VT100 codes to interactively show the
+    progress unless it's drawn on a ProgressBoard.
+
+    Bytes are written at the offset given by the response, and recorded
+    in the journal, so an interrupted download can be resumed.  Without
+    a journal, a 200 response is written to a new file (filename.1, ...
+    if filename exists) with a new journal, for the item at source if
+    it's given.  Returns the name written to."""
+    if progress is None:
+        progress = Progress(filename)
+    pos, total = response_range(res)
+    fname = filename
+    if journal is None:
+        if pos == 0:
+            fname = unique_name(filename)
+        journal = Journal.for_response(fname, res, source)
+        if pos:
+            journal.add(0, pos) # what's already in the file
+    elif pos == 0 and res.getcode() == 200:
+        journal.reset(res) # the server ignored the range: start again
+    length = res.info().get('Content-Length')
+    end = length and length.isdigit() and pos + int(length) or None
+    progress.start(total, journal.count())
+    span = tracing.span('download', fname, url=res.geturl(), offset=pos)
+    first = pos
+    reader = BlockReader(res)
+    ticker = None
+    out = None
+    try:
+        block = reader.read()
+        while block:
+            if out is None:
+                out = open_at(fname, pos, truncate=pos == 0)
+                progress.log("Downloading to %s" % fname)
+                if progress.board is None:
+                    ticker = ProgressTicker(progress)
+                    ticker.start()
+            n = len(block)
+            out.write(block)
+            journal.add(pos, pos + n, block)
+            pos += n
+            progress.update(n)
+            block = reader.read()
+        if end is not None and pos < end:
+            raise httplib.IncompleteRead('', end - pos)
+        if journal.length is None:
+            journal.length = pos # the server didn't say; assume we got it all
+    except Exception, e:
+        span.set(error=tracing.describe(e))
+        raise
+    finally:
+        if out is not None:
+            out.close()
+        if ticker is not None:
+            ticker.stop()
+        if journal.complete():
+            journal.finish(progress)
+        else:
+            journal.save()
+        span.finish(bytes=pos - first)
+    return fname
+# download
+
+def open_at(fname, pos, truncate=False):
+    "Open fname (unbuffered) for writing at pos, creating it if necessary"
+    if truncate or not os.path.exists(fname):
+        out = open(fname, "wb", 0)
+    else:
+        out = open(fname, "r+b", 0)
+    out.seek(pos)
+    return out
+
+def supports_ranges(res):
+    "Return the length of the response if the server accepts byte ranges"
+    info = res.info()
+    length = info.get('Content-Length')
+    if res.getcode() != 200 or not length or not length.isdigit():
+        return None
+    if info.get('Accept-Ranges', '').strip().lower() != 'bytes':
+        return None
+    return int(length)
+
+def plan_segments(ranges, segments):
+    """Split the [start, end) ranges into at least segments pieces (where
+    they're long enough), by halving the longest piece"""
+    pieces = [list(r) for r in ranges]
+    while len(pieces) < segments:
+        longest = max(pieces, key=lambda r: r[1] - r[0])
+        size = longest[1] - longest[0]
+        if size < 2 * MIN_SEGMENT:
+            break
+        middle = longest[0] + size // 2
+        pieces.append([middle, longest[1]])
+        longest[1] = middle
+    pieces.sort()
+    return pieces
+
+class Segment(object):
+    """A byte range [start, end) of a segmented download, fetched on its
+    own thread"""
+    def __init__(self, start, end, res=None):
+        self.start = start
+        self.end = end
+        self.pos = start
+        self.res = res
+        self.error = None
+
+    def fetch(self, opener, fname, progress, journal, abort, retries=RETRIES):
+        """Download the rest of the range into fname, reopening if needed,
+        until it's done or abort is set"""
+        res = self.res
+        reader = res and BlockReader(res)
+        attempts = 0
+        out = open_at(fname, self.pos)
+        try:
+            while self.pos < self.end:
+                if abort.is_set():
+                    raise Cancelled(progress.name)
+                try:
+                    if res is None:
+                        res = opener("bytes=%d-%d" % (self.pos, self.end - 1))
+                        if res.getcode() != 206 or response_range(res)[0] != self.pos \
+                                or not journal.matches(res):
+                            raise DownloadError("bad response to range request: %s %s" % (
+                                res.getcode(), res.info().get('Content-Range')))
+                        reader = BlockReader(res)
+                    block = reader.read(self.end - self.pos)
+                    if not block:
+                        raise httplib.IncompleteRead('')
+                except Exception, e:
+                    if res is not None:
+                        res.close()
+                        res = None
+                    attempts += 1
+                    if isinstance(e, Cancelled) or not is_transient(e) or attempts > retries:
+                        raise
+                    time.sleep(min(BACKOFF * attempts, 30))
+                    continue
+                n = len(block)
+                out.write(block)
+                journal.add(self.pos, self.pos + n)
+                self.pos += n
+                progress.update(n)
+        finally:
+            out.close()
+            if res is not None:
+                res.close()
+
+    def run(self, opener, fname, progress, journal, abort):
+        try:
+            self.fetch(opener, fname, progress, journal, abort)
+        except Exception, e:
+            self.error = e
+            abort.set() # stop the other segments
+# Segment
+
+def segmented_download(res, opener, filename, progress=None, segments=SEGMENTS,
+                       journal=None, source=None):
+    """Download a file over several connections at once
+
+    res is a response for the file, and opener is a function that returns
+    a new response for a byte range (eg. "bytes=0-1023"), resolving the
+    URL again if it's session-bound.  Without a journal this is a new
+    download of a 200 response (for the item at source), falling back to download() if the server
+    doesn't accept ranges or the file is too small to split.  With one,
+    the ranges it's missing are fetched into its target.  Returns the name
+    written to."""
+    if journal is None:
+        length = supports_ranges(res)
+        if min(segments, (length or 0) // MIN_SEGMENT) < 2:
+            return download(res, filename, progress, source=source)
+        fname = unique_name(filename)
+        journal = Journal.for_response(fname, res, source)
+    else:
+        fname = journal.target
+        if journal.length is None:
+            # there's no splitting a file of unknown size
+            return download(res, fname, progress, journal)
+    if progress is None:
+        progress = Progress(fname)
+    progress.start(journal.length, journal.count())
+    out = open_at(fname, 0)
+    if os.path.getsize(fname) < journal.length:
+        out.truncate(journal.length)
+    out.close()
+    pieces = plan_segments(journal.missing(), segments)
+    progress.log("Downloading to %s in %d segments" % (fname, len(pieces)))
+    span = tracing.span('download', fname, url=res.geturl(),
+                        segments=len(pieces))
+    done = progress.count
+    offset = response_range(res)[0]
+    parts = []
+    for start, end in pieces:
+        # the segment at the response's offset carries on with it
+        parts.append(Segment(start, end, start == offset and res or None))
+    if offset not in [start for start, end in pieces]:
+        res.close()
+    abort = threading.Event()
+    threads = []
+    for seg in parts:
+        t = threading.Thread(target=seg.run,
+            args=(opener, fname, progress, journal, abort),
+            name="Segment %d-%d" % (seg.start, seg.end))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    ticker = None
+    if progress.board is None:
+        ticker = ProgressTicker(progress)
+        ticker.start()
+    try:
+        for t in threads:
+            while t.isAlive():
+                t.join(0.5)
+    except KeyboardInterrupt:
+        abort.set()
+        for t in threads:
+            t.join()
+        raise
+    finally:
+        if ticker is not None:
+            ticker.stop()
+        if journal.complete():
+            journal.finish(progress)
+        else:
+            journal.save()
+        for seg in parts:
+            if seg.error is not None:
+                span.set(error=tracing.describe(seg.error))
+                break
+        span.finish(bytes=progress.count - done)
+    for seg in parts:
+        if seg.error is not None and not isinstance(seg.error, Cancelled):
+            raise seg.error
+    for seg in parts:
+        if seg.error is not None:
+            raise seg.error
+    return fname
+
+def resume(opener, journal, progress=None, segments=1):
+    """Carry on with the download recorded in journal, starting again if
+    the remote file has changed.  Returns the name written to."""
+    missing = journal.missing()
+    if not missing:
+        journal.finish(progress)
+        return journal.target
+    try:
+        res = opener("bytes=%d-" % missing[0][0])
+    except urllib2.HTTPError, e:
+        if e.code != 416:
+            raise
+        res = None # the range is no good, so the file must have changed
+    if res is not None and res.getcode() == 206 and not journal.matches(res):
+        res.close()
+        res = None
+    if res is None:
+        res = opener(None)
+        if not res:
+            raise DownloadError("Could not resolve %s" % journal.target)
+    if res.getcode() == 206:
+        progress and progress.log("Resuming %s" % journal.target)
+        if journal.length is None:
+            journal.length = response_range(res)[1] # if the server says now
+        if journal.length is None:
+            pass # one stream from the first gap to the end, however long
+        elif segments > 1 or len(missing) > 1:
+            return segmented_download(res, opener, journal.target, progress,
+                segments, journal)
+    else:
+        progress and progress.log("Restarting %s" % journal.target)
+        journal.reset(res)
+        if segments > 1 and supports_ranges(res):
+            return segmented_download(res, opener, journal.target, progress,
+                segments, journal)
+    return download(res, journal.target, progress, journal)
+
+def get_file(opener, fname, progress=None, segments=1, source=None):
+    """Download a file to fname, resuming it if there's a journal for it.
+
+    opener(byterange) returns an open response for the file (byterange is
+    None for all of it).  If fname ends with .EXT, the extension is
+    guessed from the response.  Returns the name written to.
+
+    With a source (the URL of the item the file is for), the manifest of
+    fname's directory is used: if the item's already been downloaded
+    there it isn't fetched again, and if the file's the same version of
+    the same URL as one that has, it's hard-linked to that one."""
+    journal = Journal.find(fname)
+    if journal is not None:
+        return resume(opener, journal, progress, segments)
+    m = source is not None and manifest.for_file(fname) or None
+    if m is not None:
+        row = m.for_source(source)
+        if row is not None:
+            have = m.filename(row)
+            if fname.endswith(".EXT") or os.path.abspath(fname) == have:
+                progress and progress.log("Already downloaded as %s" % have)
+                return have
+            return link_to(m, row, fname, source, progress)
+    res = opener(None)
+    if not res:
+        raise DownloadError("Could not resolve %s" % fname)
+    if progress is not None:
+        progress.log("Downloading %s" % (res.geturl()))
+    if fname.endswith(".EXT"):
+        ext = guess_extension(res)
+        if ext:
+            fname = fname[:-4] + ext
+    if m is not None and res.getcode() == 200:
+        info = res.info()
+        row = m.for_version(res.geturl(), response_range(res)[1],
+                            info.get('ETag'), info.get('Last-Modified'))
+        if row is not None:
+            res.close()
+            return link_to(m, row, fname, source, progress)
+    if segments > 1:
+        return segmented_download(res, opener, fname, progress, segments,
+                                  source=source)
+    return download(res, fname, progress, source=source)
+
+def link_to(m, row, fname, source, progress=None):
+    """Hard-link a new file (fname, or fname.1, ...) to the one a manifest
+    row is for, instead of downloading it, and add it to the manifest
+    for source.  Returns its name, or the other file's if it can't be
+    linked."""
+    have = m.filename(row)
+    if fname.endswith(".EXT"):
+        fname = fname[:-4] + os.path.splitext(have)[1]
+    fname = unique_name(fname)
+    if not manifest.link(have, fname):
+        progress and progress.log("Already downloaded as %s" % have)
+        return have
+    progress and progress.log("Linked %s to %s, already downloaded" % (fname, have))
+    m.add(fname, source, row['url'], row['size'], row['etag'],
+          row['last_modified'], row['sha1'])
+    return fname
+
+class Job(object):
+    """A download: target(job) resolves and downloads the file, updating
+    job.progress, and raises an exception if it fails.  source is the
+    item's URL and fname the file it's downloaded to, if they're known,
+    so the same download isn't queued twice."""
+    ids = itertools.count(1)
+
+    def __init__(self, name, url, target, source=None, fname=None):
+        self.id = self.ids.next()
+        self.name = name
+        self.host = urlparse(url)[1]
+        self.target = target
+        self.source = source
+        self.fname = fname
+        self.progress = Progress(name)
+        self.state = 'queued' # running, done, failed, cancelled
+        self.error = None
+        self.attempts = 0
+        self.not_before = 0 # time to wait for before a retry
+
+    def __repr__(self):
+        return 'Job(%d, %r, %s)' % (self.id, self.name, self.state)
+
+    def finished(self):
+        return self.state in ('done', 'failed', 'cancelled')
+
+    def cancel(self):
+        self.progress.cancelled = True
+        if self.state == 'queued':
+            self.state = 'cancelled'
+# Job
+
+class DownloadQueue(object):
+    """Runs Jobs on up to workers threads, with at most per_host of them
+    for any one host.  Submitted jobs are remembered by id until forget()
+    is called for them, so they can be listed, watched and cancelled.
+
+    A job for the same source and file as one that's queued or running
+    isn't run again; submit() returns the earlier job instead.  One for
+    the same source but another file waits until the other is done, so
+    get_file() can link it to the file that was downloaded."""
+    def __init__(self, workers=WORKERS, per_host=PER_HOST, retries=RETRIES,
+                 backoff=BACKOFF):
+        self.workers = workers
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.pending = []
+        self.jobs = collections.OrderedDict() # id -> job, in submission order
+        self.running = {} # host -> number of running jobs
+        self.threads = []
+        self.cond = threading.Condition()
+        self.board = ProgressBoard()
+
+    def submit(self, job):
+        "Queue job, returning it, or the unfinished job it duplicates"
+        with self.cond:
+            same = self.same_source(job)
+            if same is not None and same.fname == job.fname:
+                return same
+            self.jobs[job.id] = job
+            self.pending.append(job)
+            while len(self.threads) < self.workers:
+                t = threading.Thread(target=self.work, name="DownloadQueue")
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+            self.cond.notify_all()
+        return job
+
+    def same_source(self, job, states=('queued', 'running')):
+        "Another job in one of states for the same source as job, or None"
+        if job.source is None:
+            return None
+        for other in self.jobs.itervalues():
+            if other is not job and other.source == job.source \
+                    and other.state in states:
+                return other
+        return None
+
+    def next_job(self):
+        "Wait for a job that can run now, and take it off the queue"
+        with self.cond:
+            while True:
+                now = time.time()
+                delay = None
+                for job in self.pending:
+                    if job.state == 'cancelled':
+                        self.pending.remove(job)
+                        self.cond.notify_all()
+                        break
+                    if self.running.get(job.host, 0) >= self.per_host:
+                        continue
+                    if job.not_before > now:
+                        wait = job.not_before - now
+                        delay = delay is None and wait or min(delay, wait)
+                        continue
+                    if self.same_source(job, ('running',)) is not None:
+                        continue
+                    self.pending.remove(job)
+                    self.running[job.host] = self.running.get(job.host, 0) + 1
+                    job.state = 'running'
+                    return job
+                else:
+                    self.cond.wait(delay or 1)
+
+    def work(self):
+        while True:
+            job = self.next_job()
+            self.board.add(job.progress)
+            job.attempts += 1
+            try:
+                job.target(job)
+                job.state = 'done'
+            except Cancelled:
+                job.state = 'cancelled'
+            except Exception, e:
+                job.error = e
+                if is_transient(e) and job.attempts <= self.retries \
+                        and not job.progress.cancelled:
+                    wait = self.backoff * 2 ** (job.attempts - 1)
+                    job.progress.log("!! %s: %s (retrying in %ds)" % (
+                        job.name, e, wait))
+                    job.state = 'queued'
+                    job.not_before = time.time() + wait
+                else:
+                    job.state = 'failed'
+                    job.progress.log("!! %s failed: %s" % (job.name, e))
+                    if not isinstance(e, urllib2.URLError):
+                        job.progress.log(traceback.format_exc().rstrip())
+            self.board.remove(job.progress)
+            if job.state != 'queued':
+                self.board.log("[%d] %s %s" % (job.id, job.state, job.name))
+            with self.cond:
+                self.running[job.host] -= 1
+                if job.state == 'queued':
+                    self.pending.append(job)
+                self.cond.notify_all()
+
+    def job(self, id):
+        "Return the job with the given id, or None"
+        return self.jobs.get(id)
+
+    def unfinished(self):
+        "Return the jobs that are queued or running"
+        with self.cond:
+            return [job for job in self.jobs.values() if not job.finished()]
+
+    def forget(self, jobs):
+        "Stop remembering the given (finished) jobs"
+        with self.cond:
+            for job in jobs:
+                self.jobs.pop(job.id, None)
+
+    def wait(self, jobs):
+        "Wait until all the given jobs have finished"
+        with self.cond:
+            while not all(job.finished() for job in jobs):
+                self.cond.wait(1)
+
+    def watch(self, jobs):
+        """Wait for jobs, drawing their progress.  Returns False if
+        Control-C was pressed, leaving them running."""
+        self.board.start(set(job.progress for job in jobs))
+        try:
+            self.wait(jobs)
+        except KeyboardInterrupt:
+            return False
+        finally:
+            self.board.stop()
+        return True
+
+    def run(self, jobs):
+        """Submit jobs and wait for them, drawing their progress.
+        Control-C cancels them."""
+        for job in jobs:
+            self.submit(job)
+        if not self.watch(jobs):
+            self.cancel(jobs)
+
+    def cancel(self, jobs):
+        "Cancel jobs and wait for them to stop"
+        for job in jobs:
+            job.cancel()
+        self.board.start(set(job.progress for job in jobs))
+        try:
+            self.board.log("Cancelling...")
+            self.wait(jobs)
+        finally:
+            self.board.stop()
+# DownloadQueue
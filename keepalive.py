@@ -0,0 +1,354 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""HTTP/1.1 keep-alive handlers for urllib2
+
+urllib2 sends "Connection: close" and opens a new connection for every
+request.  The handlers here take connections from a ConnectionPool
+instead, and give them back once the response has been read to the end
+(or close them if it wasn't), so consecutive requests to the same host
+reuse one TCP/TLS connection.
+
+    pool = ConnectionPool()
+    opener = build_opener(pool)
+
+Responses have a timing dict: whether the connection was reused
+('reused'), and the seconds taken to look up the host ('dns'), connect
+('connect', including any TLS handshake) and get the response headers
+after sending the request ('ttfb').
+"""
+
+import time
+import errno
+import socket
+import httplib
+import urllib2
+import threading
+from urllib import addinfourl
+
+MAX_IDLE = 4         # idle connections kept per host
+IDLE_TIMEOUT = 60    # seconds before an idle connection is closed
+# requests that are resent on a new connection if a reused one has died
+IDEMPOTENT = ('GET', 'HEAD')
+
+class ConnectionPool(object):
+    """Idle HTTP connections, keyed by (scheme, host, tunnel host)"""
+    def __init__(self, maxidle=MAX_IDLE, idle_timeout=IDLE_TIMEOUT):
+        self.maxidle = maxidle
+        self.idle_timeout = idle_timeout
+        self.idle = {} # key -> [(conn, last used), ...], most recent last
+        self.lock = threading.Lock()
+        self.created = self.reused = 0
+
+    def acquire(self, key, factory):
+        "Return (connection, reused), making a new one with factory() if needed"
+        now = time.time()
+        with self.lock:
+            conns = self.idle.get(key)
+            while conns:
+                conn, used = conns.pop()
+                if now - used < self.idle_timeout:
+                    self.reused += 1
+                    return conn, True
+                conn.close()
+            self.created += 1
+        return factory(), False
+
+    def release(self, key, conn, reusable=True):
+        "Give back a connection, closing it if it can't be reused"
+        if not reusable or self.maxidle <= 0:
+            conn.close()
+            return
+        with self.lock:
+            self.evict()
+            conns = self.idle.setdefault(key, [])
+            conns.append((conn, time.time()))
+            while len(conns) > self.maxidle:
+                conns.pop(0)[0].close()
+
+    def evict(self):
+        "Close idle connections older than idle_timeout (lock must be held)"
+        cutoff = time.time() - self.idle_timeout
+        for key, conns in self.idle.items():
+            while conns and conns[0][1] < cutoff:
+                conns.pop(0)[0].close()
+            if not conns:
+                del self.idle[key]
+
+    def close(self):
+        "Close every idle connection"
+        with self.lock:
+            for conns in self.idle.values():
+                for conn, _ in conns:
+                    conn.close()
+            self.idle.clear()
+
+    def __len__(self):
+        return sum(len(c) for c in self.idle.values())
+
+    def stats(self):
+        return "connections: %d idle, %d opened, %d reused" % (
+            len(self), self.created, self.reused)
+# ConnectionPool
+
+def connect_to(addrs, timeout, source_address=None):
+    "Like socket.create_connection(), for addresses already looked up"
+    err = None
+    for af, socktype, proto, canonname, sa in addrs:
+        sock = None
+        try:
+            sock = socket.socket(af, socktype, proto)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sa)
+            return sock
+        except socket.error, err:
+            if sock is not None:
+                sock.close()
+    if err is not None:
+        raise err
+    raise socket.error("getaddrinfo returns an empty list")
+
+def connect(h, timing):
+    """Connect an HTTP(S) connection, recording the seconds taken to look
+    up the host (for plain HTTP) and to connect in timing"""
+    start = time.time()
+    if h.__class__ is httplib.HTTPConnection and not h._tunnel_host:
+        addrs = socket.getaddrinfo(h.host, h.port, 0, socket.SOCK_STREAM)
+        looked_up = time.time()
+        timing['dns'] = looked_up - start
+        start = looked_up
+        h.sock = connect_to(addrs, h.timeout, h.source_address)
+    else:
+        h.connect()
+    timing['connect'] = time.time() - start
+
+class Lease(object):
+    """A connection on loan from the pool for one response"""
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.nbytes = 0 # of the body read through the lease
+        self.on_done = None
+
+    def finished(self):
+        "True if nothing remains of the response on the connection"
+        r = self.response
+        if r.will_close:
+            return False
+        return r.isclosed() or (r.length == 0 and not r.chunked)
+
+    def release(self, reusable):
+        conn = self.conn
+        if conn is not None:
+            self.conn = None
+            self.pool.release(self.key, conn, reusable)
+            if self.on_done is not None:
+                self.on_done(self.nbytes)
+
+    def recv(self, amt):
+        "Read from the response, returning the connection at the end of it"
+        data = self.response.read(amt)
+        self.nbytes += len(data)
+        if self.conn is not None and self.finished():
+            self.release(True)
+        return data
+
+    def recv_into(self, view):
+        """Read from the response into a writable buffer, straight from
+        the socket where possible, returning the number of bytes read"""
+        r = self.response
+        if r.fp is None or r.chunked or r._method == 'HEAD' \
+                or r.fp._rbuf.getvalue():
+            # chunked, or with data buffered along with the headers
+            data = self.recv(len(view))
+            view[:len(data)] = data
+            return len(data)
+        amt = len(view)
+        if r.length is not None:
+            amt = min(amt, r.length)
+        n = 0
+        if amt:
+            while True:
+                try:
+                    n = r.fp._sock.recv_into(view, amt)
+                    break
+                except socket.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+        self.nbytes += n
+        if r.length is not None:
+            r.length -= n
+        if not n or (r.length is not None and r.length <= 0):
+            r.close() # the end of the body
+        if self.conn is not None and self.finished():
+            self.release(True)
+        return n
+# Lease
+
+class PooledFile(socket._fileobject):
+    """The body of a response on a pooled connection
+
+    The connection goes back to the pool as soon as the response has been
+    read to the end, unless the server asked to close it.  Closing the
+    file early closes the connection."""
+    def __init__(self, lease):
+        # the lease references the response but not this file, as
+        # _fileobject has a __del__ and mustn't be part of a cycle
+        lease.response.recv = lease.recv
+        socket._fileobject.__init__(self, lease.response, close=True)
+        self._lease = lease
+
+    def readinto(self, b):
+        "Read up to len(b) bytes into b, returning the number read"
+        view = memoryview(b)
+        buffered = self._rbuf.getvalue()
+        if buffered:
+            # left over from an earlier read()
+            data = self.read(min(len(view), len(buffered)))
+            view[:len(data)] = data
+            return len(data)
+        return self._lease.recv_into(view)
+
+    def when_done(self, func):
+        """Call func(bytes read) once the response has been read to the
+        end or closed"""
+        self._lease.on_done = func
+
+    def socket_body(self):
+        """Return (data, file descriptor, bytes left or None) if the rest
+        of the body can be read straight from a plain TCP socket once the
+        data already buffered has been used, otherwise None.  Reading from
+        the socket leaves the connection unusable, so it is closed rather
+        than pooled afterwards."""
+        r = self._lease.response
+        if r.fp is None or r.chunked or r._method == 'HEAD':
+            return None
+        sock = r.fp._sock
+        if type(sock) is not socket._realsocket: # eg. SSL
+            return None
+        if r.length is None and not r.will_close:
+            return None
+        # what we've read past, and what httplib read along with the headers
+        data = self._rbuf.getvalue()
+        buffered = r.fp._rbuf.getvalue()
+        if r.length is not None:
+            buffered = buffered[:r.length]
+        self._rbuf = socket.StringIO()
+        r.fp._rbuf = socket.StringIO()
+        left = r.length
+        if left is not None:
+            left -= len(buffered)
+        return data + buffered, sock.fileno(), left
+
+    def close(self):
+        lease = self._lease
+        reusable = lease.finished()
+        socket._fileobject.close(self)
+        lease.release(reusable)
+# PooledFile
+
+class AbstractKeepAliveHandler(object):
+    def __init__(self, pool):
+        self.pool = pool
+
+    def do_pooled_open(self, http_class, req, **http_conn_args):
+        "Like AbstractHTTPHandler.do_open, but using the connection pool"
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (req.get_type(), host, req._tunnel_host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict(
+            (name.title(), val) for name, val in headers.items())
+        tunnel_headers = {}
+        if req._tunnel_host:
+            proxy_auth_hdr = "Proxy-Authorization"
+            if proxy_auth_hdr in headers:
+                tunnel_headers[proxy_auth_hdr] = headers[proxy_auth_hdr]
+                # Proxy-Authorization should not be sent to origin
+                # server.
+                del headers[proxy_auth_hdr]
+
+        def factory():
+            h = http_class(host, timeout=req.timeout, **http_conn_args)
+            h.set_debuglevel(self._debuglevel)
+            if req._tunnel_host:
+                h.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            return h
+
+        while True:
+            h, reused = self.pool.acquire(key, factory)
+            timing = { 'reused' : reused }
+            try:
+                if not reused:
+                    connect(h, timing)
+                sent = time.time()
+                h.request(req.get_method(), req.get_selector(), req.data, headers)
+                r = h.getresponse(buffering=True)
+                timing['ttfb'] = time.time() - sent
+            except (socket.error, httplib.HTTPException), err:
+                h.close()
+                if reused and req.get_method() in IDEMPOTENT:
+                    # the server dropped an idle connection; try a new one.
+                    # Anything else may have been done, so mustn't be resent.
+                    continue
+                if isinstance(err, socket.error):
+                    raise urllib2.URLError(err)
+                raise
+            break
+
+        fp = PooledFile(Lease(self.pool, key, h, r))
+        resp = addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        resp.timing = timing
+        return resp
+# AbstractKeepAliveHandler
+
+class HTTPHandler(AbstractKeepAliveHandler, urllib2.HTTPHandler):
+    def __init__(self, pool, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        AbstractKeepAliveHandler.__init__(self, pool)
+
+    def http_open(self, req):
+        return self.do_pooled_open(httplib.HTTPConnection, req)
+
+if hasattr(httplib, 'HTTPS'):
+    class HTTPSHandler(AbstractKeepAliveHandler, urllib2.HTTPSHandler):
+        def __init__(self, pool, debuglevel=0, context=None):
+            urllib2.HTTPSHandler.__init__(self, debuglevel, context)
+            AbstractKeepAliveHandler.__init__(self, pool)
+
+        def https_open(self, req):
+            return self.do_pooled_open(httplib.HTTPSConnection, req,
+                context=self._context)
+
+def build_opener(pool, *handlers):
+    "Return a urllib2 opener whose HTTP(S) connections come from pool"
+    if hasattr(httplib, 'HTTPS'):
+        handlers = (HTTPSHandler(pool),) + handlers
+    return urllib2.build_opener(HTTPHandler(pool), *handlers)
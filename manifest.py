@@ -0,0 +1,167 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""A record of the files downloaded to a directory
+
+Each download directory has a manifest (an SQLite database called
+MANIFEST) of the files completed there: the item's URL they were got
+for (the source), the URL they were downloaded from, their size, ETag
+and Last-Modified, and the SHA-1 of their contents, worked out as they
+were written.  A file's size and modification time are recorded too,
+so a file that's been changed or deleted since is forgotten rather than
+trusted.
+
+get_file() uses it to skip items that are already downloaded, and to
+hard-link files that are the same as one already there instead of
+downloading them again.
+"""
+
+import os
+import time
+import sqlite3
+
+MANIFEST = ".navix-manifest.db" # the manifest in each download directory
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY, -- in the manifest's directory
+    source TEXT,
+    url TEXT,
+    size INTEGER,
+    etag TEXT,
+    last_modified TEXT,
+    sha1 TEXT,
+    mtime REAL,
+    added REAL
+);
+CREATE INDEX IF NOT EXISTS files_source ON files (source);
+CREATE INDEX IF NOT EXISTS files_url ON files (url);
+CREATE INDEX IF NOT EXISTS files_sha1 ON files (sha1);
+"""
+
+class Manifest(object):
+    """The manifest of one directory.  Errors using it are ignored, as
+    it mustn't stop a download."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST)
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        db.executescript(SCHEMA)
+        return db
+
+    def query(self, sql, args=()):
+        "Return the rows sql selects, or [] if the manifest can't be read"
+        if not os.path.exists(self.path):
+            return []
+        try:
+            db = self.connect()
+            try:
+                return db.execute(sql, args).fetchall()
+            finally:
+                db.close()
+        except sqlite3.Error:
+            return []
+
+    def update(self, sql, args=()):
+        try:
+            db = self.connect()
+            try:
+                with db:
+                    db.execute(sql, args)
+            finally:
+                db.close()
+        except sqlite3.Error:
+            pass
+
+    def filename(self, row):
+        return os.path.join(self.directory, row['name'])
+
+    def intact(self, row):
+        """True if a row's file is still there as it was downloaded,
+        forgetting it if not"""
+        try:
+            st = os.stat(self.filename(row))
+        except OSError:
+            st = None
+        if st is not None and st.st_size == row['size'] \
+                and abs(st.st_mtime - row['mtime']) < 1:
+            return True
+        self.forget(self.filename(row))
+        return False
+
+    def first(self, sql, args=()):
+        "The first row sql selects whose file is intact, or None"
+        for row in self.query(sql, args):
+            if self.intact(row):
+                return row
+        return None
+
+    def for_source(self, source):
+        "The file downloaded for the item at source, or None"
+        return self.first("SELECT * FROM files WHERE source = ? "
+                          "ORDER BY added DESC", (source,))
+
+    def for_version(self, url, size, etag=None, last_modified=None):
+        """A file downloaded from url, of size bytes, that has the same
+        validator, or None.  Without a validator, nothing matches."""
+        if etag:
+            return self.first("SELECT * FROM files WHERE url = ? AND size = ? "
+                              "AND etag = ?", (url, size, etag))
+        if last_modified:
+            return self.first("SELECT * FROM files WHERE url = ? AND size = ? "
+                              "AND last_modified = ?", (url, size, last_modified))
+        return None
+
+    def for_sha1(self, sha1, size, other_than):
+        "A file with these contents other than the named one, or None"
+        return self.first("SELECT * FROM files WHERE sha1 = ? AND size = ? "
+                          "AND name != ?", (sha1, size, os.path.basename(other_than)))
+
+    def add(self, fname, source, url, size, etag=None, last_modified=None,
+            sha1=None):
+        "Record that fname, in this directory, has been downloaded"
+        try:
+            mtime = os.path.getmtime(fname)
+        except OSError:
+            return
+        self.update("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (os.path.basename(fname), source, url, size, etag, last_modified,
+             sha1, mtime, time.time()))
+
+    def forget(self, fname):
+        self.update("DELETE FROM files WHERE name = ?", (os.path.basename(fname),))
+# Manifest
+
+def for_file(fname):
+    "The manifest of the directory fname is in"
+    return Manifest(os.path.dirname(os.path.abspath(fname)))
+
+def link(src, fname):
+    """Hard-link fname to src, replacing fname if it exists.  Returns
+    False if the filesystem can't."""
+    tmpname = "%s.%d" % (fname, os.getpid())
+    try:
+        os.link(src, tmpname)
+    except (OSError, AttributeError): # AttributeError: no links on Windows
+        return False
+    os.rename(tmpname, fname)
+    return True
@@ -17,32 +17,121 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+# Modules that are slow to import (the network stack in particular) are
+# imported where they're used, or stood in for by Lazy, so the first
+# playlist can be shown from the session snapshot without them.
 import re
 import sys
 import cmd
 import cPickle as pickle
 import os.path
 import time
-import urllib, urllib2
-from pprint import pprint, pformat
 from subprocess import Popen, PIPE
 from fnmatch import fnmatch
-import textwrap
-import platform
-import mimetypes
-import traceback
+import shlex
+import json
+import threading
+from bisect import bisect_left
+from itertools import count, izip
 #
-import scraper # the navi-x NIPL parser
+import cache
+import search # the local search index
+import tracing
+
+_lazy_lock = threading.Lock()
+
+class Lazy(object):
+    """Stands in for the global called name (a module, or an object that
+    make() returns) until one of its attributes is first used, when it's
+    made and put in its place"""
+    def __init__(self, name, make=None):
+        self.__dict__['name'] = name
+        self.__dict__['make'] = make or (lambda: __import__(name))
+
+    def __getattr__(self, attr):
+        with _lazy_lock:
+            value = globals()[self.name]
+            if value is self:
+                value = globals()[self.name] = self.make()
+        return getattr(value, attr)
+# Lazy
+
+def loaded(value):
+    "True if a Lazy global has been made"
+    return not isinstance(value, Lazy)
+
+scraper = Lazy('scraper') # the navi-x NIPL parser
+downloader = Lazy('downloader')
+streaming = Lazy('streaming')
+proxy = Lazy('proxy') # the local streaming proxy
 
 # globals
 PLSEARCHPATH = ['./navix.plx', '~/.navix.plx', '/etc/navix/playlist']
-if platform.system() == 'Windows':
+WINDOWS = sys.platform.startswith('win')
+if WINDOWS:
     PAGER_CMD = ["more"]
 else:
     PAGER_CMD = ["less", "-eFX"]
+# the player 'play' streams to, on its standard input
+PLAYER_CMD = ['mplayer', '-cache-min', '5', '-noconsolecontrols', '-cache', '2048', '/dev/stdin']
 DOWNLOADPATH=os.path.abspath('.') # current dir
+# downloaded playlists are kept on disk and revalidated after PLAYLIST_TTL
+# seconds, and parsed playlists are kept in memory for as long
+PLAYLIST_TTL = 600
+playlist_cache = cache.HTTPCache('playlists', ttl=lambda: PLAYLIST_TTL, maxitems=64)
+recent_playlists = cache.ExpiringCache('parsed playlists',
+                                       ttl=lambda: PLAYLIST_TTL, maxitems=32)
+# the first playlist and the last SESSION_PLAYLISTS visited are saved to
+# SESSION_FILE on exit, and shown from there next time while they're
+# reloaded in the background
+SESSION_FILE = os.path.join(os.path.expanduser("~"), ".navix", "session")
+SESSION_PLAYLISTS = 16
+snapshot = {} # url -> packed items of the playlists in the session file
+proxy_server = None # the proxy started by 'proxy' or 'm3u'
+downloads = Lazy('downloads', lambda: downloader.DownloadQueue())
 exit_until_index = False # set to true in a cmd and keep returning until we're at the idx again
 homedir = os.path.expanduser("~")
+# in batch mode (-c or --script) there's no pager or prompt, and errors
+# go to stderr
+BATCH = False
+JSON_OUTPUT = False # ls, show and resolve print a JSON object per line
+PROFILE_LINES = 25 # functions shown by 'profile'
+errors = 0 # the number of commands that have failed, for the exit status
+
+def error(msg):
+    "Report that a command failed"
+    global errors
+    errors += 1
+    print >>(BATCH and sys.stderr or sys.stdout), "!! %s" % msg
+
+def emit(obj):
+    "Print obj as a line of JSON"
+    print json.dumps(obj, sort_keys=True)
+
+class Pager(object):
+    """Where ls and more write their output: PAGER_CMD, or stdout in
+    batch mode"""
+    def __init__(self):
+        self.proc = None
+        if BATCH:
+            self.out = sys.stdout
+        else:
+            self.proc = Popen(PAGER_CMD, stdin=PIPE, bufsize=-1)
+            self.out = self.proc.stdin
+
+    def write(self, s):
+        self.out.write(s)
+
+    def close(self):
+        if self.proc is None:
+            self.out.flush()
+            return
+        try:
+            self.out.close()
+        except IOError:
+            pass # the pager was quit
+        self.proc.wait()
+# Pager
 
 def chdir(path, verbose=True):
     "Change the download directory"
@@ -62,11 +151,6 @@ def dcode(s):
         return s
     return s.decode('utf-8', 'replace')
 
-class myURLOpener(urllib.FancyURLopener):
-    def http_error_206(self, url, fp, errcode, errmsg, headers, data=None):
-        pass
-myUrlClass = myURLOpener()
-
 USER_AGENT="Mozilla/5.0 (Windows; U; Windows NT 6.1; ru; rv:1.9.2b5) Gecko/20091204 Firefox/3.6b5"
 
 def request(url, referer=None, ua=USER_AGENT, data=None, **kwargs):
@@ -75,65 +159,19 @@ def request(url, referer=None, ua=USER_AGENT, data=None, **kwargs):
     if referer:
         d['Referer'] = referer
     d.update(kwargs)
+    import urllib2
     r = urllib2.Request(url, data, d)
     return r
 
-def ratestring(kbps):
-    "Return the download rate in a human-friendly format."
-    if kbps > 1024:
-        return "%0.2f MB/s" % (kbps/1024)
-    return "%d KB/s" % (kbps)
-
-def guess_extension(response):
-    "Return an extension based on the Content-Type header in the response"
-    if not response:
-        return None
-    ct = response.info().get('content-type')
-    if ct:
-        mimetype = ct.split(';')[0]
-        ext = mimetypes.guess_extension(mimetype)
-        if ext:
-            return ext
-        # otherwise try based on URL
-        mimetype, _ = mimetypes.guess_type(response.geturl())
-        if mimetype:
-            ext = mimetypes.guess_extension(mimetype)
-        return ext
-
-def download(res, filename):
-    """Download the HTTP response object to the given filename
-    using VT100 codes to interactively show the progress"""
-    length = res.info().get('Content-Length', None)
-    strlength = length and ("%dk" % (int(length)/1024)) or "Unknown"
-    i = 0 # if the destination file exists, add .$i to it
-    starttime = time.time() # for rate calculation
-    buf = res.read(4096) # 4k block size
-    bytecount = len(buf)
-    out = None
-    while buf:
-        if out is None:
-            fname = filename
-            i = 1
-            if res.getcode() == 206: # partial file transfer
-                # TODO / FIXME - seek to right location, in-case
-                out = file(fname, "ab")
-            else:
-                while os.path.exists(fname):
-                    fname = "%s.%d" % (fname, i)
-                    i = i + 1
-                out = file(fname, "wb")
-            print "Downloading to %s" % fname
-        out.write(buf)
-        buf = res.read(4096)
-        bytecount += len(buf)
-        kbps = int(bytecount / (int(time.time() - starttime) or 1) / 1024.0)
-        sys.stdout.write("\r\033[K[%dk / %s] (~%s)" % (bytecount//1024, strlength, ratestring(kbps)))
-        sys.stdout.flush()
-    out.close()
-    print ""
-# download
-
-def parse_navix_pls(url):
+def open_playlist(url, store=True):
+    """Open a playlist, going through the playlist cache for HTTP URLs,
+    and adding it to the cache if store is True"""
+    browser = scraper.shared_browser()
+    if url.startswith("http://") or url.startswith("https://"):
+        return playlist_cache.open(browser, url, store=store)
+    return browser.get(url)
+
+def parse_navix_pls(url, store=True):
     """Parse a navi-x format playlist entries, ignoring any type-less entries
 
     The Navi-X playlist has some header key/value pairs for
@@ -157,19 +195,42 @@ def parse_navix_pls(url):
     type=video
     name=Cool Video 2
     ...
+
+    Keys and values are yielded as undecoded (UTF-8) byte strings, with
+    the keys interned.  If store is False, a playlist that's fetched
+    isn't added to the playlist cache.  The time spent here, rather than by the caller
+    between entries, is traced as a 'parse' span's 'busy' seconds.
     """
-    fd = urllib2.urlopen(url)
+    span = tracing.span('parse', url)
+    items = 0
+    busy = 0.0
+    try:
+        start = time.time()
+        for d in _parse_navix_pls(url, store):
+            busy += time.time() - start
+            items += 1
+            yield d
+            start = time.time()
+        busy += time.time() - start
+    except Exception, e:
+        span.set(error=tracing.describe(e))
+        raise
+    finally:
+        span.finish(items=items, busy=busy)
+
+def _parse_navix_pls(url, store=True):
+    fd = open_playlist(url, store)
     d = {}
     indesc = False
     for line in fd:
-        line = dcode(line.strip())
+        line = line.strip()
         if indesc:
             if line.endswith("/description"):
                 indesc = False
-            line = line[:-12]
+                line = line[:-12]
             d['description'] += '\n' + line
             continue
-        if re.search("^#?$", line):
+        if not line or line == '#':
             if d and 'type' in d:
                 yield d
             d = {}
@@ -178,6 +239,7 @@ def parse_navix_pls(url):
             continue
         if '=' in line:
             k,v = line.split('=', 1)
+            k = intern(k)
             if k == 'description':
                 if v.endswith("/description"):
                     v = v[:-12]
@@ -189,16 +251,100 @@ def parse_navix_pls(url):
         yield d
 # parse_navix_pls
 
-class Item(dict):
-    """Represents an item in a Playlist"""
+# Values of these keys are shared between items, as most playlists only
+# use a handful of different ones.
+INTERN_KEYS = frozenset(['type', 'processor', 'thumb', 'player', 'rating',
+                         'version', 'background', 'icon'])
+
+_layouts = {} # interned item layouts: tuple of keys -> {key: index}
+_colors = re.compile(r'\[/?COLOR.*?\]') # Navi-X color tags in names
+
+def layout_for(keys):
+    "Return the shared layout for a sorted tuple of keys"
+    layout = _layouts.get(keys)
+    if layout is None:
+        layout = _layouts.setdefault(keys,
+            dict((intern(str(k)), i) for i, k in enumerate(keys)))
+    return layout
+
+class Item(object):
+    """Represents an item in a Playlist
+
+    Items are read-only mappings stored compactly: the keys are held in a
+    layout shared by every item with the same set of keys, and the values
+    are kept as undecoded bytes in a tuple, only decoded (to unicode)
+    when they're looked up."""
+    __slots__ = ('_layout', '_values')
+
+    def __init__(self, d=(), **kwargs):
+        d = dict(d, **kwargs)
+        keys = tuple(sorted(d))
+        layout = layout_for(keys)
+        values = []
+        for k in keys:
+            v = d[k]
+            if type(v) == unicode:
+                v = v.encode('utf-8')
+            if k in INTERN_KEYS:
+                v = intern(v)
+            values.append(v)
+        self._layout = layout
+        self._values = tuple(values)
+
+    def __getstate__(self):
+        return dict(zip(self.keys(), self._values))
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def raw(self, key, default=None):
+        "Return the undecoded value for key"
+        i = self._layout.get(key)
+        if i is None:
+            return default
+        return self._values[i]
+
+    def __getitem__(self, key):
+        i = self._layout.get(key)
+        if i is None:
+            raise KeyError(key)
+        return dcode(self._values[i])
+
+    def get(self, key, default=None):
+        i = self._layout.get(key)
+        if i is None:
+            return default
+        return dcode(self._values[i])
+
+    def __contains__(self, key):
+        return key in self._layout
+
+    has_key = __contains__
+
+    def keys(self):
+        return sorted(self._layout, key=self._layout.get)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._values)
+
+    def items(self):
+        return [(k, dcode(v)) for k, v in zip(self.keys(), self._values)]
+
+    def values(self):
+        return [dcode(v) for v in self._values]
+
     def __str__(self):
         if self.type and self.name:
             return 'Item(%r,%r)' % (
                 self.type.lower().capitalize(),
                 self.name,)
-        return 'Item(%s)' % (dict.__str__(self),)
+        return 'Item(%s)' % (dict(self),)
 
     def __repr__(self):
+        from pprint import pformat
         return pformat(dict(self))
 
     @property
@@ -222,21 +368,392 @@ class Item(dict):
         return self.get('infotag', None)
 # Item
 
-class Playlist(list):
-    def __init__(self, url):
+class Playlist(object):
+    """A sequence of Items, parsed from url on a background thread
+
+    Items can be used as soon as they've arrived: indexing only blocks
+    until that item has been parsed, and iterating yields items as they
+    come in.  len() waits for the whole playlist.  d maps the (undecoded)
+    URL of each item that's arrived so far to the item.
+
+    Each item's name is stored without its color tags as it arrives, and
+    the items of each type are indexed, so that listing them (see
+    select()) costs as much as the items shown.
+
+    A Playlist made with a list of items (such as search results) is
+    complete from the start, and nothing is fetched."""
+    def __init__(self, url, lazy=True, items=None):
         self.url = url
-        self.d = d = {}
+        self.d = {}
+        self.items = []
+        self.names = [] # item index -> undecoded name without color tags
+        self.types = {} # undecoded type -> indexes of the items of that type
+        self.done = False
+        self.error = None
+        self.reported = False
+        self.wanted = None # the item index a reader is waiting for
+        self.updated = False # set when refresh() changes the items
+        self.sources = None # search results: item index -> its playlist's URL
+        self.cond = threading.Condition()
+        if items is not None:
+            for item in items:
+                self.add(item)
+            self.done = True
+        elif lazy:
+            t = threading.Thread(target=self.load, name="Playlist %s" % url)
+            t.daemon = True
+            t.start()
+        else:
+            self.load()
+
+    def add(self, item):
+        "Append and index an item (with the lock held while loading)"
+        name = item.raw('name', '')
+        if '[' in name:
+            name = _colors.sub('', name)
+        self.names.append(name)
+        self.types.setdefault(item.raw('type'), []).append(len(self.items))
+        url = item.raw('URL')
+        if url:
+            self.d[url] = item
+        self.items.append(item)
+
+    def load(self):
+        "Parse the playlist, making items available as they're parsed"
+        import urllib2
+        items = self.items
+        cond = self.cond
+        try:
+            try:
+                for x in parse_navix_pls(self.url):
+                    item = Item(x)
+                    with cond:
+                        self.add(item)
+                        if self.wanted is not None and self.wanted < len(items):
+                            self.wanted = None
+                            cond.notify_all()
+            except urllib2.HTTPError:
+                pass
+            except Exception, e:
+                self.error = e
+        finally:
+            with cond:
+                self.done = True
+                cond.notify_all()
+        if self.error is None and items:
+            search.index.add_later(self.url, (i.__getstate__() for i in items))
+
+    def wait(self, index=None):
+        """Wait until the item at index has arrived (or the playlist is
+        complete), or for the whole playlist if index is None"""
+        if index is None:
+            index = sys.maxint
+        with self.cond:
+            while not self.done and index >= len(self.items):
+                if self.wanted is None or index < self.wanted:
+                    self.wanted = index
+                # a timeout keeps this interruptible with Control-C
+                self.cond.wait(1)
+            if self.done and self.error is not None and not self.reported:
+                error("Error loading %s: %s" % (self.url, self.error))
+                self.reported = True
+
+    def refresh(self):
+        """Reload the playlist on a background thread, replacing the items
+        (and setting updated) if they've changed"""
+        t = threading.Thread(target=self._refresh, name="Refresh %s" % self.url)
+        t.daemon = True
+        t.start()
+
+    def _refresh(self):
         try:
-            gen = parse_navix_pls(url)
-        except urllib2.HTTPError:
-            return
-        for x in gen:
-            item = Item(x)
-            if item.url:
-                d[item.url] = item
-            self.append(item)
+            fresh = Playlist(self.url, lazy=False)
+        except Exception:
+            return # the interpreter's exiting
+        if fresh.failed():
+            return # keep what we have, eg. when offline
+        with self.cond:
+            if len(fresh.items) == len(self.items) and all(
+                    a._layout is b._layout and a._values == b._values
+                    for a, b in izip(fresh.items, self.items)):
+                return
+            self.items, self.names = fresh.items, fresh.names
+            self.types, self.d = fresh.types, fresh.d
+            self.updated = True
+
+    def failed(self):
+        "True if the playlist finished loading with an error or no items"
+        return self.done and (self.error is not None or not self.items)
+
+    def name(self, index):
+        "The name of the item at index, without color tags"
+        return dcode(self.names[index])
+
+    def value(self, index, key):
+        "The value of key for the item at index, '' if it has none"
+        if key == 'name':
+            return self.name(index)
+        return dcode(self.items[index].raw(key, ''))
+
+    def select(self, start=0, stop=None, test=None, type=None):
+        """Yield the indexes from start up to (not including) stop of the
+        items for which test(index) is true, as they arrive.  Given a
+        type, only the items of that type are looked at."""
+        if type is not None:
+            self.wait()
+            indexes = self.types.get(type.encode('utf-8'), [])
+            lo = bisect_left(indexes, start)
+            hi = stop is None and len(indexes) or bisect_left(indexes, stop)
+            indexes = indexes[lo:hi]
+        else:
+            indexes = count(start)
+        for i in indexes:
+            if stop is not None and i >= stop:
+                return
+            self.wait(i)
+            if i >= len(self.items):
+                return
+            if test is None or test(i):
+                yield i
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) or index < 0:
+            self.wait()
+        else:
+            self.wait(index)
+        return self.items[index]
+
+    def __len__(self):
+        self.wait()
+        return len(self.items)
+
+    def __nonzero__(self):
+        self.wait(0)
+        return bool(self.items)
+
+    def __iter__(self):
+        i = 0
+        while True:
+            self.wait(i)
+            if i >= len(self.items):
+                return
+            yield self.items[i]
+            i += 1
 # Playlist
 
+def load_playlist(url):
+    """Return the Playlist for url, reusing a recently parsed one for
+    remote playlists.  A playlist in the session snapshot is shown from
+    there while it's reloaded, except in batch mode, where commands
+    need the current items."""
+    remote = url.startswith("http://") or url.startswith("https://")
+    if remote:
+        pl = recent_playlists.get((url,))
+        if pl is not None and not pl.failed():
+            return pl
+    data = not BATCH and snapshot.pop(url, None)
+    if data:
+        pl = Playlist(url, items=unpack_items(data))
+        pl.refresh()
+    else:
+        pl = Playlist(url)
+    if remote:
+        recent_playlists.put((url,), pl)
+    return pl
+
+def pack_items(items):
+    "Pickle a list of Items, storing each set of keys once"
+    numbers = {} # id of a layout -> its number
+    layouts = []
+    rows = []
+    for item in items:
+        n = numbers.get(id(item._layout))
+        if n is None:
+            n = numbers[id(item._layout)] = len(layouts)
+            layouts.append(tuple(item.keys()))
+        rows.append((n, item._values))
+    return pickle.dumps((layouts, rows), pickle.HIGHEST_PROTOCOL)
+
+def unpack_items(data):
+    "Return the list of Items pickled by pack_items"
+    layouts, rows = pickle.loads(data)
+    layouts = map(layout_for, layouts)
+    items = []
+    new = Item.__new__
+    for n, values in rows:
+        item = new(Item)
+        item._layout = layouts[n]
+        item._values = values
+        items.append(item)
+    return items
+
+def load_session():
+    "Read the session snapshot saved by save_session"
+    try:
+        fd = open(SESSION_FILE, "rb")
+    except IOError:
+        return
+    try:
+        try:
+            snapshot.update(pickle.load(fd))
+        except Exception:
+            pass # a corrupt snapshot is no snapshot
+    finally:
+        fd.close()
+
+def save_session(root):
+    """Save the root playlist and the ones visited most recently (or
+    left over from the last snapshot) to SESSION_FILE"""
+    playlists = [root] + recent_playlists.values()[-SESSION_PLAYLISTS:]
+    data = dict(snapshot.items()[:SESSION_PLAYLISTS + 1 - len(playlists)])
+    for pl in playlists:
+        if pl.done and not pl.failed():
+            data[pl.url] = pack_items(pl.items)
+    tmpname = "%s.%d" % (SESSION_FILE, os.getpid())
+    try:
+        try:
+            os.makedirs(os.path.dirname(SESSION_FILE))
+        except OSError:
+            pass
+        fd = open(tmpname, "wb")
+        try:
+            pickle.dump(data, fd, pickle.HIGHEST_PROTOCOL)
+        finally:
+            fd.close()
+        os.rename(tmpname, SESSION_FILE)
+    except (IOError, OSError):
+        try: os.unlink(tmpname)
+        except OSError: pass
+
+def open_item(d, byterange=None):
+    """Return an open response for a playlist item, resolving it through
+    its processor if it has one"""
+    if 'processor' in d:
+        return scraper.navix_get(d['processor'], d['URL'], byterange=byterange, verbose=0)
+    browser = scraper.shared_browser()
+    if byterange:
+        return browser.get(d['URL'], Range=byterange)
+    return browser.get(d['URL'])
+
+def prefetch(items):
+    "Start resolving the playable items with processors in the background"
+    if not scraper.prefetcher.on():
+        return
+    scraper.prefetcher.request([(d['processor'], d['URL']) for d in items
+        if d.type in ('video', 'audio') and 'processor' in d and 'URL' in d])
+
+def segments_option(line):
+    "Split a leading -s[N] option off a command line: (segments, rest)"
+    m = re.match(r'-s(\d*)\s+', line.strip())
+    if m is None:
+        return 1, line
+    return int(m.group(1) or downloader.SEGMENTS), line.strip()[m.end():]
+
+_num_range = re.compile(r'(\d+)(?:-(\d*))?$')
+
+def parse_range(line, count):
+    """Return the item numbers in line, a list of numbers and from-to
+    ranges (to the last of count items if there's no 'to') separated by
+    spaces or semicolons, or None if it doesn't parse"""
+    nums = []
+    for word in re.split(r'[;\s]+', line.strip()):
+        if not word:
+            continue
+        m = _num_range.match(word)
+        if m is None:
+            return None
+        first, last = m.groups()
+        if last is None:
+            nums.append(int(first))
+        else:
+            last = last and int(last) or count - 1
+            nums.extend(xrange(int(first), min(last, count - 1) + 1))
+    return nums
+
+TYPE_ALIASES = { 'playlist' : 'pls', } # short types shown by ls
+
+_digits = re.compile(r'(\d+)')
+
+def natural_key(s):
+    "A sort key for s that puts numbers in order: 'Part 9' before 'Part 10'"
+    parts = _digits.split(s.lower())
+    parts[1::2] = map(int, parts[1::2])
+    return parts
+
+_ls_filter = re.compile(r'(\w+)(=|!=|<=|>=|<|>)(.*)$')
+_ls_window = re.compile(r'(\d+)-(\d*)$')
+
+def parse_ls(line):
+    """Split the arguments of ls into (pattern, filters, sort, window):
+    a pattern matching names, (key, op, value) filters, the key to sort
+    on (starting with '-' to reverse), and the (first, last) item
+    numbers shown (last may be None)"""
+    words = []
+    filters = []
+    sort = None
+    window = (0, None)
+    try:
+        args = shlex.split(line) # so name="a b" works
+    except ValueError:
+        args = line.split()
+    for word in args:
+        m = _ls_window.match(word)
+        if m:
+            window = (int(m.group(1)), m.group(2) and int(m.group(2)) or None)
+            continue
+        m = _ls_filter.match(word)
+        if m is None:
+            words.append(word)
+        elif m.group(1) == 'sort' and m.group(2) == '=':
+            sort = m.group(3)
+        else:
+            filters.append(m.groups())
+    return ' '.join(words), filters, sort, window
+
+def parse_crawl(line):
+    """Split the arguments of crawl, in any order, into (searchable,
+    depth, num, fname), raising ValueError if they don't make sense"""
+    searchable = False
+    depth = num = fname = None
+    try:
+        args = shlex.split(line) # so to "a b.idx" works
+    except ValueError:
+        args = line.split()
+    while args:
+        word = args.pop(0)
+        if word == '-s':
+            searchable = True
+        elif word.startswith('-d'):
+            value = word[2:] or (args and args.pop(0)) or ''
+            if not value.isdigit():
+                raise ValueError("-d needs a depth")
+            depth = int(value)
+        elif word == 'to':
+            if not args:
+                raise ValueError("to needs a file")
+            fname = args.pop(0)
+        elif word.isdigit() and num is None:
+            num = word
+        else:
+            raise ValueError("unexpected %r" % word)
+    return searchable, depth, num, fname
+
+def ls_test(playlist, key, op, value):
+    "A test of the item at an index for an ls filter"
+    if op in ('=', '!='):
+        value = value.lower()
+        if any(c in value for c in '*?['):
+            match = lambda i: fnmatch(playlist.value(i, key).lower(), value)
+        else:
+            match = lambda i: playlist.value(i, key).lower() == value
+        if op == '!=':
+            return lambda i: not match(i)
+        return match
+    value = natural_key(value)
+    compare = { '<' : lambda a: a < value, '>' : lambda a: a > value,
+                '<=' : lambda a: a <= value, '>=' : lambda a: a >= value }[op]
+    return lambda i: compare(natural_key(playlist.value(i, key)))
+
 class BaseCmd(cmd.Cmd):
     """Custom Cmd base class with extra features:
     * Support recursive exiting of Cmd loop's
@@ -245,11 +762,30 @@ class BaseCmd(cmd.Cmd):
     * Provide a help command that displays docstrings
     """
     def do_EOF(self, line=None):
-        print ""
+        if not BATCH:
+            print ""
         return True
 
+    def precmd(self, line):
+        "Treat lines starting with # as comments, for scripts"
+        if line.lstrip().startswith('#'):
+            return ''
+        return line
+
+    def onecmd(self, line):
+        "In batch mode, an exception fails the command rather than the script"
+        if not BATCH:
+            return cmd.Cmd.onecmd(self, line)
+        try:
+            return cmd.Cmd.onecmd(self, line)
+        except Exception, e:
+            error("%s: %s" % (line, e))
+
     def postcmd(self, stop, line):
-        "Support recursive exiting"
+        "Support recursive exiting, and report finished downloads"
+        if loaded(downloads):
+            for msg in downloads.board.take_held():
+                print msg
         global exit_until_index
         if exit_until_index:
             if hasattr(self, '__isindex'):
@@ -267,7 +803,7 @@ class BaseCmd(cmd.Cmd):
         if line.startswith('!'):
             os.system(line[1:])
         else:
-            print "*** Unknown syntax: %s" % line
+            error("Unknown syntax: %s" % line)
 
     def do_help(self, line):
         "help [command]"
@@ -300,10 +836,28 @@ class PlaylistCmd(BaseCmd):
     def __init__(self, name, playlist, *args, **kwargs):
         # strip Navi-X playlist colors from the title name
         name = re.sub('\[\/?COLOR.*?\]','', name)
-        self.prompt = name + "> "
+        self.name = name
+        self.prompt = not BATCH and name + "> " or ""
         self.playlist = playlist
         BaseCmd.__init__(self, *args, **kwargs)
 
+    def enter(self, name, playlist):
+        """Run a shell for a playlist until it's left, listing it first
+        (except in batch mode)"""
+        pc = PlaylistCmd(name, playlist, stdin=self.stdin, stdout=self.stdout)
+        # batch commands carry on in the new shell
+        pc.use_rawinput = self.use_rawinput
+        pc.cmdqueue = self.cmdqueue
+        if not BATCH:
+            pc.onecmd("ls")
+        pc.cmdloop()
+
+    def precmd(self, line):
+        if self.playlist.updated:
+            self.playlist.updated = False
+            print "-- This playlist has changed since it was last shown ('ls' to list it)"
+        return BaseCmd.precmd(self, line)
+
     def _getd(self, line):
         "Convert a number into an Item"
         try:
@@ -311,12 +865,28 @@ class PlaylistCmd(BaseCmd):
         except:
             return None
 
+    def _getfull(self, line):
+        """Like _getd, but a search result is looked up in its playlist,
+        as the search index doesn't keep every value"""
+        d = self._getd(line)
+        sources = self.playlist.sources
+        if d is None or sources is None or 'URL' not in d:
+            return d
+        pl = load_playlist(sources[int(line.strip())])
+        pl.wait()
+        return pl.d.get(d.raw('URL')) or d
+
     def do_show(self, line):
         "show <num>: show a human summary of the entry"
-        d = self._getd(line)
+        d = self._getfull(line)
         if d is None:
-            print "!! Cannot find %s" % line
+            error("Cannot find %s" % line)
             return
+        if JSON_OUTPUT:
+            emit(dict(d.items(), index=int(line)))
+            prefetch([d])
+            return
+        import textwrap
         if 'name' in d:
             for x in textwrap.wrap(d['name'], 70):
                 print x
@@ -331,28 +901,61 @@ class PlaylistCmd(BaseCmd):
                         except: print x.decode('iso-8859-1', 'replace')
         if 'URL' in d:
             print '[URL=%s]' % d['URL']
+        prefetch([d])
 
     def do_info(self, line):
         self.do_show(line)
 
     def do_ls(self, line):
-        "ls: list the entries in the current playlist"
-        line = line.strip()
-        i = -1
-        typealiases = { 'playlist' : 'pls', }
-        pipe = Popen(PAGER_CMD, stdin=PIPE)
-        for item in self.playlist:
-            i += 1
-            name = re.sub('\[\/?COLOR.*?\]','', item['name'])
-            if line and not fnmatch(name, line):
-                continue
-            typ = typealiases.get(item.type, item.type)
-            if item.infotag:
-                name = "%s [%s]" % (name, item.infotag)
-            out = "[%3d] (%s) %s\n" % (i, typ, name)
-            pipe.stdin.write(out.encode('utf-8','ignore'))
-        pipe.stdin.close()
-        pipe.wait()
+        """ls [<pattern>] [<key><op><value>...] [sort=[-]<key>] [<from>-<to>]:
+        list the entries in the current playlist, or those whose names
+        match the pattern and whose values pass the filters (op is one of
+        = != < > <= >=, and = may take a pattern), e.g.
+            ls type=video infotag>2010 sort=-rating 100-199"""
+        pattern, filters, sort, (first, last) = parse_ls(line)
+        pl = self.playlist
+        tests = []
+        only = None
+        if pattern:
+            tests.append(lambda i: fnmatch(pl.name(i), pattern))
+        for key, op, value in filters:
+            if key == 'type' and op == '=' and not any(c in value for c in '*?['):
+                only = value.lower() # indexed
+            else:
+                tests.append(ls_test(pl, key, op, value))
+        test = None
+        if tests:
+            test = lambda i: all(t(i) for t in tests)
+        indexes = pl.select(first, last is not None and last + 1 or None,
+                            test, only)
+        if sort:
+            key = sort.lstrip('-')
+            indexes = sorted(indexes, reverse=sort.startswith('-'),
+                             key=lambda i: natural_key(pl.value(i, key)))
+        if JSON_OUTPUT:
+            for i in indexes:
+                emit(dict(pl.items[i].items(), index=i))
+            return
+        pager = Pager()
+        shown = []
+        try:
+            # lines are written (undecoded) as they're made, so quitting
+            # the pager stops the listing
+            for i in indexes:
+                item = pl.items[i]
+                shown.append(item)
+                typ = item.raw('type')
+                typ = TYPE_ALIASES.get(typ, typ)
+                infotag = item.raw('infotag')
+                if infotag:
+                    out = "[%3d] (%s) %s [%s]\n" % (i, typ, pl.names[i], infotag)
+                else:
+                    out = "[%3d] (%s) %s\n" % (i, typ, pl.names[i])
+                pager.write(out)
+        except IOError:
+            pass
+        pager.close()
+        prefetch(shown)
 
     def do_cd(self, line):
         "cd <num> | cd .. | cd /: change to the given playlist, up one level, or back to the main index"
@@ -364,62 +967,68 @@ class PlaylistCmd(BaseCmd):
             return True
         if line.startswith("http"):
             try:
-                pl = PlaylistCmd(line, Playlist(line))
+                pl = load_playlist(line)
             except Exception, e:
-                print e
+                error(e)
                 return
-            pl.onecmd("ls")
-            pl.cmdloop()
+            self.enter(line, pl)
             return
         elif os.path.isfile(line):
             line = os.path.abspath(line)
-            pl = PlaylistCmd(line, Playlist("file://"+line))
-            pl.onecmd("ls")
-            pl.cmdloop()
+            self.enter(line, load_playlist("file://"+line))
+            return
         d = self._getd(line)
         if d is None:
-            print "!! Cannot cd to %s" % line
+            error("Cannot cd to %s" % line)
             return
         if d['type'] == 'playlist':
-            pl = PlaylistCmd(d['name'], Playlist(d['URL']))
-            pl.onecmd("ls")
-            pl.cmdloop()
+            self.enter(d['name'], load_playlist(d['URL']))
         else:
-            print "!! Cannot cd to %s" % line
+            error("Cannot cd to %s" % line)
 
     def do_more(self, line):
         "Open a URL directly and display the output"
         item = self._getd(line)
         if item is None:
-            print "!! Cannot more %s" % line
+            error("Cannot more %s" % line)
             return
         if item.url and item.type:
             if item.type in ('video', 'audio'):
-                print "!! Cannot view binary data as a text file"
+                error("Cannot view binary data as a text file")
                 return
-            req = request(item.url)
-            g = urllib2.urlopen(req)
-            pipe = Popen(PAGER_CMD, stdin=PIPE)
+            g = scraper.shared_browser().get(item.url)
+            pager = Pager()
             while True:
                 b = g.read(512)
                 if not b:
                     break
                 try:
-                    pipe.stdin.write(b)
+                    pager.write(b)
                 except IOError:
                     break
-            pipe.stdin.close()
-            pipe.wait()
+            pager.close()
             print ""
 
     def do_search(self, line):
-        "search <string>: search the Navi-X database for the given string"
-        pl = Playlist("http://navix.turner3d.net/playlist/search/%s" % (
-            urllib.quote_plus(line)))
-        if len(pl) > 0:
-            pc=PlaylistCmd("Results for '%s'" % line, pl)
-            pc.onecmd("ls")
-            pc.cmdloop()
+        """search [-r] <string>: search the items of the playlists you've
+        loaded or crawled for the given string, or with -r search the
+        Navi-X database"""
+        line = line.strip()
+        if line.startswith('-r '):
+            from urllib import quote_plus
+            line = line[3:].strip()
+            pl = load_playlist("http://navix.turner3d.net/playlist/search/%s" % (
+                quote_plus(line)))
+        else:
+            results = search.index.search(line)
+            pl = Playlist("search:%s" % line,
+                          items=[Item(d) for score, d, url in results])
+            pl.sources = [url for score, d, url in results]
+            if not pl:
+                print "No local results for '%s' (try search -r %s)" % (line, line)
+                return
+        if pl:
+            self.enter("Results for '%s'" % line, pl)
         else:
             print "No results for '%s'" % line
 
@@ -427,24 +1036,242 @@ class PlaylistCmd(BaseCmd):
         "dump <num>: show debugging dictionary for item"
         d = self._getd(line)
         if d is None:
-            print "!! Cannot show %s" % line
+            error("Cannot show %s" % line)
             return
+        from pprint import pprint
         pprint(d)
 
     def do_proc(self, line):
         "proc <num>: Display the output of the given processor for the item"
         d = self._getd(line)
         if d is None:
-            print "!! Error calling proc with argument: %s" % line
+            error("Error calling proc with argument: %s" % line)
             return
         if 'processor' in d:
-            purl = "%s?url=%s" % (d['processor'], urllib.quote(d['URL']))
+            from urllib import quote
+            purl = "%s?url=%s" % (d['processor'], quote(d['URL']))
             print "Processing with %s" % purl
-            print urllib2.urlopen(purl).read()
+            print scraper.shared_browser().get(purl).read()
             print
         else:
             print "No processor required for", d['URL']
 
+    def do_resolve(self, line):
+        """resolve <num>|<from>-<to>[;...]: show the final URL of items (and
+        any headers needed to fetch them), worked out through their
+        processors, up to scraper.RESOLVE_WORKERS at once.  With several
+        items, each is shown as soon as it's resolved, numbered."""
+        nums = parse_range(line, len(self.playlist))
+        if not nums:
+            error("Usage: resolve <num>|<from>-<to>[;...]")
+            return
+        numbered = len(nums) > 1
+        pending = []
+        for n in nums:
+            d = self._getd(str(n))
+            if d is None or 'URL' not in d:
+                error("Cannot resolve %d" % n)
+            elif 'processor' in d:
+                pending.append((n, d))
+            else:
+                self.show_resolved(n, d, d['URL'], {}, numbered)
+        results = scraper.resolve_all([(item['processor'], item['URL'])
+                                       for num, item in pending])
+        try:
+            for i, res, e, msgs in results:
+                n, d = pending[i]
+                for msg in msgs:
+                    print msg
+                if res is None:
+                    error("Couldn't resolve %d%s" % (n, e and ": %s" % e or ""))
+                else:
+                    self.show_resolved(n, d, res.url, res.headers, numbered)
+        except KeyboardInterrupt:
+            results.close()
+            error("Stopped resolving")
+
+    def show_resolved(self, n, d, url, headers, numbered):
+        if JSON_OUTPUT:
+            emit({'index' : n, 'name' : d.name, 'URL' : d['URL'],
+                  'processor' : d.get('processor'), 'resolved' : url,
+                  'headers' : headers})
+            return
+        if numbered:
+            print "[%3d] %s" % (n, url)
+        else:
+            print url
+        for k, v in sorted(headers.items()):
+            print "  %s: %s" % (k, v)
+
+    def do_record(self, line):
+        """record <num> <file>: resolve an item through its processor with
+        a browser of its own, saving every request and response to a
+        cassette file, to be replayed without the network"""
+        args = line.split(None, 1)
+        d = args and self._getd(args[0])
+        if len(args) != 2 or not d or 'processor' not in d:
+            error("Usage: record <num> <file>, for an item with a processor")
+            return
+        fname = os.path.expanduser(args[1])
+        try:
+            res = scraper.record(d['processor'], d['URL'], fname)
+        except (IOError, OSError), e:
+            error(e)
+            return
+        print "Recorded to %s: %s" % (fname, res and res.url or "not resolved")
+
+    def do_replay(self, line):
+        """replay <file>: resolve the item recorded in a cassette file again
+        from its responses, and show whether it came out the same"""
+        fname = os.path.expanduser(line.strip())
+        try:
+            c = scraper.cassette.Cassette.load(fname)
+        except (IOError, ValueError), e:
+            error(e)
+            return
+        res = scraper.replay(c)
+        got = res and { 'url' : res.url, 'headers' : res.headers }
+        if got != c.meta.get('resolution'):
+            error("Resolved differently: %r (recorded %r)" % (
+                got, c.meta.get('resolution')))
+            return
+        print "Same as recorded: %s" % (res and res.url or "not resolved")
+
+    def do_cache(self, line):
+        "cache [clear]: show statistics for the local caches, or clear them"
+        caches = [playlist_cache, recent_playlists,
+                  scraper.proc_cache, scraper.resolutions]
+        if line.strip() == 'clear':
+            for c in caches:
+                c.clear()
+            print "Caches cleared"
+        else:
+            for c in caches:
+                print c.stats()
+            print scraper.prefetcher.stats()
+            print search.index.stats()
+
+    def do_stats(self, line):
+        """stats [clear | export <file>]: show how long requests, processors,
+        playlists and downloads have taken lately, by host and processor,
+        or save the timings as lines of JSON ('-' for the screen)"""
+        args = line.split(None, 1)
+        if args == ['clear']:
+            tracing.clear()
+            print "Timings cleared"
+            return
+        if args and args[0] == 'export' and len(args) == 2:
+            if args[1] == '-':
+                tracing.export(sys.stdout)
+                return
+            try:
+                fd = open(os.path.expanduser(args[1]), 'w')
+            except IOError, e:
+                error(e)
+                return
+            try:
+                print "%d spans written to %s" % (tracing.export(fd), args[1])
+            finally:
+                fd.close()
+            return
+        if args:
+            error("Usage: stats [clear | export <file>]")
+            return
+        kept = tracing.spans()
+        http = [s for s in kept if s.kind == 'http']
+        new = lambda s: 'connect' in s.attrs and \
+            s.attrs.get('dns', 0) + s.attrs['connect'] or None
+        ttfb = lambda s: s.attrs.get('ttfb')
+        tables = [
+            ('kind', tracing.summarize(kept, lambda s: s.kind,
+                # the time parsing took, not the caller between items
+                lambda s: s.attrs.get('busy', s.duration()))),
+            ('host', tracing.summarize(http, lambda s: s.attrs.get('host'),
+                connect=new, ttfb=ttfb)),
+            ('processor', tracing.summarize(
+                [s for s in kept if s.kind == 'resolve'],
+                lambda s: s.attrs.get('proc'))),
+        ]
+        if JSON_OUTPUT:
+            for title, rows in tables:
+                for row in rows:
+                    emit(dict(row, table=title))
+            return
+        if not kept:
+            print "Nothing timed yet"
+            return
+        ms = lambda v: v is not None and "%.1f" % (v * 1000) or "-"
+        for title, rows in tables:
+            if not rows:
+                continue
+            print
+            print "%-36s %6s %5s %8s %8s %8s %8s %8s %10s" % (title, "count",
+                "errs", "conn", "ttfb", "p50 ms", "p90 ms", "p99 ms", "KB")
+            for row in rows:
+                print "%-36s %6d %5d %8s %8s %8s %8s %8s %10d" % (
+                    row['key'][-36:], row['count'], row['errors'],
+                    ms(row.get('connect')), ms(row.get('ttfb')),
+                    ms(row['p50']), ms(row['p90']), ms(row['p99']),
+                    row['bytes'] // 1024)
+        print
+        print "(the last %d spans; conn and ttfb are medians)" % len(kept)
+
+    def do_profile(self, line):
+        """profile <command>: run a command under cProfile, then show the
+        PROFILE_LINES functions it spent longest in.  Background
+        downloads and loads aren't included."""
+        if not line.strip():
+            error("Usage: profile <command>")
+            return
+        import cProfile
+        import pstats
+        prof = cProfile.Profile()
+        try:
+            return prof.runcall(self.onecmd, line)
+        finally:
+            stats = pstats.Stats(prof, stream=sys.stdout)
+            stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+
+    def do_crawl(self, line):
+        """crawl [-s] [-d <depth>] [<num>] [to <file>]: index every playlist
+        under this one (or under item <num>) into a file, by default
+        crawler.INDEX, and with -s into the search index too.  The options
+        can come in any order; quote a file name with spaces.  Control-C
+        stops the crawl."""
+        import crawler
+        try:
+            searchable, depth, num, fname = parse_crawl(line)
+        except ValueError, e:
+            error("%s.  Usage: crawl [-s] [-d <depth>] [<num>] [to <file>]" % e)
+            return
+        root, name = self.playlist.url, self.name
+        if num is not None:
+            d = self._getd(num)
+            if d is None or d.type != 'playlist':
+                error("%s isn't a playlist" % num)
+                return
+            root, name = d['URL'], re.sub('\[\/?COLOR.*?\]', '', d['name'])
+        c = crawler.crawl(root, fname, depth, name=name,
+            indexer=searchable and search.index or None,
+            parse=parse_navix_pls)
+        if searchable:
+            search.index.save()
+        print "%d playlists, %d items written to %s (%d failed)" % (
+            c.playlists, c.items, fname or crawler.INDEX, c.failed)
+
+    def do_prefetch(self, line):
+        """prefetch [on|off]: resolve the items shown by ls and show in the
+        background, so get and play can start straight away"""
+        line = line.strip()
+        if line in ('on', 'off'):
+            scraper.prefetcher.enabled = line == 'on'
+            if line == 'off':
+                scraper.prefetcher.cancel()
+        elif line:
+            error("Usage: prefetch [on|off]")
+            return
+        print scraper.prefetcher.stats()
+
     def do_lcd(self, line):
         "lcd <dir>: change the current local directory"
         global DOWNLOADPATH
@@ -452,121 +1279,270 @@ class PlaylistCmd(BaseCmd):
 
     def do_lls(self, line):
         "list the contents of the current local directory (passing arguments to the command)"
-        if platform.system() == 'Windows':
+        if WINDOWS:
             os.system("dir %s" % line.strip())
         else:
             os.system("ls %s" % line.strip())
 
-    def do_get(self, line):
-        "get <num> [to/as <filename>]: download the specified item"
+    def get_job(self, line, segments=1):
+        """Return a downloader.Job for 'get' arguments, or None.  If
+        segments > 1, the file is downloaded over that many connections."""
         fname = None
         if re.search('\d+ (to|as) .+', line):
-            line, fname = line.split(' to ', 1)
+            line, fname = re.split(' (?:to|as) ', line, 1)
         d = self._getd(line)
         if d is None:
-            print "!! Error calling get with argument: %s" % line
-            return
-        if 'URL' in d and 'name' in d:
-            if fname:
-                if '/' not in fname:
-                    fname = os.path.abspath(os.path.join(DOWNLOADPATH, fname))
-            else:
-                fname = d['name']
-                # cleanup filename
-                fname = fname.rsplit("/",1)[-1].replace(" ","_") + ".EXT"
-                fname = re.sub(r"&amp;|[;:()\/&\[\]*%#@!?]", "_", fname)
-                fname = re.sub(r"__+","_", fname)
-                fname = re.sub(r"\.\.+",".", fname)
-                fname = fname.replace("_.", ".")
-                fname = os.path.join(DOWNLOADPATH, fname)
-            if os.path.exists(fname):
-                byterange = "Range: bytes=%s-" % (os.path.getsize(fname)+1)
-            else:
-                byterange = None
-            try:
-                if 'processor' in d:
-                    res = scraper.navix_get(d['processor'], d['URL'], byterange=byterange, verbose=0)
-                else:
-                    browser = scraper.Browser()
-                    if byterange:
-                        res = browser.get(d['URL'], Range=byterange)
-                    else:
-                        res = browser.get(d['URL'])
-                if not res:
-                    print "Could not download %s" % (d)
-                # guess extension
-                if fname.endswith(".EXT"):
-                    ext = guess_extension(res)
-                    if ext:
-                        fname = fname[:-4] + ext
-                # download the sucker
-                print "Downloading %s" % (res.geturl())
-                download(res, fname)
-            except:
-                traceback.print_exc()
+            error("Error calling get with argument: %s" % line)
+            return None
+        if 'URL' not in d or 'name' not in d:
+            error("Nothing to download for %s" % line)
+            return None
+        if fname:
+            if '/' not in fname:
+                fname = os.path.abspath(os.path.join(DOWNLOADPATH, fname))
+        else:
+            fname = re.sub('\[\/?COLOR.*?\]', '', d['name'])
+            # cleanup filename
+            fname = fname.rsplit("/",1)[-1].replace(" ","_") + ".EXT"
+            fname = re.sub(r"&amp;|[;:()\/&\[\]*%#@!?]", "_", fname)
+            fname = re.sub(r"__+","_", fname)
+            fname = re.sub(r"\.\.+",".", fname)
+            fname = fname.replace("_.", ".")
+            fname = os.path.join(DOWNLOADPATH, fname)
+
+        def fetch(job):
+            scraper.log_to(job.progress.log)
+            downloader.get_file(lambda byterange: open_item(d, byterange),
+                fname, job.progress, segments, source=d['URL'])
+        name = re.sub('\[\/?COLOR.*?\]', '', d['name'])
+        return downloader.Job(name, d['URL'], fetch, source=d['URL'],
+                              fname=os.path.abspath(fname))
+
+    def do_get(self, line):
+        """get [-s[N]] <num> [to/as <filename>]: download the specified item
+        in the background (see 'jobs')
+        -s downloads it over N connections at once (downloader.SEGMENTS
+        by default), if the server allows it"""
+        segments, line = segments_option(line)
+        job = self.get_job(line, segments)
+        if job is not None:
+            self._submit(job)
 
     def do_getall(self, line):
-        "getall <num>[;<num>][;<num> as myname.avi]: download multiple files in sequence"
+        "getall [-s[N]] <num>[;<num>][;<num> as myname.avi]: download multiple files in the background"
+        segments, line = segments_option(line)
         for x in line.split(";"):
-            self.do_get(x)
+            if x.strip(): # eg. after a trailing ;
+                self.do_get("-s%d %s" % (segments, x.strip()))
 
     def do_geturl(self, line):
-        "geturl <filename>;<url>;<processor url>: download a URL using the given processor URL"
+        "geturl [-s[N]] <filename>;<url>;<processor url>: download a URL using the given processor URL"
+        segments, line = segments_option(line)
         try:
-            filename, url, proc = line.split(";", 2)
+            filename, url, proc = [x.strip() for x in line.split(";", 2)]
         except:
-            print "Usage: geturl filename;url;processor"
+            error("Usage: geturl [-s[N]] filename;url;processor")
             return
+        def fetch(job):
+            scraper.log_to(job.progress.log)
+            downloader.get_file(
+                lambda byterange: scraper.navix_get(proc, url, byterange=byterange),
+                filename, job.progress, segments, source=url)
+        self._submit(downloader.Job(filename, url, fetch, source=url,
+                                    fname=os.path.abspath(filename)))
+
+    def _submit(self, job):
+        "Queue a download, unless it's the same as one that's unfinished"
+        queued = downloads.submit(job)
+        if queued is not job:
+            print "[%d] %s (already %s)" % (queued.id, queued.name, queued.state)
+        else:
+            print "[%d] %s" % (job.id, job.name)
+
+    def _getjob(self, line):
+        "Convert a job number (optionally with a leading %) into a Job"
         try:
-            res = scraper.navix_get(proc.strip(), url.strip(), verbose=0)
-            download(res, filename.strip())
-        except:
-            traceback.print_exc()
+            return downloads.job(int(line.strip().lstrip('%')))
+        except ValueError:
+            return None
+
+    def do_jobs(self, line):
+        "jobs: list the background downloads"
+        jobs = downloads.jobs.values()
+        if not jobs:
+            print "No downloads"
+        for job in jobs:
+            if job.state == 'running':
+                status = job.progress.line()
+            elif job.state == 'failed':
+                status = "failed: %s" % job.error
+            else:
+                status = job.state
+            print "[%d] %-40s %s" % (job.id, job.name[:40], status)
+        # like a shell, finished jobs are only listed once
+        downloads.forget([job for job in jobs if job.finished()])
+
+    def do_fg(self, line):
+        "fg [<job>]: watch a background download (the latest by default) until it's done; Control-C stops watching"
+        if line.strip():
+            job = self._getjob(line)
+        else:
+            job = (downloads.unfinished() or [None])[-1]
+        if job is None:
+            error("No such download: %s" % line)
+            return
+        if job.finished():
+            print "[%d] %s %s" % (job.id, job.state, job.name)
+        else:
+            downloads.watch([job])
+
+    def do_kill(self, line):
+        "kill <job>: cancel a background download; it can be resumed by getting it again"
+        job = self._getjob(line)
+        if job is None:
+            error("No such download: %s" % line)
+            return
+        downloads.cancel([job])
+
+    def do_wait(self, line):
+        "wait: watch the background downloads until they're all done; Control-C stops watching"
+        jobs = downloads.unfinished()
+        if jobs and downloads.watch(jobs):
+            print "Downloaded %d of %d" % (
+                len([job for job in jobs if job.state == 'done']), len(jobs))
 
     def do_play(self, line):
-        "Try to play this video using mplayer (stream from stdin)"
-        if platform.system() == 'Windows':
-            print "!! No streaming support on Windows, sorry. Try 'get' instead."
+        """play <num>: Try to play this video using mplayer (streamed to its stdin)
+        The first streaming.PREFILL bytes are buffered before the player
+        starts, and up to streaming.BUFFER_SIZE are read ahead of it."""
+        if WINDOWS:
+            error("No streaming support on Windows, sorry. Try 'get' instead.")
             return
         d = self._getd(line)
         if d is None:
-            print "!! Error calling play with argument: %s" % line
+            error("Error calling play with argument: %s" % line)
             return
         res = None
         if 'processor' in d and 'URL' in d:
             res = scraper.navix_get(d['processor'], d['URL'], verbose=0)
         elif 'URL' in d:
-            res = urllib.urlopen(request(d['URL']))
+            res = scraper.shared_browser().get(d['URL'])
         if res:
-            mplayer = Popen(['mplayer', '-cache-min', '5', '-noconsolecontrols', '-cache', '2048', '/dev/stdin'], stdin=PIPE)
-            while True:
-                bytes = res.read(16384)
-                if not bytes:
-                    break
-                try:
-                    mplayer.stdin.write(bytes)
-                except:
-                    res.close()
-                    break
-            mplayer.stdin.close()
+            streaming.play(res, PLAYER_CMD, d.name)
         else:
-            print "Missing some info required to play"
+            error("Missing some info required to play")
+
+    def start_proxy(self, port=None):
+        """Start the proxy if it isn't running, returning its URL, or None.
+        If the port's taken, it's assumed to be proxy.py's."""
+        global proxy_server
+        import socket
+        import errno
+        if proxy_server is None:
+            if port is None:
+                port = proxy.PORT
+            try:
+                proxy_server = proxy.start(port)
+            except socket.error, e:
+                if e.errno != errno.EADDRINUSE:
+                    error("Can't start the proxy: %s" % e)
+                    return None
+                return "http://%s:%d" % (proxy.ADDRESS, port)
+            if not BATCH:
+                print "Proxy started on %s" % proxy_server.base()
+        return proxy_server.base()
+
+    def do_proxy(self, line):
+        """proxy [start [<port>] | stop]: run a local HTTP proxy that plays
+        items at URLs of their own, resolving them when they're first
+        played, with seeking.  Shows its URL."""
+        global proxy_server
+        args = line.split()
+        if args == ['stop']:
+            if proxy_server is not None:
+                proxy_server.shutdown()
+                proxy_server.server_close()
+                proxy_server = None
+            print "Proxy stopped"
+        elif args[:1] == ['start'] and len(args) <= 2:
+            if len(args) == 2 and not args[1].isdigit():
+                error("Usage: proxy [start [<port>] | stop]")
+                return
+            self.start_proxy(int(args[1]) if len(args) == 2 else None)
+        elif args:
+            error("Usage: proxy [start [<port>] | stop]")
+        elif proxy_server is None:
+            print "Proxy not running"
+        else:
+            print "Proxy running on %s" % proxy_server.base()
+
+    def do_m3u(self, line):
+        """m3u [<file>]: write the video and audio items of this playlist to
+        an M3U playlist (navix.m3u by default, '-' for the screen) that
+        plays them through the proxy, starting it if need be.  Items are
+        only resolved when they're played."""
+        fname = line.strip() or "navix.m3u"
+        base = self.start_proxy()
+        if base is None:
+            return
+        items = [(re.sub('\[\/?COLOR.*?\]', '', d.name or d['URL']), d['URL'],
+                  d.get('processor'))
+                 for d in self.playlist
+                 if d.type in ('video', 'audio') and 'URL' in d]
+        if fname == '-':
+            proxy.m3u(sys.stdout, base, items)
+            return
+        try:
+            fd = open(os.path.expanduser(fname), 'w')
+        except IOError, e:
+            error(e)
+            return
+        try:
+            proxy.m3u(fd, base, items)
+        finally:
+            fd.close()
+        print "%d items written to %s" % (len(items), fname)
 
     # nice for developing scraper.py
     def do_reload_scraper(self, line):
-        reload(scraper)
+        global scraper
+        scraper = reload(__import__('scraper'))
 # PlaylistCmd
 
 
 def main(args):
-    global DOWNLOADPATH, PAGER_CMD, PLSEARCHPATH, homedir
+    """Run the shell, or with -c or --script run commands without it.
+    Returns the exit status: 0 if everything worked, 1 if a command or
+    download failed (2 for bad options)."""
+    global DOWNLOADPATH, PAGER_CMD, PLSEARCHPATH, homedir, BATCH, JSON_OUTPUT
+    import optparse
+    from StringIO import StringIO
+    parser = optparse.OptionParser(
+        usage="%prog [options] [<playlist url or file>]")
+    parser.add_option("-c", "--command", metavar="COMMANDS",
+        help="run the commands (separated by '; ' or newlines) and exit")
+    parser.add_option("--script", metavar="FILE",
+        help="run the commands in FILE ('-' for standard input) and exit")
+    parser.add_option("-j", "--json", action="store_true",
+        help="print ls, show and resolve results as JSON, an object per line")
+    parser.add_option("--trace", metavar="FILE",
+        help="append the timings of requests, processors, playlists and "
+             "downloads to FILE as lines of JSON")
+    options, args = parser.parse_args(args[1:])
+    if len(args) > 1:
+        parser.error("expected one playlist")
+    BATCH = options.command is not None or options.script is not None
+    JSON_OUTPUT = bool(options.json)
+    if options.trace:
+        tracing.TRACE_FILE = os.path.abspath(options.trace)
+    load_session()
     # set the default playlist
 
-    if len(sys.argv) > 1:
-        if os.path.exists(sys.argv[1]):
-            pl = Playlist("file://"+sys.argv[1])
+    if args:
+        if os.path.exists(args[0]):
+            pl = load_playlist("file://"+args[0])
         else:
-            pl = Playlist(sys.argv[1])
+            pl = load_playlist(args[0])
     else:
         localpl = None
         for plfile in PLSEARCHPATH:
@@ -575,10 +1551,11 @@ def main(args):
                 localpl = "file://"+plfile
                 break
         if localpl:
-            print "Using local playlist %s" % localpl
-            pl = Playlist(localpl)
+            if not BATCH:
+                print "Using local playlist %s" % localpl
+            pl = load_playlist(localpl)
         else:
-            pl = Playlist("http://navix.turner3d.net/playlist/index.plx")
+            pl = load_playlist("http://navix.turner3d.net/playlist/index.plx")
     if not os.access(DOWNLOADPATH, os.W_OK):
         # find a writable download directory
         for x in ('~/Downloads', '~/My Downloads', '~/Videos', '~'):
@@ -590,10 +1567,44 @@ def main(args):
     chdir(DOWNLOADPATH, False)
 
     # load & run the playlist menu
-    plc = PlaylistCmd("index", pl)
+    if options.command is not None:
+        plc = PlaylistCmd("index", pl, stdin=StringIO())
+        plc.cmdqueue = re.split(r';\s+|\n', options.command)
+    elif options.script == '-':
+        plc = PlaylistCmd("index", pl, stdin=sys.stdin)
+    elif options.script is not None:
+        try:
+            plc = PlaylistCmd("index", pl, stdin=open(options.script))
+        except IOError, e:
+            parser.error(e)
+    else:
+        plc = PlaylistCmd("index", pl)
     plc.__isindex = True # used in 'cd /'
-    plc.onecmd("ls")
+    if BATCH:
+        plc.use_rawinput = False
+    else:
+        plc.onecmd("ls")
     plc.cmdloop()
+    failed = []
+    if loaded(downloads):
+        if BATCH:
+            # finish the downloads the commands started; Control-C cancels them
+            try:
+                downloads.wait(downloads.unfinished())
+            except KeyboardInterrupt:
+                pass
+        # stop any downloads cleanly, so they can be resumed next time
+        jobs = downloads.unfinished()
+        if jobs:
+            downloads.cancel(jobs)
+        for msg in downloads.board.take_held():
+            print msg
+        failed = [job for job in downloads.jobs.values() if job.state != 'done']
+    save_session(pl)
+    search.index.save()
+    if not BATCH:
+        return 0
+    return (errors or failed) and 1 or 0
 
 if __name__ == '__main__':
-    main(sys.argv)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,259 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Compiler for Navi-X v2 processor scripts (NIPL)
+
+A script is turned into a flat list of instructions, each a tuple whose
+first element is one of the OP_* opcodes below.  Conditional blocks are
+compiled into OP_IF / OP_JUMP instructions with resolved targets, and
+conditions into plain functions of the variable dictionary, so running a
+phase is a simple loop over the program with no parsing and no eval().
+
+Compiled programs are cached by the SHA1 of their source; use
+get_program() rather than compile_nipl() directly.
+"""
+
+import re
+import hashlib
+import operator
+import threading
+from collections import OrderedDict
+
+PROGRAM_CACHE_SIZE = 128 # number of compiled scripts to keep
+
+# opcodes
+OP_ASSIGN = 1      # (op, name, operand)
+OP_SCRAPE = 2      # (op,)
+OP_PLAY = 3        # (op,)
+OP_REPORT = 4      # (op,)
+OP_IF = 5          # (op, condition, target if false)
+OP_JUMP = 6        # (op, target)
+OP_VERBOSE = 7     # (op, level)
+OP_ERROR = 8       # (op, message)
+OP_REPORT_VAL = 9  # (op, name, operand)
+OP_CONCAT = 10     # (op, name, operand)
+OP_MATCH = 11      # (op, name)
+OP_REPLACE = 12    # (op, name, operand)
+OP_UNESCAPE = 13   # (op, name)
+OP_DEBUG = 14      # (op, name)
+OP_PRINT = 15      # (op, operand)
+OP_SYNTAX = 16     # (op, line) - report a syntax error when reached
+OP_UNKNOWN = 17    # (op, method)
+
+# command parser
+lparse = re.compile('^([^ =]+)([ =])(.+)$')
+# condition parser
+ifparse = re.compile('^([^<>=!]+)\s*([!<>=]+)\s*(.+)$')
+
+OPERATORS = {
+    '=' : operator.eq,
+    '==' : operator.eq,
+    '!=' : operator.ne,
+    '<>' : operator.ne,
+    '<' : operator.lt,
+    '<=' : operator.le,
+    '>' : operator.gt,
+    '>=' : operator.ge,
+}
+
+_programs = OrderedDict()
+_programs_lock = threading.Lock()
+
+class Program(object):
+    """A compiled NIPL script"""
+    __slots__ = ('digest', 'source', 'code')
+
+    def __init__(self, digest, source, code):
+        self.digest = digest
+        self.source = source
+        self.code = code
+
+    def __len__(self):
+        return len(self.code)
+
+    def __repr__(self):
+        return 'Program(%s, %d instructions)' % (self.digest[:8], len(self.code))
+# Program
+
+def operand(arg):
+    """Compile a value reference into (literal, text)
+
+    A leading quote means the rest of the argument is a literal string,
+    otherwise it names a variable."""
+    if arg[:1] == "'":
+        return (True, arg[1:])
+    return (False, arg)
+
+def value(v, opnd):
+    "Return the value of a compiled operand"
+    if opnd[0]:
+        return opnd[1]
+    return v.get(opnd[1], '')
+
+def compile_condition(arg):
+    """Compile the argument of an if/elseif into a function of the
+    variable dictionary, or return None if it cannot be compiled."""
+    match = ifparse.search(arg)
+    if match is None:
+        # single argument: true if the variable is set
+        def cond(v, key=arg):
+            return bool(v.get(key, ''))
+        return cond
+    lkey = match.group(1).rstrip()
+    oper = OPERATORS.get(match.group(2))
+    if oper is None:
+        return None
+    rside = operand(match.group(3))
+    if rside[0]:
+        def cond(v, lkey=lkey, oper=oper, rval=rside[1]):
+            return oper(v.get(lkey, ''), rval)
+    else:
+        def cond(v, lkey=lkey, oper=oper, rkey=rside[1]):
+            return oper(v.get(lkey, ''), v.get(rkey, ''))
+    return cond
+
+def compile_command(line, subj, arg):
+    "Compile a 'method argument' line into a single instruction"
+    if subj == 'verbose':
+        try: level = int(arg)
+        except: level = 0
+        return (OP_VERBOSE, level)
+    elif subj == 'error':
+        return (OP_ERROR, arg[1:])
+    elif subj in ('report_val', 'concat', 'replace'):
+        match = lparse.search(arg)
+        if match is None:
+            return (OP_SYNTAX, line)
+        op = { 'report_val' : OP_REPORT_VAL,
+               'concat' : OP_CONCAT,
+               'replace' : OP_REPLACE }[subj]
+        return (op, match.group(1), operand(match.group(3)))
+    elif subj == 'match':
+        return (OP_MATCH, arg)
+    elif subj == 'unescape':
+        return (OP_UNESCAPE, arg)
+    elif subj == 'debug':
+        return (OP_DEBUG, arg)
+    elif subj == 'print':
+        return (OP_PRINT, operand(arg))
+    return (OP_UNKNOWN, subj)
+
+def compile_nipl(source, digest=None):
+    """Compile the NIPL source of a single phase into a Program
+
+    Lines are stripped of leading whitespace only, as trailing whitespace
+    may be part of a literal.  Lines that don't parse are compiled into
+    OP_SYNTAX instructions so that, like before, a syntax error is only
+    reported if that line is actually reached."""
+    if digest is None:
+        digest = hashlib.sha1(source).hexdigest()
+    code = []
+    blocks = [] # stack of [pending OP_IF index, [OP_JUMP indices]]
+
+    def patch(idx, target):
+        ins = code[idx]
+        code[idx] = ins[:-1] + (target,)
+
+    for line in source.splitlines():
+        line = line.lstrip()
+        if not line or line[:1] == '#':
+            continue
+        if line == 'scrape':
+            code.append((OP_SCRAPE,))
+        elif line == 'play':
+            code.append((OP_PLAY,))
+        elif line == 'report':
+            code.append((OP_REPORT,))
+        elif line == 'else':
+            if not blocks:
+                continue
+            block = blocks[-1]
+            # the end of the previous branch skips to the endif
+            block[1].append(len(code))
+            code.append((OP_JUMP, None))
+            if block[0] is not None:
+                patch(block[0], len(code))
+            block[0] = None
+        elif line == 'endif':
+            if not blocks:
+                continue
+            pending, jumps = blocks.pop()
+            if pending is not None:
+                patch(pending, len(code))
+            for idx in jumps:
+                patch(idx, len(code))
+        else:
+            match = lparse.search(line)
+            if match is None:
+                code.append((OP_SYNTAX, line))
+                continue
+            subj = match.group(1)
+            arg = match.group(3)
+            if subj == 'if' or subj == 'elseif' or subj == 'elsif':
+                cond = compile_condition(arg)
+                if cond is None:
+                    code.append((OP_SYNTAX, line))
+                    continue
+                if subj == 'if':
+                    blocks.append([len(code), []])
+                elif blocks:
+                    block = blocks[-1]
+                    block[1].append(len(code))
+                    code.append((OP_JUMP, None))
+                    if block[0] is not None:
+                        patch(block[0], len(code))
+                    block[0] = len(code)
+                else:
+                    # an elseif without an if behaves like an if
+                    blocks.append([len(code), []])
+                code.append((OP_IF, cond, None))
+            elif match.group(2) == '=':
+                code.append((OP_ASSIGN, subj, operand(arg)))
+            else:
+                code.append(compile_command(line, subj, arg))
+    # unterminated blocks end with the script
+    while blocks:
+        pending, jumps = blocks.pop()
+        if pending is not None:
+            patch(pending, len(code))
+        for idx in jumps:
+            patch(idx, len(code))
+    return Program(digest, source, tuple(code))
+
+def get_program(source):
+    "Return the compiled Program for source, compiling it only once"
+    digest = hashlib.sha1(source).hexdigest()
+    with _programs_lock:
+        prog = _programs.get(digest)
+        if prog is not None:
+            # keep recently used programs at the end
+            del _programs[digest]
+            _programs[digest] = prog
+            return prog
+    prog = compile_nipl(source, digest)
+    with _programs_lock:
+        _programs[digest] = prog
+        while len(_programs) > PROGRAM_CACHE_SIZE:
+            _programs.popitem(last=False)
+    return prog
+
+def clear_cache():
+    "Forget all compiled programs"
+    with _programs_lock:
+        _programs.clear()
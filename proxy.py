@@ -0,0 +1,233 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""A local HTTP proxy that resolves Navi-X items as they're played
+
+Each item has a URL on the proxy that holds its URL and processor:
+
+    http://127.0.0.1:<PORT>/item/<name>?url=<URL>&proc=<processor>
+
+so the proxy keeps no state of its own, and the URLs stay the same
+across restarts.  The first request for an item resolves it through
+its processor with navix_get(), which remembers the resolution for
+scraper.RESOLVE_TTL seconds, and the media is passed on as it arrives.
+Range requests are passed through, so players can seek.  m3u() writes
+a playlist of such URLs, so only what's played is ever resolved.
+
+The proxy fetches whatever http(s) URL it's asked to (never a file or
+other scheme), so it only listens on ADDRESS, this machine, unless
+told otherwise.
+
+    python proxy.py [-p <port>] [-a <address>] [-q]
+"""
+
+import re
+import sys
+import socket
+import urllib
+import urllib2
+import threading
+import BaseHTTPServer
+import SocketServer
+from urlparse import urlparse, parse_qs
+
+import scraper
+import tracing
+import downloader
+
+PORT = 8642           # where the proxy listens by default
+ADDRESS = '127.0.0.1' # only this machine can use the proxy
+CHUNK = 1 << 16       # bytes passed on to the player at a time
+# the media's headers that are passed on to the player
+PASS_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range',
+                'Accept-Ranges', 'Last-Modified', 'ETag')
+SCHEMES = ('http', 'https') # the only URLs items and processors can have
+
+def utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+def item_url(base, url, proc=None, name=None):
+    """The URL of an item on the proxy at base (eg. http://127.0.0.1:8642).
+    The name is only there to make it readable."""
+    slug = re.sub(r'[^\w.-]+', '_', utf8(name or '')).strip('_')[:60] or 'item'
+    query = [('url', utf8(url))]
+    if proc:
+        query.append(('proc', utf8(proc)))
+    return "%s/item/%s?%s" % (base, slug, urllib.urlencode(query))
+
+def m3u(fd, base, items):
+    """Write an M3U playlist of (name, url, proc) items, played through
+    the proxy at base"""
+    fd.write("#EXTM3U\n")
+    for name, url, proc in items:
+        fd.write("#EXTINF:-1,%s\n%s\n" % (utf8(name).replace("\n", " "),
+                                           item_url(base, url, proc, name)))
+
+def open_item(url, proc=None, byterange=None):
+    """Return an open response for an item's media (or None if it can't be
+    resolved), resolving it through its processor if it has one"""
+    if proc:
+        return scraper.navix_get(proc, url, byterange=byterange)
+    browser = scraper.shared_browser()
+    if byterange:
+        return browser.get(url, Range=byterange)
+    return browser.get(url)
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1 # send the headers with the body, not a packet each
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        u = urlparse(self.path)
+        q = parse_qs(u.query)
+        if not u.path.startswith('/item/') or 'url' not in q:
+            return self.reply(404, "Not an item")
+        url = q['url'][0]
+        proc = q.get('proc', [None])[0]
+        for target in filter(None, (url, proc)):
+            if urlparse(target).scheme.lower() not in SCHEMES:
+                return self.reply(400, "Not an http(s) URL: %s" % target)
+        if not self.server.verbose:
+            scraper.log_to(None)
+        span = tracing.span('proxy', url, proc=proc)
+        try:
+            res = open_item(url, proc, self.headers.get('Range'))
+        except urllib2.HTTPError, e:
+            res = e # pass the error on, eg. 416 for a range past the end
+        except (urllib2.URLError, socket.error, IOError), e:
+            span.finish(error=tracing.describe(e))
+            return self.reply(502, "Can't fetch %s: %s" % (url, e))
+        if res is None:
+            span.finish(error="not resolved")
+            return self.reply(502, "Can't resolve %s" % url)
+        status = res.getcode()
+        if status is None: # eg. a processor resolved it to a file:// URL
+            res.close()
+            span.finish(error="no status")
+            return self.reply(502, "No HTTP response for %s" % url)
+        copied = 0
+        try:
+            self.send_response(status)
+            headers = res.info()
+            for name in PASS_HEADERS:
+                if name in headers:
+                    self.send_header(name, headers[name])
+            if 'Content-Length' not in headers:
+                self.close_connection = 1 # the end is the end of the media
+            self.end_headers()
+            if self.command != 'HEAD':
+                copied = self.copy(res)
+            self.wfile.flush()
+        except socket.error, e:
+            # the player went away, eg. seeking to another range
+            self.close_connection = 1
+            span.set(error=tracing.describe(e))
+        finally:
+            res.close()
+            span.finish(status=status, bytes=copied)
+
+    def copy(self, res):
+        "Pass the body of res on to the player, returning its length"
+        self.wfile.flush() # the headers
+        readinto = downloader.readinto_of(res)
+        view = memoryview(bytearray(CHUNK))
+        copied = 0
+        while True:
+            if readinto is not None:
+                n = readinto(view)
+            else:
+                data = res.read(CHUNK)
+                n = len(data)
+                view[:n] = data
+            if not n:
+                return copied
+            self.connection.sendall(view[:n])
+            copied += n
+
+    def reply(self, code, msg):
+        body = msg + "\n"
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+# Handler
+
+class Proxy(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    verbose = False # log each request, and the processors' messages
+
+    def handle_error(self, request, client_address):
+        if self.verbose:
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def base(self):
+        "The URL of the proxy, that item URLs go under"
+        return "http://%s:%d" % self.server_address
+# Proxy
+
+def start(port=None, address=None, verbose=False):
+    "Start a proxy on a background thread, returning it"
+    if port is None:
+        port = PORT
+    if address is None:
+        address = ADDRESS
+    proxy = Proxy((address, port), Handler)
+    proxy.verbose = verbose
+    t = threading.Thread(target=proxy.serve_forever, name="Proxy")
+    t.daemon = True
+    t.start()
+    return proxy
+
+def main(args):
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [-p <port>] [-a <address>] [-q]")
+    parser.add_option("-p", "--port", type="int", default=PORT,
+        help="port to listen on (%default)")
+    parser.add_option("-a", "--address", default=ADDRESS,
+        help="address to listen on (%default)")
+    parser.add_option("-q", "--quiet", action="store_true",
+        help="don't log requests")
+    options, args = parser.parse_args(args[1:])
+    try:
+        proxy = Proxy((options.address, options.port), Handler)
+    except socket.error, e:
+        print "Can't listen on %s:%d: %s" % (options.address, options.port, e)
+        return 1
+    proxy.verbose = not options.quiet
+    print "Proxying on %s" % proxy.base()
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
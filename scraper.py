@@ -20,15 +20,64 @@
 import re
 import sys
 import time
+import Queue
 import urllib
 import urllib2
 import os.path
 import hashlib
 import cookielib
+import threading
+from collections import deque
 from urllib import quote, quote_plus, unquote
+#
+import nipl # the NIPL compiler
+import cache
+import tracing
+import cassette
+import keepalive
 
 USER_AGENT="Mozilla/5.0 (Windows; U; Windows NT 6.1; ru; rv:1.9.2b5) Gecko/20091204 Firefox/3.6b5"
 
+# Processor scripts and the output of each 'report' phase are cached for
+# this many seconds before being revalidated.  Set to None to disable, or
+# add per-processor values to proc_cache.ttls (keyed by URL prefix).
+PROC_TTL = 1800
+proc_cache = cache.HTTPCache('proc', ttl=lambda: PROC_TTL)
+
+# Resolved items are remembered for this many seconds.  Add per-processor
+# values to resolutions.ttls (keyed by URL prefix); 0 disables.
+RESOLVE_TTL = 300
+resolutions = cache.ExpiringCache('resolutions', ttl=lambda: RESOLVE_TTL)
+
+# Prefetching resolves the items shown by 'ls' and 'show' in the
+# background, PREFETCH_WORKERS at a time, and at most PREFETCH_LIMIT
+# items from each listing.
+PREFETCH = False
+PREFETCH_WORKERS = 2
+PREFETCH_LIMIT = 20
+
+# 'resolve' with several items resolves up to RESOLVE_WORKERS at once
+RESOLVE_WORKERS = 8
+
+# used to tidy up the arguments of a NIPL 'report'
+_report_empty_v = re.compile('v\d+=&')
+_report_amps = re.compile('&+')
+_report_lead = re.compile('^&')
+
+_log = threading.local()
+
+def log(msg):
+    "Print a message about processing, or pass it to the thread's log_to() function"
+    func = getattr(_log, 'func', log)
+    if func is log:
+        print msg
+    elif func is not None:
+        func(msg)
+
+def log_to(func):
+    "Send this thread's processing messages to func(msg), or discard them if None"
+    _log.func = func
+
 def get_match(regex, content, num=1):
     m = re.search(regex, content, re.I)
     try:
@@ -37,11 +86,40 @@ def get_match(regex, content, num=1):
         return None
 
 class Browser(object):
-    def __init__(self, ua=USER_AGENT, refpolicy=0, headers=None):
+    """Makes requests with a cookie jar and a pool of keep-alive
+    connections.  Use shared_browser() for the session's instance.
+
+    With a cassette, requests and responses are recorded to it, or
+    replayed from it without the network, and processors skip proc_cache
+    so every request they make is on the cassette."""
+    def __init__(self, ua=USER_AGENT, refpolicy=0, headers=None, pool=None):
         self.user_agent = ua
         self.cookiejar = cookielib.CookieJar()
         self.headers = headers or {}
         self.refpolicy = 0
+        self.pool = pool or keepalive.ConnectionPool()
+        self.opener = keepalive.build_opener(self.pool)
+        self.cassette = None
+        self.replaying = False
+    def record(self, cassette):
+        "Record requests and responses (with their bodies) to a Cassette"
+        self.cassette = cassette
+        self.replaying = False
+    def replay(self, cassette):
+        "Answer requests from a Cassette rather than the network"
+        self.cassette = cassette
+        self.replaying = True
+    def open(self, req):
+        "Open a request, through the cassette if there is one"
+        if self.cassette is None:
+            return self.opener.open(req)
+        if self.replaying:
+            return self.cassette.play(req)
+        try:
+            res = self.opener.open(req)
+        except urllib2.HTTPError, e:
+            raise self.cassette.record(req, e)
+        return self.cassette.record(req, res)
     def make_request(self, url, referer=None, ua=USER_AGENT, data=None,
                      cookies=None, **kwargs):
         d = { "User-Agent" : self.user_agent }
@@ -57,53 +135,249 @@ class Browser(object):
         return r
     def get(self, url, *args, **kwargs):
         req = self.make_request(url, *args, **kwargs)
-        res = urllib2.urlopen(req)
+        span = tracing.span('http', url, host=req.get_host())
+        try:
+            res = self.open(req)
+        except Exception, e:
+            span.finish(status=getattr(e, 'code', None), error=tracing.describe(e))
+            raise
         #print "Requested %s" % url
         self.cookiejar.extract_cookies(res, req)
+        span.set(status=res.getcode(), **getattr(res, 'timing', {}))
+        when_done = getattr(getattr(res, 'fp', None), 'when_done', None)
+        if when_done is None:
+            span.finish()
+        else:
+            # the span lasts until the body's been read
+            ready = time.time()
+            when_done(lambda nbytes: span.finish(bytes=nbytes,
+                                                 body=time.time() - ready))
         return res
+    def resolution(self, url, **kwargs):
+        """Return a Resolution for url and the given headers, capturing
+        any cookies from the jar that a request for url would send"""
+        if 'Cookie' not in kwargs:
+            r = urllib2.Request(url)
+            self.cookiejar.add_cookie_header(r)
+            cookie = r.get_header('Cookie')
+            if cookie:
+                kwargs['Cookie'] = cookie
+        return Resolution(url, kwargs)
     def add_cookie(cookie):
         pass
 
-def navix_get(procurl, url, browser=None, _ttl=5, byterange=None, verbose=0):
-        "Use Navi-X's processors to return an open request for a url"
+_shared_browser = None
+
+def shared_browser():
+    "Return the Browser shared by the whole session"
+    global _shared_browser
+    if _shared_browser is None:
+        _shared_browser = Browser()
+    return _shared_browser
+
+class Resolution(object):
+    """The final URL of an item, and the headers (including any Cookie)
+    needed to fetch it"""
+    __slots__ = ('url', 'headers')
+
+    def __init__(self, url, headers=None):
+        self.url = url
+        self.headers = headers or {}
+
+    def __repr__(self):
+        return 'Resolution(%r, %r)' % (self.url, self.headers)
+
+    def open(self, browser, byterange=None):
+        "Return an open request for the final URL"
+        kwargs = dict(self.headers)
+        if byterange is not None:
+            kwargs['Range'] = byterange
+        return browser.get(self.url, **kwargs)
+# Resolution
+
+def navix_get(procurl, url, browser=None, byterange=None, verbose=0):
+    """Use Navi-X's processors to return an open request for a url
+
+    The resolution is remembered in the resolutions cache for
+    RESOLVE_TTL seconds (overridable per processor URL prefix in
+    resolutions.ttls), and forgotten if the final URL returns 403/404.
+    It's then resolved again, once, without the processors' cached
+    output, which may be what gave the stale URL."""
+    if browser is None:
+        browser = shared_browser()
+    key = (procurl, url)
+    prefetcher.wait(key)
+    fresh = False
+    res = resolutions.get(key)
+    if res is not None:
+        if verbose:
+            log("Using cached resolution %r" % res.url)
+        try:
+            return res.open(browser, byterange)
+        except urllib2.HTTPError, e:
+            if e.code not in (403, 404):
+                raise
+            resolutions.invalidate(key)
+            fresh = True
+    while True:
+        res = navix_resolve(procurl, url, browser, verbose=verbose, fresh=fresh)
+        if res is None:
+            return None
+        resolutions.put(key, res)
+        try:
+            return res.open(browser, byterange)
+        except urllib2.HTTPError, e:
+            if e.code not in (403, 404):
+                raise
+            resolutions.invalidate(key)
+            if fresh:
+                raise
+            if verbose:
+                log("Got %d, resolving again" % e.code)
+            fresh = True
+
+def resolve(procurl, url, browser=None, verbose=0):
+    """Use Navi-X's processors to return the Resolution for a url (or
+    None), remembering it like navix_get() without fetching it"""
+    key = (procurl, url)
+    prefetcher.wait(key)
+    res = resolutions.get(key)
+    if res is None:
+        res = navix_resolve(procurl, url, browser, verbose=verbose)
+        if res is not None:
+            resolutions.put(key, res)
+    return res
+
+def resolve_all(keys, workers=None, browser=None):
+    """Resolve (processor, url) keys as resolve() does, up to workers
+    (RESOLVE_WORKERS by default) at a time, yielding (index of the key,
+    Resolution or None, exception or None, processing messages) for each
+    as it's done.  Closing the generator (or Control-C) stops the keys
+    not yet started."""
+    if workers is None:
+        workers = RESOLVE_WORKERS
+    todo = deque(enumerate(keys))
+    count = len(todo)
+    done = Queue.Queue()
+    def work():
+        while True:
+            try:
+                i, key = todo.popleft()
+            except IndexError:
+                return
+            msgs = []
+            log_to(msgs.append) # to be shown with the result
+            try:
+                res, err = resolve(key[0], key[1], browser), None
+            except Exception, e:
+                res, err = None, e
+            done.put((i, res, err, msgs))
+    for n in xrange(min(workers, count)):
+        t = threading.Thread(target=work, name="Resolver")
+        t.daemon = True
+        t.start()
+    try:
+        for n in xrange(count):
+            result = None
+            while result is None:
+                try:
+                    # with a timeout, so Control-C isn't held up
+                    result = done.get(True, 0.5)
+                except Queue.Empty:
+                    pass
+            yield result
+    finally:
+        todo.clear()
+
+def record(procurl, url, fname, verbose=0):
+    """Resolve url with a Browser of its own, saving every request and
+    response to a cassette file, with the resolution.  Returns the
+    Resolution or None."""
+    c = cassette.Cassette(meta={ 'processor' : procurl, 'url' : url,
+                                 'recorded' : time.strftime('%Y-%m-%d %H:%M:%S') })
+    browser = Browser()
+    browser.record(c)
+    res = navix_resolve(procurl, url, browser, verbose=verbose)
+    c.meta['resolution'] = res and { 'url' : res.url, 'headers' : res.headers }
+    c.save(fname)
+    return res
+
+def replay(c, browser=None, verbose=0):
+    """Resolve the item recorded on a Cassette again from its responses,
+    without the network, with a new Browser or the given one (clearing
+    its cookies).  Returns the Resolution or None."""
+    c.rewind()
+    if browser is None:
+        browser = Browser()
+    browser.cookiejar.clear()
+    browser.replay(c)
+    return navix_resolve(c.meta['processor'], c.meta['url'], browser,
+                         verbose=verbose)
+
+def fetch_proc(browser, url, fresh=False):
+    """Fetch a processor's script or output, through proc_cache unless the
+    browser has a cassette.  If fresh, what's cached for url is dropped
+    and it's fetched again."""
+    if browser.cassette is not None:
+        return browser.get(url).read()
+    if fresh:
+        proc_cache.invalidate(url)
+    return proc_cache.fetch(browser, url)
+
+def navix_resolve(procurl, url, browser=None, verbose=0, fresh=False):
+    """Use Navi-X's processors to work out the final URL for a url,
+    returning a Resolution or None, without fetching the final URL.
+    If fresh, proc_cache isn't used for anything it already has."""
+    with tracing.span('resolve', url, proc=procurl) as span:
+        res = _navix_resolve(procurl, url, browser, verbose=verbose,
+                             fresh=fresh)
+        if res is None:
+            span.set(error="not resolved")
+        return res
+
+def _navix_resolve(procurl, url, browser=None, _ttl=5, verbose=0, fresh=False):
         # Much of the code in this function was originally taken from the
         # Navi-X project, which is GPLv2 licensed.
         # See: http://code.google.com/p/navi-x/
         if not _ttl:
-            print "In a loop!"
+            log("In a loop!")
             return None
         if browser is None:
-            browser = Browser()
+            browser = shared_browser()
         if not isinstance(browser, Browser):
-            print `browser`
+            log(`browser`)
         if url.startswith("http://") or url.startswith("https://"):
             gurl = "%s?url=%s" % (procurl, quote_plus(url))
         else: # pre-quoted
             gurl = "%s?%s" % (procurl, url)
         if verbose:
-            print "Fetching %r" % gurl
-        htmRaw = browser.get(gurl).read()
+            log("Fetching %r" % gurl)
+        span = tracing.begin('phase', procurl, phase=6 - _ttl)
+        htmRaw = fetch_proc(browser, gurl, fresh)
         proc = htmRaw.splitlines()
         if not proc:
             return None
         if not proc[0].startswith("v2"):
             # Handle the simple/old way of doing regex parsing on a URL and
             # returning the regex matches as v1, v2, etc. to the processor.
-            if verbose:
-                print "Fetching %r" % proc[0]
-            if byterange is not None:
-                v1 = browser.get(proc[0], Range=byterange)
-            else:
-                v1 = browser.get(proc[0])
             if len(proc) == 1:
-                return v1 # the final url
-            m = re.search(proc[1], v1.read())
+                return browser.resolution(proc[0]) # the final url
+            if verbose:
+                log("Fetching %r" % proc[0])
+            htmRaw = browser.get(proc[0]).read()
+            with tracing.span('regex', proc[1], bytes=len(htmRaw)):
+                m = re.search(proc[1], htmRaw)
+            span.finish()
+            if m is None:
+                log("Processor scrape: no match")
+                return None
             i = 0
             parts = []
             for g in m.groups():
                 i += 1
                 parts.append("v%s=%s" % (i, quote_plus(g)))
-            return navix_get(procurl, "&".join(parts), browser, _ttl=_ttl-1, byterange=byterange)
+            return _navix_resolve(procurl, "&".join(parts), browser, _ttl=_ttl-1,
+                                  verbose=verbose, fresh=fresh)
         #
         # v2 script: a DSL for scraping webpages
         # http://navix.turner3d.net/proc_docs/
@@ -115,7 +389,7 @@ def navix_get(procurl, url, browser=None, _ttl=5, byterange=None, verbose=0):
         exflag = False
         phase1complete = False
         proc_args = ''
-        inst_prev = ''
+        digest_prev = None
         def_agent='Mozilla/5.0 (Windows; U; Windows NT 5.1; en-US; rv:1.9.0.4) Gecko/2008102920 Firefox/3.0.4'
         #
         v_defaults = {
@@ -135,78 +409,58 @@ def navix_get(procurl, url, browser=None, _ttl=5, byterange=None, verbose=0):
                 'pageurl':''
         }
         v = v_defaults.copy()
-        # command parser
-        lparse=re.compile('^([^ =]+)([ =])(.+)$')
-        # condition parser
-        ifparse=re.compile('^([^<>=!]+)\s*([!<>=]+)\s*(.+)$');
         while exflag == False:
             scrape = 1
             phase = phase + 1
             rep = {}
-
-            if_satisfied = False
-            if_next = False
-            if_end = False
-
-            src_printed = False
+            if phase > 1:
+                span.finish()
+                span = tracing.begin('phase', procurl, phase=phase)
 
             if proc_args:
-                inst = browser.get(procurl+"?"+proc_args).read()
+                inst = fetch_proc(browser, procurl+"?"+proc_args, fresh)
                 proc_args = ''
             elif phase1complete:
                 exflag = True
             else:
                 v['s_url'] = url
 
-            if inst == inst_prev:
-                print "Endless loop detected"
+            prog = nipl.get_program(inst)
+            if prog.digest == digest_prev:
+                log("Endless loop detected")
                 return None
+            digest_prev = prog.digest
 
-            inst_prev = inst
-            lines = inst.splitlines()
-
-            if not len(lines):
-                print "Processor error: nothing returned from phase "+phase
+            if not inst.splitlines():
+                log("Processor error: nothing returned from phase %d" % phase)
                 return None
 
-            linenum = 0
-            for line in lines:
-                #print "Processing %r" % line
-                linenum += 1
-                line = re.sub('^\s*', '', line)
-                if verbose > 0 and src_printed == False:
-                    print "Processor NIPL source:\n"+inst
-                    src_printed = True
+            if verbose > 0:
+                log("Processor NIPL source:\n"+inst)
 
-                if line[:1] == '#' or not line:
-                    continue
+            code = prog.code
+            end = len(code)
+            pc = 0
+            while pc < end:
+                ins = code[pc]
+                op = ins[0]
+                pc += 1
 
-                if if_end and line != 'endif':
-                    continue
+                if op == nipl.OP_ASSIGN:
+                    v[ins[1]] = nipl.value(v, ins[2])
 
-                if if_next and line[:5] != 'elseif' and line != 'else' and line != 'endif':
-                    continue
+                elif op == nipl.OP_IF:
+                    if not ins[1](v):
+                        pc = ins[2]
 
-                if line == 'else':
-                    if if_satisfied:
-                        if_end=True
-                    else:
-                        if_next = False
-                    continue
-                # /else
-
-                elif line == 'endif':
-                    if_satisfied = False
-                    if_next = False
-                    if_end = False
-                    continue
-                # /endif
-
-                elif line == 'scrape':
+                elif op == nipl.OP_JUMP:
+                    pc = ins[1]
+
+                elif op == nipl.OP_SCRAPE:
                     if not v['s_url']:
                         return None
                     if verbose:
-                        print "Scraping %r" % v['s_url']
+                        log("Scraping %r" % v['s_url'])
                     scrape = scrape + 1
                     if v['s_method'] == 'get':
                         kwargs = {}
@@ -217,7 +471,7 @@ def navix_get(procurl, url, browser=None, _ttl=5, byterange=None, verbose=0):
                         kwargs = {}
                         if v.get('s_cookie',''):
                             kwargs['Cookie'] = v['s_cookie']
-                        res = browser.get(v['s_url'], referer=v['s_referer'], data=v['s_postdata'], **kwargs)
+                        res = browser.get(v['s_url'], referer=v['s_referer'], data=v.get('s_postdata', ''), **kwargs)
                         if v['s_action'] == 'read':
                             v['htmRaw'] = res.read()
                         elif v['s_action'] == 'geturl':
@@ -231,7 +485,8 @@ def navix_get(procurl, url, browser=None, _ttl=5, byterange=None, verbose=0):
                             v[ke] = ''
                             rep[ke] = ''
                         p = re.compile(v['regex'])
-                        match = p.search(v['htmRaw'])
+                        with tracing.span('regex', v['regex'], bytes=len(v['htmRaw'])):
+                            match = p.search(v['htmRaw'])
                         if match:
                             for i in xrange(1, len(match.groups())+1):
                                 val = match.group(i)
@@ -239,151 +494,163 @@ def navix_get(procurl, url, browser=None, _ttl=5, byterange=None, verbose=0):
                                 rep[key] = val
                                 v[key] = val
                         else:
-                            print "Processor scrape: no match"
+                            log("Processor scrape: no match")
                             rep['nomatch'] = 1
                             v['nomatch'] = 1
-                # /scrape
 
-                elif line == 'play':
+                elif op == nipl.OP_PLAY:
                     exflag = True
-                # /play
 
-                elif line == 'report':
+                elif op == nipl.OP_REPORT:
                     rep['phase'] = str(phase)
                     proc_args = urllib.urlencode(rep)
-                    proc_args = re.sub('v\d+=&', '&', proc_args)
+                    proc_args = _report_empty_v.sub('&', proc_args)
                     proc_args = proc_args.replace('nomatch=&', '&')
-                    proc_args=re.sub('&+','&',proc_args)
-                    proc_args=re.sub('^&','',proc_args)
-                # /report
+                    proc_args = _report_amps.sub('&', proc_args)
+                    proc_args = _report_lead.sub('', proc_args)
 
-                else:
-                    # parse
-                    match = lparse.search(line)
-                    if match is None:
-                        print "Processor syntax error: "+line
-                        return None
-                    subj = match.group(1)
-                    arg = match.group(3)
+                elif op == nipl.OP_VERBOSE:
+                    verbose = ins[1]
 
-                    if subj == 'if' or subj == 'elsif':
-                        if if_satisfied:
-                            if_end = True
-                        else:
-                            # process if with operators
-                            match = ifparse.search(arg)
-                            if match:
-                                lkey = match.group(1)
-                                oper = match.group(2)
-                                rraw = match.group(3)
-                                if oper == '=':
-                                    oper = '=='
-                                if lkey not in v:
-                                    v[lkey] = ''
-                                if rraw[0:1] == "'":
-                                    rside = rraw[1:]
-                                else:
-                                    if rraw not in v:
-                                        v[rraw] = ''
-                                    rside = v[rraw]
-                                _bool = eval("v[lkey]" + oper + "rside")
-                            else:
-                                # process single if argument
-                                if arg not in v:
-                                    v[arg] = ''
-                                _bool = bool(v[arg])
-                        if _bool:
-                            if_satisfied = True
-                            if_next = False
-                        else:
-                            if_next = True
-                        continue
-                    if match.group(2) == '=':
-                        # assignment operator
-                        if arg[0:1] == "'":
-                            v[subj]=arg[1:]
-                        else:
-                            if arg not in v:
-                                v[arg] = ''
-                            v[subj] = v[arg]
+                elif op == nipl.OP_ERROR:
+                    log("Processing error: "+ins[1])
+                    return
+
+                elif op == nipl.OP_REPORT_VAL:
+                    rep[ins[1]] = nipl.value(v, ins[2])
+
+                elif op == nipl.OP_CONCAT:
+                    v[ins[1]] = v.get(ins[1], '') + nipl.value(v, ins[2])
+
+                elif op == nipl.OP_MATCH:
+                    v['nomatch'] = ''
+                    rep['nomatch'] = ''
+                    for i in xrange(1,11):
+                        ke = 'v'+str(i)
+                        v[ke] = ''
+                        rep[ke] = ''
+                    p = re.compile(v['regex'])
+                    with tracing.span('regex', v['regex'], bytes=len(v.get(ins[1], ''))):
+                        match = p.search(v.get(ins[1], ''))
+                    if match:
+                        for i in xrange(1, len(match.groups())+1):
+                            v['v%d'%i] = match.group(i)
                     else:
-                        # do command
-                        if subj == 'verbose':
-                            try: verbose = int(arg)
-                            except: verbose = 0
-                        elif subj == 'error':
-                            print "Processing error: "+arg[1:]
-                            return
-                        elif subj == 'report_val':
-                            match = lparse.search(arg)
-                            if match is None:
-                                print "Processor syntax error: "+line
-                                return
-                            ke = match.group(1)
-                            va = match.group(3)
-                            if va[0:1] == "'":
-                                rep[ke] = va[1:]
-                            else:
-                                rep[ke] = v.get(va,'')
-                        elif subj=='concat':
-                            match = lparse.search(arg)
-                            if match is None:
-                                print "Processor syntax error: "+line
-                                return
-                            ke = match.group(1)
-                            va = match.group(3)
-                            oldtmp = v.get(ke,'')
-                            if va[0:1] == "'":
-                                v[ke] = v[ke] + va[1:]
-                            else:
-                                v[ke] = v[ke] + v.get(va,'')
-                        elif subj == 'match':
-                            v['nomatch'] = ''
-                            rep['nomatch'] = ''
-                            for i in xrange(1,11):
-                                ke = 'v'+str(i)
-                                v[ke] = ''
-                                rep[ke] = ''
-                            p = re.compile(v['regex'])
-                            match = p.search(v[arg])
-                            if match:
-                                for i in xrange(1, len(match.groups())+1):
-                                    v['v%d'%i] = match.group(i)
-                            else:
-                                v['nomatch'] = 1
-                        elif subj == 'replace':
-                            # preset regex, replace var [']val
-                            match = lparse.search(arg)
-                            if match is None:
-                                print "Processor syntax error: "+line
-                                return
-                            ke = match.group(1)
-                            va = match.group(3)
-                            if va[0:1] == "'":
-                                va=va[1:]
-                            else:
-                                va=v.get(va, '')
-                            oldtmp = v.get(ke, '') # ??
-                            v[ke] = re.sub(v['regex'], va, v[ke])
-                        elif subj == 'unescape':
-                            oldtmp = v.get(arg, '')
-                            v[arg] = urllib.unquote(oldtmp)
-                        elif subj == 'debug' and verbose > 0:
-                            print "Processor debug "+arg+":\n" + v.get(arg,'');
-                        elif subj == 'print':
-                            if arg[0:1] == "'":
-                                print "Processor print: "+arg[1:]
-                            else:
-                                print "Processor print: "+v.get(arg,'')
-                        else:
-                            print "Processor error: unrecognised method '%s'" % subj
+                        v['nomatch'] = 1
+
+                elif op == nipl.OP_REPLACE:
+                    # preset regex, replace var [']val
+                    v[ins[1]] = re.sub(v['regex'], nipl.value(v, ins[2]), v.get(ins[1], ''))
+
+                elif op == nipl.OP_UNESCAPE:
+                    v[ins[1]] = urllib.unquote(v.get(ins[1], ''))
+
+                elif op == nipl.OP_DEBUG:
+                    if verbose > 0:
+                        log("Processor debug "+ins[1]+":\n" + v.get(ins[1],''))
+
+                elif op == nipl.OP_PRINT:
+                    log("Processor print: "+nipl.value(v, ins[1]))
+
+                elif op == nipl.OP_SYNTAX:
+                    log("Processor syntax error: "+ins[1])
+                    return None
+
+                elif op == nipl.OP_UNKNOWN:
+                    log("Processor error: unrecognised method '%s'" % ins[1])
 
             kwargs = {}
             if v.get('s_cookie'):
                 kwargs['Cookie'] = v['s_cookie']
-            if byterange is not None:
-                kwargs['Range'] = byterange
             if verbose:
-                print "URL: %s" % v.get('url','')
+                log("URL: %s" % v.get('url',''))
             if v.get('url',''):
-                return browser.get(v['url'], **kwargs)
+                return browser.resolution(v['url'], **kwargs)
+
+class Prefetcher(object):
+    """Resolves items in the background, ahead of 'get' or 'play', and
+    remembers them in the resolutions cache.  Only processors are
+    fetched, never the media itself.  At most workers resolutions run at
+    once, and a new request replaces any items still waiting.  Settings
+    left as None are read from PREFETCH_WORKERS, PREFETCH_LIMIT and
+    PREFETCH when they're needed."""
+    def __init__(self, workers=None, limit=None, enabled=None):
+        self.workers = workers
+        self.limit = limit
+        self.enabled = enabled
+        self.pending = deque()
+        self.inflight = set()
+        self.threads = []
+        self.cond = threading.Condition()
+        self.resolved = self.failed = 0
+
+    def on(self):
+        "Whether prefetching is enabled"
+        if self.enabled is None:
+            return PREFETCH
+        return self.enabled
+
+    def request(self, keys):
+        "Resolve the (processor, url) keys not already resolved or in progress"
+        if not self.on():
+            return
+        limit = self.limit
+        if limit is None:
+            limit = PREFETCH_LIMIT
+        workers = self.workers
+        if workers is None:
+            workers = PREFETCH_WORKERS
+        with self.cond:
+            self.pending.clear()
+            for key in keys:
+                if len(self.pending) >= limit:
+                    break
+                if key not in self.inflight and resolutions.get(key) is None:
+                    self.pending.append(key)
+            while len(self.threads) < min(workers, len(self.pending)):
+                t = threading.Thread(target=self.work, name="Prefetcher")
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+            self.cond.notify_all()
+
+    def work(self):
+        log_to(None) # nobody's waiting to read about it
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                key = self.pending.popleft()
+                self.inflight.add(key)
+            try:
+                res = navix_resolve(key[0], key[1], shared_browser())
+            except Exception:
+                res = None
+            if res is not None:
+                resolutions.put(key, res)
+            with self.cond:
+                if res is None:
+                    self.failed += 1
+                else:
+                    self.resolved += 1
+                self.inflight.discard(key)
+                self.cond.notify_all()
+
+    def wait(self, key):
+        "Wait for key to be resolved if it's in progress"
+        with self.cond:
+            while key in self.inflight:
+                self.cond.wait(1)
+
+    def cancel(self):
+        "Forget the items waiting to be resolved"
+        with self.cond:
+            self.pending.clear()
+
+    def stats(self):
+        return "prefetch: %s, %d waiting, %d in progress, %d resolved, %d failed" % (
+            self.on() and "on" or "off", len(self.pending),
+            len(self.inflight), self.resolved, self.failed)
+# Prefetcher
+
+prefetcher = Prefetcher()
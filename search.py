@@ -0,0 +1,346 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Local search over the items of every playlist loaded or crawled
+
+An inverted index maps each word in the name, infotag and description
+of an item to a posting list: an array of (item number << 4 | weight),
+where the weight counts the word's occurrences, with words in the name
+counting most.  Results are ranked by the sum of their words' weights
+times their inverse document frequency, favouring items that match
+every word of the query.  Words in more than COMMON items are only
+looked up in the best items matching the rarer words of the query,
+rather than adding every item they're in.
+
+Adding a playlist again replaces its items.  Loaded playlists are
+indexed on a background thread (add_later()), so loading isn't held up.
+Once there are more than MAX_ITEMS items, the playlists indexed longest
+ago are dropped.  The index is kept in memory and saved (pickled) to
+SEARCH_FILE by save().
+"""
+
+import os
+import re
+import math
+import array
+import threading
+import cPickle as pickle
+from collections import deque, OrderedDict
+from bisect import bisect_left
+from itertools import izip, repeat
+from operator import rshift, and_, mul
+
+SEARCH_FILE = os.path.join(os.path.expanduser("~"), ".navix", "search.idx")
+RESULTS = 500 # most results returned by a search
+# words in more items than this are only looked up in the best items
+# matching the rarer words of the query
+COMMON = 20000
+MAX_ITEMS = 500000 # items kept; the playlists indexed longest ago go first
+
+# how much a word counts for in each field
+FIELD_WEIGHTS = (('name', 4), ('infotag', 2), ('description', 1))
+# the fields kept for each item, to show and fetch search results
+STORED = ('type', 'name', 'URL', 'processor', 'infotag', 'thumb')
+# stored values shared by many items, kept once in memory and on disk
+SHARED = frozenset(['type', 'processor', 'thumb'])
+
+_colors = re.compile(r'\[/?COLOR[^\]]*\]')
+_words = re.compile(r'\w+', re.U)
+
+def tokenize(s):
+    "Return the lower-case words in s (UTF-8 or unicode) as UTF-8 strings"
+    if type(s) != unicode:
+        s = s.decode('utf-8', 'replace')
+    return [w.encode('utf-8') for w in _words.findall(_colors.sub(' ', s).lower())]
+
+class SearchIndex(object):
+    """An inverted index of playlist items, loaded from path on first use"""
+    def __init__(self, path=SEARCH_FILE):
+        self.path = path
+        self.docs = []      # item number -> stored values, or None if removed
+        self.sources = []   # playlist number -> URL
+        # playlist URL -> (playlist number, array of items), oldest first
+        self.playlists = OrderedDict()
+        self.postings = {}  # word -> array of (item number << 4 | weight)
+        self.removed = 0
+        self.loaded = False
+        self.dirty = False
+        self.lock = threading.RLock()
+        self.pending = deque() # (url, items) waiting to be indexed
+        self.worker = None
+        self.pending_lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            try:
+                fd = open(self.path, "rb")
+            except IOError:
+                return
+            try:
+                try:
+                    state = pickle.load(fd)
+                except Exception:
+                    return # a corrupt index is an empty index
+            finally:
+                fd.close()
+            (self.docs, self.sources, self.playlists, self.postings,
+             self.removed) = state
+            if not isinstance(self.playlists, OrderedDict):
+                self.playlists = OrderedDict(sorted(self.playlists.iteritems(),
+                                                    key=lambda e: e[1][0]))
+
+    def save(self):
+        "Write the index to disk if it's changed, ignoring errors"
+        self.flush()
+        with self.lock:
+            if not self.dirty:
+                return
+            if self.removed > len(self.docs) // 4:
+                self.compact()
+            state = (self.docs, self.sources, self.playlists, self.postings,
+                     self.removed)
+            tmpname = "%s.%d" % (self.path, os.getpid())
+            try:
+                try:
+                    os.makedirs(os.path.dirname(self.path))
+                except OSError:
+                    pass
+                fd = open(tmpname, "wb")
+                try:
+                    pickle.dump(state, fd, pickle.HIGHEST_PROTOCOL)
+                finally:
+                    fd.close()
+                os.rename(tmpname, self.path)
+                self.dirty = False
+            except (IOError, OSError):
+                try: os.unlink(tmpname)
+                except OSError: pass
+
+    def compact(self):
+        "Renumber the items to drop the ones that have been removed"
+        renumber = array.array('i', [-1]) * len(self.docs)
+        docs = []
+        for i, doc in enumerate(self.docs):
+            if doc is not None:
+                renumber[i] = len(docs)
+                docs.append(doc)
+        postings = {}
+        for word, plist in self.postings.iteritems():
+            new = array.array('I', [(renumber[p >> 4] << 4) | (p & 15)
+                                    for p in plist if renumber[p >> 4] >= 0])
+            if new:
+                postings[word] = new
+        for url, (source, items) in self.playlists.items():
+            self.playlists[url] = (source, array.array('I',
+                [renumber[i] for i in items if renumber[i] >= 0]))
+        self.docs = docs
+        self.postings = postings
+        self.removed = 0
+
+    def begin(self, url):
+        "Start (re)indexing the playlist at url, removing its old items"
+        with self.lock:
+            self.load()
+            entry = self.playlists.pop(url, None)
+            if entry is None:
+                self.sources.append(url)
+                entry = (len(self.sources) - 1, array.array('I'))
+            else:
+                self.remove(entry[1])
+                entry = (entry[0], array.array('I'))
+            self.trim()
+            self.playlists[url] = entry # the newest
+            self.dirty = True
+
+    def remove(self, items):
+        for i in items:
+            if self.docs[i] is not None:
+                self.docs[i] = None
+                self.removed += 1
+
+    def trim(self):
+        """Drop the playlists indexed longest ago while there are more
+        than MAX_ITEMS items, compacting once a quarter have gone"""
+        while self.playlists and len(self.docs) - self.removed > MAX_ITEMS:
+            url, (source, items) = self.playlists.popitem(last=False)
+            self.remove(items)
+        if self.removed > len(self.docs) // 4:
+            self.compact()
+
+    def add(self, url, item):
+        """Index an item (a mapping of keys to UTF-8 values) of the
+        playlist at url, after begin(url).  If the playlist has been
+        dropped by trim() since, eg. for another crawler thread's
+        begin(), the item is dropped too."""
+        weights = {}
+        for field, weight in FIELD_WEIGHTS:
+            value = item.get(field)
+            if value:
+                for word in tokenize(value):
+                    weights[word] = weights.get(word, 0) + weight
+        stored = tuple([self.stored(k, item.get(k)) for k in STORED])
+        with self.lock:
+            entry = self.playlists.get(url)
+            if entry is None:
+                return
+            source, items = entry
+            n = len(self.docs)
+            self.docs.append((source,) + stored)
+            items.append(n)
+            postings = self.postings
+            for word, weight in weights.iteritems():
+                plist = postings.get(word)
+                if plist is None:
+                    plist = postings[word] = array.array('I')
+                plist.append((n << 4) | min(weight, 15))
+
+    @staticmethod
+    def stored(key, value):
+        if not value:
+            return None
+        if type(value) == unicode:
+            value = value.encode('utf-8')
+        if key in SHARED:
+            value = intern(value)
+        return value
+
+    def add_playlist(self, url, items):
+        "Index (or reindex) all the items of a playlist"
+        with self.lock:
+            self.begin(url)
+            for item in items:
+                self.add(url, item)
+
+    def add_later(self, url, items):
+        """Index (or reindex) the items of a playlist on a background
+        thread.  items can be an iterator, only run when it's indexed."""
+        with self.pending_lock:
+            self.pending.append((url, items))
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.work,
+                                               name="Search index")
+                self.worker.daemon = True
+                self.worker.start()
+
+    def next_pending(self, worker=False):
+        "Take the next playlist waiting to be indexed, or return None"
+        with self.pending_lock:
+            if self.pending:
+                return self.pending.popleft()
+            if worker:
+                self.worker = None
+            return None
+
+    def work(self):
+        while True:
+            job = self.next_pending(True)
+            if job is None:
+                return
+            self.add_playlist(*job)
+
+    def flush(self):
+        "Index the playlists waiting to be, before a search or save"
+        while True:
+            job = self.next_pending()
+            if job is None:
+                return
+            self.add_playlist(*job)
+
+    def search(self, query, limit=RESULTS):
+        """Return up to limit (score, item dict, playlist URL) for the best
+        matches of query, with items whose URL has already been listed
+        left out"""
+        words = list(set(tokenize(query)))
+        if not words:
+            return []
+        self.flush()
+        with self.lock:
+            self.load()
+            ndocs = float(len(self.docs) - self.removed) or 1.0
+            # rarest first, so common words can be looked up in the items
+            # they've matched rather than scanned
+            plists = sorted(filter(None, map(self.postings.get, words)), key=len)
+            scores = {}
+            matched = {}
+            for plist in plists:
+                idf = math.log(1 + ndocs / len(plist))
+                if not scores:
+                    # map() keeps the loop over a long list in C
+                    count = len(plist)
+                    ids = map(rshift, plist, repeat(4, count))
+                    weights = map(and_, plist, repeat(15, count))
+                    scores = dict(izip(ids, map(mul, weights, repeat(idf, count))))
+                    matched = dict.fromkeys(ids, 1)
+                elif len(plist) <= COMMON:
+                    for p in plist:
+                        n = p >> 4
+                        scores[n] = scores.get(n, 0.0) + idf * (p & 15)
+                        matched[n] = matched.get(n, 0) + 1
+                else:
+                    if len(scores) > 8 * limit:
+                        # only the best so far can make it to the results
+                        best = sorted(scores, key=scores.get, reverse=True)[:8 * limit]
+                        scores = dict((n, scores[n]) for n in best)
+                        matched = dict((n, matched[n]) for n in best)
+                    # the postings are in item order, so can be bisected
+                    for n in scores:
+                        i = bisect_left(plist, n << 4)
+                        if i < len(plist) and plist[i] >> 4 == n:
+                            scores[n] += idf * (plist[i] & 15)
+                            matched[n] += 1
+            nwords = float(len(words))
+            if len(plists) > 1:
+                # favour the items that match the most words of the query
+                for n, m in matched.iteritems():
+                    if m < nwords:
+                        scores[n] *= (m / nwords) ** 2
+            results = []
+            seen = set()
+            for n in sorted(scores, key=scores.get, reverse=True):
+                doc = self.docs[n]
+                if doc is None or doc[3] in seen:
+                    continue
+                if doc[3] is not None:
+                    seen.add(doc[3])
+                item = dict((k, v) for k, v in zip(STORED, doc[1:]) if v)
+                results.append((scores[n], item, self.sources[doc[0]]))
+                if len(results) >= limit:
+                    break
+            return results
+
+    def clear(self):
+        with self.lock:
+            self.docs = []
+            self.sources = []
+            self.playlists = OrderedDict()
+            self.postings = {}
+            self.removed = 0
+            self.loaded = self.dirty = True
+
+    def stats(self):
+        with self.lock:
+            return "search index: %d items from %d playlists, %d words" % (
+                len(self.docs) - self.removed, len(self.playlists),
+                len(self.postings))
+# SearchIndex
+
+index = SearchIndex()
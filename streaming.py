@@ -0,0 +1,392 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Streaming a response to a player through a read-ahead buffer
+
+One thread reads the response into a bounded buffer while another feeds
+the player from it, so a network stall doesn't stall playback until the
+buffer runs dry, and a player that stops reading doesn't stop the
+download until the buffer is full.
+
+On Linux, when the body can be read straight from a plain TCP socket and
+a pipe can hold BUFFER_SIZE bytes (see /proc/sys/fs/pipe-max-size), the
+buffer is a pipe and the data is moved with splice(), without ever being
+copied into Python.  Otherwise it's a RingBuffer in memory.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import threading
+from subprocess import Popen, PIPE
+
+import downloader
+
+BUFFER_SIZE = 8 << 20 # bytes read ahead of the player
+PREFILL = 1 << 20     # bytes buffered before the player is started
+CHUNK = 1 << 16       # largest write to the player
+
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+SPLICE_F_MORE = 4
+
+_splice = None
+if sys.platform.startswith('linux'):
+    try:
+        import ctypes
+        import fcntl
+        import termios
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _splice = _libc.splice
+        _splice.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint)
+        _splice.restype = ctypes.c_ssize_t
+    except (ImportError, OSError, AttributeError):
+        _splice = None
+
+def pipe_max_size():
+    "The largest pipe an unprivileged process may make, or 0 if unknown"
+    try:
+        fd = open("/proc/sys/fs/pipe-max-size")
+        try:
+            return int(fd.read())
+        finally:
+            fd.close()
+    except (IOError, ValueError):
+        return 0
+
+def mb(nbytes):
+    return "%.1fMB" % (nbytes / 1048576.0)
+
+class RingBuffer(object):
+    """A bounded FIFO of bytes in one preallocated bytearray, for one
+    producer and one consumer thread.  Each side works on its own part of
+    the array outside the lock, so bytes are copied once on the way in
+    (by readinto) and once on the way out (by os.write)."""
+    def __init__(self, size):
+        self.size = size
+        self.view = memoryview(bytearray(size))
+        self.head = 0  # next byte to be read
+        self.count = 0 # bytes in the buffer
+        self.eof = False    # the producer has finished
+        self.closed = False # the consumer has gone
+        self.underruns = 0
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        return self.count
+
+    def capacity(self):
+        return self.size
+
+    def finish(self):
+        with self.cond:
+            self.eof = True
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def release(self):
+        pass
+
+    def wait(self, nbytes, timeout):
+        "Wait up to timeout for nbytes to be buffered, or the end of the input"
+        with self.cond:
+            if self.count < nbytes and not self.eof:
+                self.cond.wait(timeout)
+
+    def produce(self, res, progress):
+        "Read the response into the buffer until it ends or the buffer is closed"
+        readinto = downloader.readinto_of(res)
+        if readinto is None:
+            def readinto(view):
+                data = res.read(len(view))
+                view[:len(data)] = data
+                return len(data)
+        size = self.size
+        while True:
+            with self.cond:
+                while self.count == size and not self.closed:
+                    self.cond.wait(1)
+                if self.closed:
+                    return
+                tail = (self.head + self.count) % size
+                free = min(size - self.count, size - tail)
+            n = readinto(self.view[tail:tail + free])
+            if not n:
+                return
+            progress.update(n)
+            with self.cond:
+                self.count += n
+                self.cond.notify_all()
+
+    def consume(self, fd):
+        "Write the buffer to fd until the input ends or the buffer is closed"
+        size = self.size
+        while True:
+            with self.cond:
+                if self.count == 0 and not self.eof:
+                    self.underruns += 1
+                    while self.count == 0 and not self.eof and not self.closed:
+                        self.cond.wait(1)
+                if self.closed or self.count == 0:
+                    return
+                head = self.head
+                avail = min(self.count, size - head, CHUNK)
+            n = os.write(fd, self.view[head:head + avail])
+            with self.cond:
+                self.head = (head + n) % size
+                self.count -= n
+                self.cond.notify_all()
+# RingBuffer
+
+class PipeBuffer(object):
+    """A pipe used as the buffer, filled from a socket and drained into
+    the player with splice()"""
+    def __init__(self, size):
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            # the player mustn't hold the pipe open
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        try:
+            fcntl.fcntl(self.wfd, F_SETPIPE_SZ, size)
+        except IOError:
+            pass # too big after all; use what we have
+        self.size = fcntl.fcntl(self.wfd, F_GETPIPE_SZ)
+        self.eof = False
+        self.closed = threading.Event()
+        self.underruns = 0
+
+    @classmethod
+    def usable(cls, res, size):
+        "Return the socket body of res if it can be spliced into a pipe of size bytes"
+        if _splice is None or size > pipe_max_size():
+            return None
+        socket_body = getattr(getattr(res, 'fp', None), 'socket_body', None)
+        return socket_body and socket_body()
+
+    def __len__(self):
+        try:
+            buf = fcntl.ioctl(self.rfd, termios.FIONREAD, '\0' * 4)
+        except IOError:
+            return 0
+        return struct.unpack('i', buf)[0]
+
+    def capacity(self):
+        return self.size
+
+    def splice(self, fd_in, fd_out, nbytes):
+        """Move up to nbytes from fd_in to fd_out, waiting until both are
+        ready.  Returns the number moved, 0 at the end of the input or
+        once the buffer has been closed."""
+        while not self.closed.is_set():
+            n = _splice(fd_in, None, fd_out, None, nbytes,
+                        SPLICE_F_MOVE | SPLICE_F_NONBLOCK | SPLICE_F_MORE)
+            if n >= 0:
+                return n
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err != errno.EAGAIN:
+                raise OSError(err, os.strerror(err))
+            # wait for each side in turn, so neither can make us spin
+            select.select([fd_in], [], [], 1)
+            select.select([], [fd_out], [], 1)
+        return 0
+
+    def finish(self):
+        "End the input, so the consumer sees the end once the pipe's empty"
+        self.eof = True
+        os.close(self.wfd)
+
+    def close(self):
+        self.closed.set()
+
+    def release(self):
+        "Close the pipe, once neither side is using it"
+        os.close(self.rfd)
+        if not self.eof:
+            os.close(self.wfd)
+
+    def wait(self, nbytes, timeout):
+        if len(self) < nbytes and not self.eof:
+            time.sleep(min(timeout, 0.1))
+
+    def produce(self, source, progress):
+        "Splice the socket body into the pipe"
+        data, fd, left = source
+        view = memoryview(data)
+        while view:
+            # what was read along with the headers
+            n = os.write(self.wfd, view)
+            progress.update(n)
+            view = view[n:]
+        while left is None or left > 0:
+            n = self.splice(fd, self.wfd, left is None and CHUNK or min(left, CHUNK))
+            if not n:
+                return
+            progress.update(n)
+            if left is not None:
+                left -= n
+
+    def consume(self, fd):
+        "Splice the pipe into fd until the input ends or the buffer is closed"
+        while True:
+            if not len(self) and not self.eof:
+                self.underruns += 1
+            if not self.splice(self.rfd, fd, CHUNK):
+                return
+# PipeBuffer
+
+class Stream(object):
+    """A response being read ahead into a buffer of size bytes
+    (BUFFER_SIZE by default) on its own thread"""
+    def __init__(self, res, name, size=None):
+        if size is None:
+            size = BUFFER_SIZE
+        self.res = res
+        self.source = PipeBuffer.usable(res, size)
+        if self.source is not None:
+            self.buffer = PipeBuffer(size)
+        else:
+            self.buffer = RingBuffer(size)
+        self.progress = downloader.Progress(name)
+        self.error = None
+        self.lowest = None # the emptiest the buffer has been while playing
+        self.stopping = False
+        self.threads = []
+
+    def spawn(self, target, name, *args):
+        t = threading.Thread(target=target, args=args, name=name)
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def start(self):
+        "Start reading ahead"
+        self.progress.start(downloader.response_range(self.res)[1])
+        self.spawn(self.produce, "Stream producer")
+
+    def produce(self):
+        try:
+            self.buffer.produce(self.source or self.res, self.progress)
+        except Exception, e:
+            if not self.stopping:
+                self.error = e
+        finally:
+            self.buffer.finish()
+
+    def prefill(self, nbytes, out=sys.stdout):
+        "Wait until nbytes are buffered (or the whole response is), showing how it's going"
+        nbytes = min(nbytes, self.buffer.capacity())
+        while len(self.buffer) < nbytes and not self.buffer.eof:
+            out.write("\r\033[KBuffering %s of %s (~%s)" % (mb(len(self.buffer)),
+                mb(nbytes), downloader.ratestring(self.progress.kbps())))
+            out.flush()
+            self.buffer.wait(nbytes, 0.25)
+        out.write("\r\033[K")
+        out.flush()
+        return self.error is None
+
+    def feed(self, out):
+        "Start feeding the buffer to the file out, closing it at the end"
+        self.spawn(self.consume, "Stream consumer", out)
+
+    def consume(self, out):
+        try:
+            self.buffer.consume(out.fileno())
+        except (IOError, OSError, select.error), e:
+            # EPIPE: the player quit
+            if e.args[0] != errno.EPIPE and not self.stopping:
+                self.error = e
+        finally:
+            self.buffer.close()
+            try:
+                out.close()
+            except IOError:
+                pass
+
+    def sample(self):
+        "Note how full the buffer is, for health()"
+        # spliced pages can hold more than the pipe's nominal size
+        fill = min(len(self.buffer), self.buffer.capacity())
+        if self.lowest is None or fill < self.lowest:
+            self.lowest = fill
+
+    def stop(self):
+        "Stop both threads, and close the response"
+        self.stopping = True
+        self.buffer.close()
+        for t in self.threads:
+            t.join(2)
+        self.res.close()
+        if not any(t.isAlive() for t in self.threads):
+            self.buffer.release()
+
+    def health(self):
+        "Describe how well the buffer kept up"
+        cap = self.buffer.capacity()
+        s = "%s buffer (%s), %s read at ~%s, %d underruns" % (
+            mb(cap), self.source and "splice" or "memory",
+            mb(self.progress.count), downloader.ratestring(self.progress.kbps()),
+            self.buffer.underruns)
+        if self.lowest is not None:
+            s += ", lowest fill %d%%" % (100 * self.lowest // cap)
+        return s
+# Stream
+
+def play(res, cmd, name="stream", size=None, prefill=None):
+    """Play a response by piping it to the player command cmd, reading
+    ahead into a buffer of size bytes (BUFFER_SIZE), of which prefill
+    (PREFILL) are read before the player is started"""
+    if size is None:
+        size = BUFFER_SIZE
+    if prefill is None:
+        prefill = PREFILL
+    stream = Stream(res, name, size)
+    stream.start()
+    try:
+        if not stream.prefill(prefill):
+            print "!! %s" % stream.error
+            return
+        player = Popen(cmd, stdin=PIPE, close_fds=True)
+        stream.feed(player.stdin)
+        underruns = 0
+        while player.poll() is None:
+            time.sleep(0.5)
+            if not stream.buffer.eof:
+                stream.sample()
+            if stream.buffer.underruns > underruns and not stream.buffer.eof:
+                underruns = stream.buffer.underruns
+                print >>sys.stderr, "\n-- buffer empty, waiting for the network"
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stream.stop()
+    if stream.error is not None:
+        print "!! %s" % stream.error
+    print stream.health()
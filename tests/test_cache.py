@@ -0,0 +1,90 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the on-disk cache's pruning
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import cache
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="navix-cache-")
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def fill(self, disk, n):
+        "Store n entries, each a second older than the next"
+        now = time.time()
+        for i in xrange(n):
+            url = "http://example.com/%d" % i
+            disk.put(url, cache.Entry(url, "body %d" % i))
+            t = now - (n - i)
+            os.utime(disk.filename(url), (t, t))
+
+    def test_maxitems(self):
+        disk = cache.DiskCache(self.path, maxitems=5)
+        self.fill(disk, 12)
+        disk.prune()
+        self.assertEqual(len(os.listdir(self.path)), 5)
+        for i in xrange(7):
+            self.assertEqual(disk.get("http://example.com/%d" % i), None)
+        for i in xrange(7, 12):
+            self.assertEqual(disk.get("http://example.com/%d" % i).body, "body %d" % i)
+
+    def test_maxage(self):
+        disk = cache.DiskCache(self.path, maxitems=100, maxage=5.5)
+        self.fill(disk, 10)
+        disk.prune()
+        self.assertEqual(len(os.listdir(self.path)), 5)
+        self.assertEqual(disk.get("http://example.com/4"), None)
+        self.assertEqual(disk.get("http://example.com/5").body, "body 5")
+
+    def test_used_entries_kept(self):
+        disk = cache.DiskCache(self.path, maxitems=3)
+        self.fill(disk, 6)
+        disk.get("http://example.com/0") # now the most recently used
+        disk.prune()
+        self.assertEqual(disk.get("http://example.com/0").body, "body 0")
+        self.assertEqual(disk.get("http://example.com/3"), None)
+
+    def test_pruned_when_stored(self):
+        old = cache.PRUNE_EVERY, cache.DISK_MAXITEMS
+        cache.PRUNE_EVERY, cache.DISK_MAXITEMS = 4, 2 # read when pruning
+        try:
+            disk = cache.DiskCache(self.path)
+            self.fill(disk, 9) # pruned storing the 1st, 5th and 9th
+        finally:
+            cache.PRUNE_EVERY, cache.DISK_MAXITEMS = old
+        self.assertEqual(len(os.listdir(self.path)), 2)
+# DiskCacheTest
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the search index's limit on its size
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import search
+
+def item(n):
+    return {'type' : 'video', 'name' : 'clip%d' % n,
+            'URL' : 'http://example.com/%d' % n}
+
+class TrimTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="navix-search-")
+        self.index = search.SearchIndex(os.path.join(self.dir, "search.idx"))
+        self.max_items = search.MAX_ITEMS
+        search.MAX_ITEMS = 100
+
+    def tearDown(self):
+        search.MAX_ITEMS = self.max_items
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def count(self):
+        return len(self.index.docs) - self.index.removed
+
+    def test_oldest_dropped(self):
+        for p in xrange(10):
+            self.index.add_playlist("http://example.com/%d.plx" % p,
+                                    [item(p * 30 + i) for i in xrange(30)])
+        # trimmed before each playlist is begun
+        self.assertTrue(self.count() <= search.MAX_ITEMS + 30)
+        self.assertFalse("http://example.com/0.plx" in self.index.playlists)
+        self.assertTrue("http://example.com/9.plx" in self.index.playlists)
+        self.assertEqual(len(self.index.search("clip299")), 1)
+        self.assertEqual(self.index.search("clip0"), [])
+
+    def test_crawled_concurrently(self):
+        # each crawler worker begins a playlist then adds its items, while
+        # the others' begin() may drop that playlist to make room
+        errors = []
+        def work(w):
+            try:
+                for p in xrange(40):
+                    url = "http://example.com/%d/%d.plx" % (w, p)
+                    self.index.begin(url)
+                    for i in xrange(25):
+                        self.index.add(url, item(i))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(w,)) for w in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(self.count() <= search.MAX_ITEMS + 8 * 25)
+        for url, (source, items) in self.index.playlists.iteritems():
+            for i in items:
+                self.assertNotEqual(self.index.docs[i], None)
+# TrimTest
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+#
+# Navi-X CLI
+# Copyright (C) 2010  Robert Thomson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Timing spans for HTTP requests, processors, playlists and downloads
+
+A span times one piece of work, of one of these kinds:
+
+    http      a request: dns, connect and ttfb (from sending the request
+              to reading the response headers) and body seconds, status
+              and bytes
+    resolve   a processor working out an item's final URL
+    phase     a phase of a processor: fetching its script (or output),
+              then scraping
+    regex     a processor's regex, with the bytes it searched
+    parse     parsing a playlist, with the items it had
+    download  a download, with its bytes
+    proxy     a request to the streaming proxy, with its status and the
+              bytes passed on
+
+Spans started while another is open in the same thread are its children,
+and inherit its processor ('proc').  Finished spans are kept in a ring
+buffer of the last SPANS for 'stats', and appended to TRACE_FILE as
+lines of JSON if it's set.
+
+    with tracing.span('resolve', url, proc=procurl):
+        ...
+"""
+
+import time
+import threading
+from collections import deque
+from itertools import count
+
+TRACING = True    # False stops spans being recorded
+SPANS = 5000      # finished spans kept for 'stats'
+TRACE_FILE = None # every finished span is appended here as a line of JSON
+
+_spans = deque(maxlen=SPANS)
+_ids = count(1)
+_local = threading.local()
+_trace_lock = threading.Lock()
+_trace_fd = None
+
+def _stack():
+    "The spans open in this thread, innermost last"
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+class Span(object):
+    """One timed piece of work: its kind, what it worked on (a URL or
+    file name), its parent's id and any other attributes.  Using it in
+    a with statement makes it the parent of the spans started inside."""
+    __slots__ = ('id', 'parent', 'kind', 'name', 'start', 'end', 'attrs')
+
+    def __init__(self, kind, name, parent=None, attrs=None):
+        self.id = next(_ids)
+        self.parent = parent
+        self.kind = kind
+        self.name = name
+        self.attrs = attrs or {}
+        self.start = time.time()
+        self.end = None
+
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self, **attrs):
+        """Stop timing, with attrs, and keep the span, finishing any
+        spans still open inside it"""
+        if self.end is not None:
+            return
+        self.end = time.time()
+        self.attrs.update(attrs)
+        stack = _stack()
+        if self in stack:
+            while stack:
+                span = stack.pop()
+                if span is self:
+                    break
+                span.finish()
+        keep(self)
+
+    def __enter__(self):
+        _stack().append(self)
+        return self
+
+    def __exit__(self, type, value, tb):
+        if value is not None:
+            self.finish(error=describe(value))
+        else:
+            self.finish()
+
+    def to_dict(self):
+        d = dict(self.attrs, id=self.id, kind=self.kind, name=self.name,
+                 start=round(self.start, 6), duration=round(self.duration(), 6))
+        if self.parent is not None:
+            d['parent'] = self.parent
+        return d
+# Span
+
+class NullSpan(object):
+    "What span() returns when TRACING is off"
+    attrs = property(lambda self: {})
+    def set(self, **attrs): pass
+    def finish(self, **attrs): pass
+    def __enter__(self): return self
+    def __exit__(self, type, value, tb): pass
+# NullSpan
+
+_null = NullSpan()
+
+def span(kind, name, **attrs):
+    """Start a span, a child of the innermost span open in this thread.
+    Finish it with finish(), or by using it in a with statement."""
+    if not TRACING:
+        return _null
+    stack = _stack()
+    parent = None
+    if stack:
+        parent = stack[-1]
+        if 'proc' not in attrs and 'proc' in parent.attrs:
+            attrs['proc'] = parent.attrs['proc']
+        parent = parent.id
+    return Span(kind, name, parent, attrs)
+
+def begin(kind, name, **attrs):
+    """Start a span and make it the parent of the spans started after it
+    in this thread, until it finishes"""
+    return span(kind, name, **attrs).__enter__()
+
+def describe(e):
+    return "%s: %s" % (type(e).__name__, e)
+
+def keep(span):
+    "Add a finished span to the ring buffer, and to TRACE_FILE"
+    global _trace_fd
+    _spans.append(span)
+    if TRACE_FILE is None:
+        return
+    import json
+    line = json.dumps(span.to_dict(), sort_keys=True) + '\n'
+    with _trace_lock:
+        try:
+            if _trace_fd is None or _trace_fd.name != TRACE_FILE:
+                _trace_fd = open(TRACE_FILE, 'a')
+            _trace_fd.write(line)
+            _trace_fd.flush()
+        except IOError:
+            pass # monitoring mustn't stop a download
+
+def spans(kind=None):
+    "The finished spans kept, oldest first, of one kind or all of them"
+    kept = list(_spans)
+    if kind is None:
+        return kept
+    return [s for s in kept if s.kind == kind]
+
+def clear():
+    _spans.clear()
+
+def export(fd):
+    "Write the spans kept to fd as lines of JSON, returning how many"
+    import json
+    kept = spans()
+    for s in kept:
+        fd.write(json.dumps(s.to_dict(), sort_keys=True) + '\n')
+    return len(kept)
+
+def percentile(values, p):
+    "The p'th percentile of values (nearest rank), or None if there are none"
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def summarize(kept, key, value=Span.duration, **medians):
+    """Group spans by key(span), leaving out the ones it returns None for,
+    and return a dict for each group, busiest first: its key, count,
+    errors and bytes, the p50, p90 and p99 of value(span) in seconds,
+    and the median of each of the other functions given, by name"""
+    groups = {}
+    for s in kept:
+        k = key(s)
+        if k is not None:
+            groups.setdefault(k, []).append(s)
+    rows = []
+    for k, group in groups.iteritems():
+        values = [v for v in map(value, group) if v is not None]
+        row = { 'key' : k, 'count' : len(group),
+                'errors' : sum(1 for s in group if 'error' in s.attrs),
+                'bytes' : sum(s.attrs.get('bytes') or 0 for s in group),
+                'p50' : percentile(values, 50), 'p90' : percentile(values, 90),
+                'p99' : percentile(values, 99) }
+        for name, func in medians.iteritems():
+            row[name] = percentile([v for v in map(func, group)
+                                    if v is not None], 50)
+        rows.append(row)
+    rows.sort(key=lambda row: -row['count'])
+    return rows